@@ -0,0 +1,22 @@
+from .utm import UtmClient, parse_utm_response, is_rejection
+from .outbox import OutboxDispatcher
+from .cheque import ChequeBuilder
+from .schema import ChequeValidator, ChequeValidationError, validate_egais_fields, validate_bottle_fields
+from .upload import UploadTooLarge, receive_xml_upload
+from .breaker import CircuitBreaker, CircuitOpenError
+
+__all__ = [
+    'UtmClient',
+    'OutboxDispatcher',
+    'CircuitBreaker',
+    'ChequeBuilder',
+    'ChequeValidator',
+    'ChequeValidationError',
+    'CircuitOpenError',
+    'UploadTooLarge',
+    'parse_utm_response',
+    'is_rejection',
+    'receive_xml_upload',
+    'validate_egais_fields',
+    'validate_bottle_fields'
+]
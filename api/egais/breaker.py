@@ -0,0 +1,155 @@
+import asyncio
+import time
+from datetime import datetime
+
+from loguru import logger
+
+CLOSED = "closed"
+OPEN = "open"
+
+
+class CircuitOpenError(ConnectionError):
+    """Обращение отклонено без сетевого запроса: сервис недоступен по данным автомата"""
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты для внешнего сервиса (УТМ ЕГАИС).
+
+    После failure_threshold ошибок подряд автомат размыкается: запросы сразу
+    получают CircuitOpenError вместо ожидания таймаута. Пока автомат разомкнут,
+    сервис проверяется дешевым запросом probe() раз в probe_interval секунд;
+    первая успешная проверка замыкает автомат и вызывает on_close. В замкнутом
+    состоянии проверка выполняется раз в health_interval секунд (0 - только
+    по запросам), чтобы знать о недоступности до первого чека.
+    """
+
+    def __init__(self, name, failure_threshold=3, probe=None, probe_interval=5, health_interval=60, on_close=None):
+        """
+        :param probe: async probe() - исключение, если сервис недоступен
+        :param on_close: on_close() - автомат замкнулся, сервис снова доступен
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.health_interval = health_interval
+        self.on_close = on_close
+        self.state = CLOSED
+        self.failures = 0  # Ошибок подряд
+        self.counters = {'successes': 0, 'failures': 0, 'rejected': 0, 'opened': 0, 'probes': 0, 'probe_failures': 0}
+        self.last_error = None
+        self.opened_at = None
+        self.last_probe = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self.probe is not None:
+            self._task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def allow(self):
+        """Можно ли обращаться к сервису"""
+        return self.state == CLOSED
+
+    def check(self):
+        """
+        Проверить автомат перед запросом
+
+        :raises CircuitOpenError: автомат разомкнут
+        """
+        if self.state != CLOSED:
+            self.counters['rejected'] += 1
+            raise CircuitOpenError(f"{self.name} недоступен (автомат разомкнут после ошибки: {self.last_error})")
+
+    def record_success(self):
+        self.counters['successes'] += 1
+        self.failures = 0
+        if self.state != CLOSED:
+            self._close("запрос выполнен")
+
+    def record_failure(self, error):
+        self.counters['failures'] += 1
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+        if self.state == CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.counters['opened'] += 1
+        logger.error(f"{self.name} недоступен ({self.failures} ошибок подряд: {self.last_error}), "
+                     f"запросы отклоняются до успешной проверки")
+        self._wakeup.set()
+
+    def _close(self, reason):
+        downtime = time.monotonic() - self.opened_at if self.opened_at else 0
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        logger.info(f"{self.name} снова доступен ({reason}), недоступен был {downtime:.0f} с")
+        if self.on_close:
+            self.on_close()
+
+    async def run_probe(self):
+        """Проверить сервис немедленно"""
+        self.counters['probes'] += 1
+        started = time.monotonic()
+        try:
+            await self.probe()
+        except Exception as e:
+            self.counters['probe_failures'] += 1
+            self.last_probe = {'ok': False, 'error': str(e) or type(e).__name__}
+            if self.state == CLOSED:
+                self.record_failure(e)
+        else:
+            self.last_probe = {'ok': True, 'error': None}
+            if self.state != CLOSED:
+                self._close("проверка прошла")
+            else:
+                self.failures = 0
+        self.last_probe.update(
+            checked_at=datetime.now().isoformat(),
+            latency_ms=round((time.monotonic() - started) * 1000, 1)
+        )
+        return self.last_probe
+
+    async def _probe_loop(self):
+        while True:
+            interval = self.probe_interval if self.state != CLOSED else self.health_interval
+            self._wakeup.clear()
+            if interval:
+                try:
+                    # Размыкание автомата прерывает долгую паузу замкнутого состояния
+                    await asyncio.wait_for(self._wakeup.wait(), interval)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._wakeup.wait()
+                continue
+            try:
+                await self.run_probe()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Ошибка проверки {self.name}: {e}")
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'failure_threshold': self.failure_threshold,
+            'open_for': round(time.monotonic() - self.opened_at, 1) if self.opened_at else None,
+            'last_error': self.last_error,
+            'last_probe': self.last_probe,
+            'counters': dict(self.counters)
+        }
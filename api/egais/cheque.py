@@ -0,0 +1,67 @@
+from copy import deepcopy
+
+from lxml import etree
+
+NS_DOC = "http://fsrar.ru/WEGAIS/WB_DOC_SINGLE_01"
+NS_CHEQUE = "http://fsrar.ru/WEGAIS/ChequeV3"
+
+NSMAP = {
+    'xsi': "http://www.w3.org/2001/XMLSchema-instance",
+    'ns': NS_DOC,
+    'ck': NS_CHEQUE,
+    'oref': "http://fsrar.ru/WEGAIS/ClientRef_v2",
+    'pref': "http://fsrar.ru/WEGAIS/ProductRef_v2",
+}
+
+HEADER_FIELDS = ('Date', 'Kassa', 'Shift', 'Number', 'Type')
+BOTTLE_FIELDS = ('Barcode', 'EAN', 'Price')
+
+
+def _skeleton(fsrar_id):
+    documents = etree.Element(f"{{{NS_DOC}}}Documents", Version="1.0", nsmap=NSMAP)
+    owner = etree.SubElement(documents, f"{{{NS_DOC}}}Owner")
+    etree.SubElement(owner, f"{{{NS_DOC}}}FSRAR_ID").text = fsrar_id
+    document = etree.SubElement(documents, f"{{{NS_DOC}}}Document")
+    cheque = etree.SubElement(document, f"{{{NS_DOC}}}ChequeV3")
+    header = etree.SubElement(cheque, f"{{{NS_CHEQUE}}}Header")
+    for field in HEADER_FIELDS:
+        etree.SubElement(header, f"{{{NS_CHEQUE}}}{field}")
+    content = etree.SubElement(cheque, f"{{{NS_CHEQUE}}}Content")
+    bottle = etree.SubElement(content, f"{{{NS_CHEQUE}}}Bottle")
+    for field in BOTTLE_FIELDS:
+        etree.SubElement(bottle, f"{{{NS_CHEQUE}}}{field}")
+    # Строка Bottle - шаблон, в документ не входит
+    content.remove(bottle)
+    return documents, bottle
+
+
+class ChequeBuilder:
+    """
+    Построение XML чека ChequeV3 (WB_DOC_SINGLE_01) для УТМ ЕГАИС на lxml.
+
+    Постоянная часть документа (корень с пространствами имен, Owner с
+    FSRAR_ID, пустые Header и Content) строится один раз; для каждого чека
+    копируется готовый каркас, заполняются поля заголовка и добавляются
+    копии шаблона строки Bottle, результат сериализуется сразу в байты UTF-8.
+    """
+
+    def __init__(self, fsrar_id):
+        self.fsrar_id = fsrar_id
+        self._skeleton, self._bottle = _skeleton(fsrar_id)
+
+    def build(self, date, kassa, shift, number, cheque_type, bottles):
+        """
+        :param bottles: [(баркод, EAN, цена)] - строки
+        :return: XML чека (bytes)
+        """
+        documents = deepcopy(self._skeleton)
+        cheque = documents[1][0]
+        header, content = cheque[0], cheque[1]
+        for element, value in zip(header, (date, kassa, shift, number, cheque_type)):
+            element.text = value
+        for values in bottles:
+            bottle = deepcopy(self._bottle)
+            for element, value in zip(bottle, values):
+                element.text = value
+            content.append(bottle)
+        return etree.tostring(documents, encoding='UTF-8', xml_declaration=True)
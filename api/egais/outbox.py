@@ -0,0 +1,252 @@
+import asyncio
+from datetime import timedelta
+
+from loguru import logger
+from tortoise import timezone
+
+from api.models import EgaisOutbox
+from .breaker import CircuitOpenError
+
+# Статусы записи очереди
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+
+class OutboxDispatcher:
+    """
+    Отправка чеков в УТМ ЕГАИС через очередь в БД (таблица egais_outbox).
+
+    Чек сначала записывается в очередь, оплата не ждет УТМ. Для каждой кассы
+    работает отдельная задача: чеки кассы уходят в УТМ строго по порядку, при
+    ошибке первый чек повторяется с растущей паузой (retry_base * 2^n, не
+    больше retry_max), следующие ждут. После max_attempts неудачных попыток
+    чек получает статус failed и остается в очереди - его можно отправить
+    повторно (retry). Чек, отправка которого прервалась перезапуском,
+    отправляется снова. Пока УТМ недоступен (available() -> False), очередь
+    ждет без попыток отправки и без расхода попыток до вызова wake_all();
+    отказ автомата защиты (CircuitOpenError) во время отправки попыткой тоже
+    не считается.
+    Чек, отклоненный УТМ (rejected(error) -> True), сразу получает статус
+    failed без повторов. Отправленные чеки удаляются из очереди спустя
+    retention секунд (ответ УТМ остается в журнале egais_logs).
+    """
+
+    def __init__(self, send, on_sent=None, on_failed=None, retry_base=10, retry_max=600, max_attempts=50,
+                 available=None, rejected=None, retention=None, purge_interval=3600):
+        """
+        :param send: async send(xml_data) -> текст ответа УТМ
+        :param on_sent: async on_sent(entry, response_text) - чек принят УТМ
+        :param on_failed: async on_failed(entry) - попытки исчерпаны или чек отклонен
+        :param available: available() -> False, если УТМ заведомо недоступен
+        :param rejected: rejected(error) -> True, если УТМ отклонил сам документ
+        :param retention: сколько секунд хранить отправленные чеки (None - не удалять)
+        :param purge_interval: период удаления отправленных чеков, сек
+        """
+        self.send = send
+        self.available = available
+        self.rejected = rejected
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._purger = None
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self._workers = {}
+        self._wakeups = {}
+        self.running = False
+
+    async def start(self):
+        """Продолжить отправку чеков, оставшихся в очереди после перезапуска"""
+        self.running = True
+        interrupted = await EgaisOutbox.filter(status=SENDING).update(status=PENDING)
+        if interrupted:
+            logger.warning(f"Отправка {interrupted} чеков в ЕГАИС прервалась перезапуском, отправляем повторно")
+        registers = await EgaisOutbox.filter(status=PENDING).distinct().values_list('register', flat=True)
+        for register in registers:
+            self._ensure_worker(register)
+        if registers:
+            pending = await EgaisOutbox.filter(status=PENDING).count()
+            logger.info(f"В очереди ЕГАИС {pending} чеков, касс: {len(registers)}")
+        if self.retention:
+            self._purger = asyncio.create_task(self._purge_loop())
+
+    async def stop(self):
+        self.running = False
+        workers = [worker for worker in self._workers.values() if not worker.done()]
+        if self._purger is not None:
+            workers.append(self._purger)
+            self._purger = None
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._workers.clear()
+
+    def _ensure_worker(self, register):
+        if not self.running:
+            return
+        worker = self._workers.get(register)
+        if worker is None or worker.done():
+            self._workers[register] = asyncio.create_task(self._worker(register))
+        else:
+            self.wake(register)
+
+    def wake(self, register):
+        """Прервать паузу перед повтором"""
+        event = self._wakeups.get(register)
+        if event is not None:
+            event.set()
+
+    def wake_all(self):
+        """Прервать паузы всех касс (УТМ снова доступен)"""
+        for event in list(self._wakeups.values()):
+            event.set()
+
+    async def enqueue(self, register, xml_data, **fields):
+        """
+        Поставить чек в очередь кассы
+
+        :param fields: поля EgaisOutbox (legacynum, order_data, xml_file, device_id, print_qr...)
+        :return: запись очереди
+        """
+        entry = await EgaisOutbox.create(register=register, xml_data=xml_data, status=PENDING, **fields)
+        self._ensure_worker(register)
+        return entry
+
+    async def retry(self, ids=None):
+        """Вернуть в очередь чеки со статусом failed (все или указанные)"""
+        query = EgaisOutbox.filter(status=FAILED)
+        if ids:
+            query = query.filter(id__in=ids)
+        registers = await query.distinct().values_list('register', flat=True)
+        count = await query.update(status=PENDING, attempts=0, next_attempt_at=None)
+        for register in registers:
+            self._ensure_worker(register)
+        return count
+
+    async def _sleep(self, register, delay):
+        event = self._wakeups[register] = asyncio.Event()
+        try:
+            await asyncio.wait_for(event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._wakeups.pop(register, None)
+
+    async def _worker(self, register):
+        while True:
+            try:
+                entry = await EgaisOutbox.filter(register=register, status=PENDING).order_by('id').first()
+                if entry is None:
+                    return
+                if entry.next_attempt_at is not None:
+                    delay = (entry.next_attempt_at - timezone.now()).total_seconds()
+                    if delay > 0:
+                        await self._sleep(register, delay)
+                        continue
+                if self.available is not None and not self.available():
+                    await self._sleep(register, self.retry_max)
+                    continue
+                await self._deliver(entry)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Ошибка БД: очередь не теряется, повторяем позже
+                logger.error(f"Ошибка очереди ЕГАИС кассы {register}: {e}")
+                await self._sleep(register, self.retry_base)
+
+    async def _deliver(self, entry):
+        entry.status = SENDING
+        await entry.save(update_fields=['status', 'updated_at'])
+        try:
+            response_text = await self.send(entry.xml_data)
+        except CircuitOpenError as e:
+            # Запрос в УТМ не выполнялся: чек ждет замыкания автомата, попытка не расходуется
+            entry.status = PENDING
+            entry.last_error = str(e) or type(e).__name__
+            await entry.save(update_fields=['status', 'last_error', 'updated_at'])
+            logger.warning(f"Чек {entry.legacynum} ждет доступности УТМ: {entry.last_error}")
+            return
+        except Exception as e:
+            entry.attempts += 1
+            entry.last_error = str(e) or type(e).__name__
+            if self.rejected is not None and self.rejected(e):
+                entry.status = FAILED
+                entry.next_attempt_at = None
+                logger.error(f"УТМ отклонил чек {entry.legacynum}, повторов не будет: {entry.last_error}")
+            elif entry.attempts >= self.max_attempts:
+                entry.status = FAILED
+                entry.next_attempt_at = None
+                logger.error(f"Чек {entry.legacynum} не отправлен в ЕГАИС за {entry.attempts} попыток: {entry.last_error}")
+            else:
+                entry.status = PENDING
+                delay = min(self.retry_max, self.retry_base * 2 ** (entry.attempts - 1))
+                entry.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+                logger.warning(f"УТМ не принял чек {entry.legacynum} (попытка {entry.attempts}): {entry.last_error}, повтор через {delay} с")
+            await entry.save(update_fields=['status', 'attempts', 'last_error', 'next_attempt_at', 'updated_at'])
+            if entry.status == FAILED and self.on_failed:
+                await self._callback(self.on_failed, entry)
+            return
+        entry.status = SENT
+        entry.response_data = response_text
+        entry.last_error = None
+        entry.sent_at = timezone.now()
+        await entry.save(update_fields=['status', 'response_data', 'last_error', 'sent_at', 'updated_at'])
+        if self.on_sent:
+            await self._callback(self.on_sent, entry, response_text)
+
+    async def purge(self):
+        """
+        Удалить отправленные чеки старше retention секунд
+
+        Записи повторной отправки (egais_log_id) остаются - по ним replay
+        не ставит одну и ту же запись журнала второй раз
+        """
+        threshold = timezone.now() - timedelta(seconds=self.retention)
+        deleted = await EgaisOutbox.filter(
+            status=SENT, sent_at__lt=threshold, egais_log_id__isnull=True
+        ).delete()
+        if deleted:
+            logger.info(f"Из очереди ЕГАИС удалено {deleted} отправленных чеков")
+        return deleted
+
+    async def _purge_loop(self):
+        while True:
+            try:
+                await self.purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка очистки очереди ЕГАИС: {e}")
+            await asyncio.sleep(self.purge_interval)
+
+    @staticmethod
+    def age(entry):
+        """Сколько секунд чек провел в очереди"""
+        return (timezone.now() - entry.created_at).total_seconds()
+
+    @staticmethod
+    async def _callback(callback, *args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            logger.error(f"Ошибка обработки результата отправки в ЕГАИС: {e}")
+
+    async def status(self):
+        """Число чеков по статусам и кассам, возраст самого старого неотправленного чека"""
+        rows = await EgaisOutbox.exclude(status=SENT).values('register', 'status', 'created_at', 'attempts', 'last_error')
+        now = timezone.now()
+        registers = {}
+        for row in rows:
+            data = registers.setdefault(row['register'], {'register': row['register'], PENDING: 0, SENDING: 0, FAILED: 0,
+                                                          'oldest_age': None, 'last_error': None})
+            data[row['status']] = data.get(row['status'], 0) + 1
+            if row['status'] != FAILED:
+                age = round((now - row['created_at']).total_seconds(), 1)
+                if data['oldest_age'] is None or age > data['oldest_age']:
+                    data['oldest_age'] = age
+                    data['last_error'] = row['last_error']
+        return list(registers.values())
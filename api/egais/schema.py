@@ -0,0 +1,105 @@
+import re
+
+from lxml import etree
+
+INN_RE = re.compile(r'\d{10}|\d{12}')
+KPP_RE = re.compile(r'\d{9}')
+PRICE_RE = re.compile(r'-?\d+\.\d{0,2}')
+# Акцизная марка: PDF417 (68 символов) или DataMatrix (150 символов), как PDF417String в EGCommon.xsd
+BARCODE_RE = re.compile(r'\d\d[a-zA-Z0-9]{21}\d[0-1]\d[0-3]\d{10}[a-zA-Z0-9]{31}|[a-zA-Z0-9]{150}')
+EAN_RE = re.compile(r'\d{8}|\d{12}|\d{13}|\d{14}')
+VOLUME_RE = re.compile(r'\d+\.?\d{0,4}')
+
+
+def validate_egais_fields(inn, kpp, kassa, address, name, number, shift):
+    """
+    Валидация полей согласно XSD схеме ПРИЛОЖЕНИЕ Б
+    """
+    # Валидация ИНН (10 или 12 цифр)
+    if not INN_RE.fullmatch(str(inn)):
+        raise ValueError(f"ИНН должен содержать 10 или 12 цифр: {inn}")
+
+    # Валидация КПП (9 цифр или пустая строка)
+    if kpp and not KPP_RE.fullmatch(str(kpp)):
+        raise ValueError(f"КПП должен содержать 9 цифр: {kpp}")
+
+    # Валидация адреса (максимум 128 символов)
+    if len(str(address)) > 128:
+        raise ValueError(f"Адрес не должен превышать 128 символов: {len(str(address))}")
+
+    # Валидация названия (максимум 128 символов)
+    if len(str(name)) > 128:
+        raise ValueError(f"Название не должно превышать 128 символов: {len(str(name))}")
+
+    return True
+
+
+def validate_bottle_fields(price, barcode, ean=None, volume=None):
+    """
+    Валидация полей элемента Bottle согласно XSD схеме
+    """
+    # Валидация цены (формат: [-]?\d+\.\d{0,2})
+    if not PRICE_RE.fullmatch(str(price)):
+        raise ValueError(f"Цена должна быть в формате [-]?\\d+\\.\\d{{0,2}}: {price}")
+
+    # Валидация баркода (PDF417 или DataMatrix)
+    if not BARCODE_RE.fullmatch(str(barcode)):
+        raise ValueError(f"Баркод не соответствует формату: {barcode}")
+
+    # Валидация EAN (8, 12, 13 или 14 цифр)
+    if ean and not EAN_RE.fullmatch(str(ean)):
+        raise ValueError(f"EAN должен содержать 8, 12, 13 или 14 цифр: {ean}")
+
+    # Валидация объема (формат: \d+\.?\d{0,4})
+    if volume and not VOLUME_RE.fullmatch(str(volume)):
+        raise ValueError(f"Объем должен быть в формате \\d+\\.?\\d{{0,4}}: {volume}")
+
+    return True
+
+
+class ChequeValidationError(ValueError):
+    """Чек не соответствует XSD-схеме"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("XML чека не соответствует схеме: " + "; ".join(errors[:5]))
+
+
+class ChequeValidator:
+    """
+    Проверка XML чека по XSD-схеме перед отправкой в УТМ.
+
+    Схема (scheme/ChequeV3Documents.xsd с импортами ChequeV3.xsd, EGCommon.xsd,
+    ProductRef_v2.xsd) компилируется один раз при создании. Чек с ошибкой
+    отклоняется сразу, без запроса к УТМ и без повторов в очереди.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.schema = etree.XMLSchema(etree.parse(path))
+        # Внешние сущности и сетевые ссылки во входящих документах не разрешаются
+        self.parser = etree.XMLParser(resolve_entities=False, no_network=True)
+        self.counters = {'valid': 0, 'invalid': 0}
+
+    def pull_parser(self):
+        """Парсер для проверки по частям (XMLPullParser со схемой)"""
+        return etree.XMLPullParser(events=('start', 'end'), schema=self.schema,
+                                   resolve_entities=False, no_network=True)
+
+    def validate(self, xml_data):
+        """
+        :param xml_data: XML чека (bytes или str)
+        :raises ChequeValidationError: XML не разобран или не соответствует схеме
+        """
+        if isinstance(xml_data, str):
+            xml_data = xml_data.encode('utf-8')
+        try:
+            document = etree.fromstring(xml_data, self.parser)
+        except etree.XMLSyntaxError as e:
+            self.counters['invalid'] += 1
+            raise ChequeValidationError([f"XML не разобран: {e}"])
+        if not self.schema.validate(document):
+            self.counters['invalid'] += 1
+            raise ChequeValidationError([f"строка {error.line}: {error.message}" for error in self.schema.error_log])
+        self.counters['valid'] += 1
+        return True
@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import os
+import time
+
+from lxml import etree
+
+from .schema import ChequeValidationError
+
+
+class UploadTooLarge(ValueError):
+    """Загружаемый файл больше допустимого размера"""
+
+
+class XmlStreamChecker:
+    """
+    Разбор XML по частям по мере загрузки: проверка корректности (и схемы,
+    если задан validator) без построения всего дерева в памяти - разобранные
+    элементы сразу очищаются.
+    """
+
+    def __init__(self, validator=None):
+        if validator is not None:
+            self.parser = validator.pull_parser()
+        else:
+            self.parser = etree.XMLPullParser(events=('start', 'end'), resolve_entities=False, no_network=True)
+        self.validator = validator
+        self.depth = 0
+        self.closed = False  # Корневой элемент закрыт
+
+    def feed(self, chunk):
+        try:
+            self.parser.feed(chunk)
+        except etree.XMLSyntaxError as e:
+            self._fail(e)
+        self._drain()
+
+    def close(self):
+        try:
+            self.parser.close()
+        except etree.XMLSyntaxError as e:
+            self._fail(e)
+        self._drain()
+        # Парсер со схемой не сообщает об оборванном документе - проверяем, что корень закрыт
+        if not self.closed:
+            self._fail("документ оборван: корневой элемент не закрыт")
+        if self.validator is not None:
+            self.validator.counters['valid'] += 1
+
+    def _drain(self):
+        for event, element in self.parser.read_events():
+            if event == 'start':
+                self.depth += 1
+                continue
+            self.depth -= 1
+            if self.depth == 0:
+                self.closed = True
+            element.clear()
+            # Уже разобранные соседние элементы тоже не держим в памяти
+            parent = element.getparent()
+            while parent is not None and element.getprevious() is not None:
+                del parent[0]
+
+    def _fail(self, error):
+        if self.validator is not None:
+            self.validator.counters['invalid'] += 1
+        raise ChequeValidationError([str(error)])
+
+
+async def receive_xml_upload(upload, directory, prefix, max_size, validator=None, chunk_size=64 * 1024):
+    """
+    Сохранить загруженный XML на диск по частям
+
+    Файл читается кусками по chunk_size: каждый кусок пишется на диск,
+    добавляется к хешу SHA-256 и разбирается XmlStreamChecker. Весь файл в
+    памяти не собирается. Недописанный или отклоненный файл удаляется.
+
+    :param upload: UploadFile
+    :param prefix: начало имени файла (к нему добавляются время и начало хеша)
+    :param max_size: максимальный размер, байт
+    :param validator: ChequeValidator - проверка по схеме (None - только корректность XML)
+    :return: {'path', 'size', 'sha256'}
+    :raises UploadTooLarge: файл больше max_size
+    :raises ChequeValidationError: XML не разобран или не соответствует схеме
+    """
+    # Размер, известный заранее, проверяем до чтения
+    declared = getattr(upload, 'size', None)
+    if declared is not None and declared > max_size:
+        raise UploadTooLarge(f"Файл больше {max_size} байт: {declared}")
+    os.makedirs(directory, exist_ok=True)
+    partial = os.path.join(directory, f"{prefix}_{time.time_ns()}.part")
+    digest = hashlib.sha256()
+    checker = XmlStreamChecker(validator)
+    size = 0
+    try:
+        with open(partial, "wb") as f:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(f"Файл больше {max_size} байт")
+                digest.update(chunk)
+                checker.feed(chunk)
+                await asyncio.to_thread(f.write, chunk)
+            checker.close()
+        sha256 = digest.hexdigest()
+        path = os.path.join(directory, f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}_{sha256[:8]}.xml")
+        os.replace(partial, path)
+    except BaseException:
+        try:
+            os.remove(partial)
+        except FileNotFoundError:
+            pass
+        raise
+    return {'path': path, 'size': size, 'sha256': sha256}
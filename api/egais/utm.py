@@ -0,0 +1,137 @@
+import asyncio
+import xml.etree.ElementTree as ET
+
+import httpx
+from loguru import logger
+
+
+def parse_utm_response(text):
+    """
+    Ответ УТМ на чек (квитанция типа A) -> (url для QR-кода, подпись)
+
+    :return: (url, sign); None - элемента нет или ответ не XML
+    """
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError:
+        return None, None
+    url = root.find('url')
+    sign = root.find('sign')
+    return (url.text if url is not None else None), (sign.text if sign is not None else None)
+
+
+def is_rejection(error):
+    """УТМ доступен, но отклонил документ (HTTP 4xx) - повтор того же документа не поможет"""
+    return isinstance(error, httpx.HTTPStatusError) and 400 <= error.response.status_code < 500
+
+
+class UtmClient:
+    """
+    Асинхронный клиент УТМ ЕГАИС.
+
+    Одно постоянное подключение (пул httpx) на весь сервис: запросы не
+    открывают новое TCP-подключение и не блокируют цикл событий, пока УТМ
+    обрабатывает чек. Таймауты подключения и чтения раздельные: недоступный
+    УТМ обнаруживается за connect_timeout, а медленный (2-5 с на чек) успевает
+    ответить за read_timeout. Одновременных запросов к УТМ не больше
+    max_concurrency, остальные ждут очереди, не нагружая слабую машину УТМ.
+    Если задан автомат защиты (CircuitBreaker), ошибки подключения и ответы
+    5xx засчитываются ему, а при разомкнутом автомате запрос отклоняется без
+    обращения к сети.
+    """
+
+    def __init__(self, host, connect_timeout=3, read_timeout=15, max_concurrency=2, max_connections=4,
+                 breaker=None, health_path="/"):
+        """
+        :param host: адрес УТМ (http://host:8080)
+        :param connect_timeout: таймаут подключения, сек
+        :param read_timeout: таймаут ответа УТМ, сек
+        :param max_concurrency: одновременных запросов к УТМ
+        :param max_connections: подключений в пуле
+        :param breaker: автомат защиты (CircuitBreaker) или None
+        :param health_path: адрес дешевой проверки доступности УТМ (GET)
+        """
+        self.host = host.rstrip('/')
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.max_concurrency = max_concurrency
+        self.active = 0  # Запросов в работе у УТМ
+        self.waiting = 0  # Запросов в ожидании очереди
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+        self.breaker = breaker
+        self.health_path = health_path
+
+    @property
+    def client(self):
+        # Клиент создается при первом запросе - в цикле событий сервиса
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.host, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def status(self):
+        return {
+            'host': self.host,
+            'max_concurrency': self.max_concurrency,
+            'active': self.active,
+            'waiting': self.waiting
+        }
+
+    async def send_xml(self, xml_data, doc_type='ChequeV3', filename='Cheque.xml'):
+        """
+        Отправить документ в УТМ (POST /xml, multipart xml_file)
+
+        :return: текст ответа УТМ
+        :raises httpx.HTTPError: УТМ недоступен, таймаут или HTTP-ошибка
+        :raises CircuitOpenError: автомат защиты разомкнут, запрос не отправлялся
+        """
+        if self.breaker is not None:
+            self.breaker.check()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            # Пока запрос ждал очереди, автомат мог разомкнуться
+            if self.breaker is not None:
+                self.breaker.check()
+            response = await self.client.post(
+                "/xml",
+                files={'xml_file': (filename, xml_data, 'application/xml')},
+                params={'type': doc_type}
+            )
+        except httpx.TransportError as e:
+            if self.breaker is not None:
+                self.breaker.record_failure(e)
+            raise
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+        if self.breaker is not None:
+            # 4xx - УТМ доступен, но отклонил документ; автомат считает только отказы УТМ
+            if response.status_code >= 500:
+                self.breaker.record_failure(f"HTTP {response.status_code}")
+            else:
+                self.breaker.record_success()
+        response.raise_for_status()
+        logger.debug(f"Ответ УТМ на {doc_type}: {response.status_code}, {response.elapsed.total_seconds():.2f} с")
+        return response.text
+
+    async def probe(self):
+        """
+        Дешевая проверка доступности УТМ: GET health_path с таймаутом подключения,
+        без очереди запросов и без разбора ответа
+
+        :raises httpx.HTTPError: УТМ недоступен или ответил 5xx
+        """
+        timeout = httpx.Timeout(self.timeout.connect, connect=self.timeout.connect)
+        response = await self.client.get(self.health_path, timeout=timeout)
+        if response.status_code >= 500:
+            response.raise_for_status()
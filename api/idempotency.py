@@ -0,0 +1,94 @@
+import asyncio
+from collections import OrderedDict
+
+from loguru import logger
+
+
+class IdempotencyRegistry:
+    """
+    Защита от повторного выполнения операции с тем же ключом (номер заказа
+    или заголовок Idempotency-Key).
+
+    Повтор, пришедший во время выполнения, ждет результата первой попытки.
+    Повтор после успешного завершения получает исходный результат без
+    обращения к ККТ. Результаты хранятся в памяти (последние max_entries) и
+    во внешнем хранилище (load/save), чтобы пережить перезапуск сервиса.
+    Неуспешный результат не запоминается - операцию можно повторить.
+    """
+
+    def __init__(self, max_entries=1000, load=None, save=None):
+        """
+        :param max_entries: сколько последних результатов хранить в памяти
+        :param load: async load(key) -> результат или None (хранилище, например БД)
+        :param save: async save(key, result) - сохранить успешный результат
+        """
+        self.max_entries = max_entries
+        self.load = load
+        self.save = save
+        self._results = OrderedDict()
+        self._in_flight = {}
+
+    @staticmethod
+    def is_success(result):
+        return isinstance(result, dict) and result.get("status") == "success"
+
+    def _remember(self, key, result):
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    async def record(self, key, result):
+        """Запомнить результат операции, выполненной в обход run (например, при восстановлении)"""
+        self._remember(key, result)
+        if self.save:
+            await self.save(key, result)
+
+    async def run(self, key, operation):
+        """
+        Выполнить operation() не более одного раза для ключа
+
+        :param operation: функция без аргументов -> корутина с результатом (dict)
+        :return: (результат, True если это повтор)
+        """
+        task = self._in_flight.get(key)
+        if task is not None:
+            logger.info(f"Повтор операции {key} во время выполнения - ждем результат первой попытки")
+            return await asyncio.shield(task), True
+
+        result = self._results.get(key)
+        if result is None and self.load:
+            try:
+                result = await self.load(key)
+            except Exception as e:
+                logger.warning(f"Ошибка чтения ключа идемпотентности {key}: {e}")
+            if result is not None:
+                self._remember(key, result)
+        if result is not None:
+            self._results.move_to_end(key)
+            logger.info(f"Повтор завершенной операции {key} - возвращаем исходный результат")
+            return result, True
+
+        # Повтор мог прийти, пока читали хранилище
+        task = self._in_flight.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+
+        # Операция выполняется отдельной задачей: отключение клиента не прерывает ее
+        task = asyncio.create_task(self._execute(key, operation))
+        self._in_flight[key] = task
+        return await asyncio.shield(task), False
+
+    async def _execute(self, key, operation):
+        try:
+            result = await operation()
+            if self.is_success(result):
+                self._remember(key, result)
+                if self.save:
+                    try:
+                        await self.save(key, result)
+                    except Exception as e:
+                        logger.warning(f"Ошибка сохранения ключа идемпотентности {key}: {e}")
+            return result
+        finally:
+            self._in_flight.pop(key, None)
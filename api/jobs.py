@@ -0,0 +1,92 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from loguru import logger
+
+
+class JobRegistry:
+    """
+    Фоновые задания (отчеты ККТ): запрос сразу получает идентификатор задания,
+    статус запрашивается отдельно или ожидается long-poll запросом.
+
+    Статусы: queued - ждет очереди ККТ, running - выполняется, done - выполнено,
+    error - ошибка (исключение или результат {"status": "error", ...}).
+    Хранятся последние max_jobs заданий.
+    """
+
+    def __init__(self, max_jobs=100):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._events = {}
+        self._tasks = set()
+
+    def submit(self, kind, operation, **meta):
+        """
+        Запустить задание
+
+        :param operation: функция operation(job) -> корутина с результатом (dict)
+        :return: dict задания
+        """
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'status': 'queued',
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None,
+            **meta
+        }
+        self._jobs[job['id']] = job
+        self._events[job['id']] = asyncio.Event()
+        while len(self._jobs) > self.max_jobs:
+            old_id, old_job = next(iter(self._jobs.items()))
+            if old_job['status'] in ('queued', 'running'):
+                break
+            del self._jobs[old_id]
+            self._events.pop(old_id, None)
+        task = asyncio.create_task(self._run(job, operation))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    @staticmethod
+    def started(job):
+        """Задание начало выполняться (можно вызывать из потока ККТ)"""
+        job['started_at'] = datetime.now().isoformat()
+        job['status'] = 'running'
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    async def wait(self, job_id, timeout):
+        """Дождаться завершения задания не дольше timeout секунд (long-poll)"""
+        event = self._events.get(job_id)
+        if event is not None and timeout > 0:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._jobs.get(job_id)
+
+    async def _run(self, job, operation):
+        try:
+            result = await operation(job)
+            job['result'] = result
+            if isinstance(result, dict) and result.get('status') == 'error':
+                job['status'] = 'error'
+                job['error'] = result.get('error')
+            else:
+                job['status'] = 'done'
+        except Exception as e:
+            logger.error(f"Ошибка задания {job['kind']} {job['id']}: {e}")
+            job['status'] = 'error'
+            job['error'] = str(e)
+        finally:
+            job['finished_at'] = datetime.now().isoformat()
+            event = self._events.get(job['id'])
+            if event is not None:
+                event.set()
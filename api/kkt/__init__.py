@@ -0,0 +1,42 @@
+from .worker import (
+    KktWorker,
+    KktQueueFull,
+    KktTimeout,
+    PRIORITY_PAYMENT,
+    PRIORITY_PRINT,
+    PRIORITY_REPORT,
+    PRIORITY_IDLE
+)
+from .driver import FiscalDriver, WIN32_AVAILABLE, make_driver_factory
+from .simulator import ShtrihSimulator
+from .pool import KktPool, KktDevice, KktDeviceNotFound
+from .status import KktStatusPoller
+from .state import KktState
+from .metrics import DriverMetrics, InstrumentedDriver, begin_trace, end_trace
+from .journal import FiscalJournal, reconcile, receipt_fiscalized
+
+__all__ = [
+    'KktWorker',
+    'KktQueueFull',
+    'KktTimeout',
+    'PRIORITY_PAYMENT',
+    'PRIORITY_PRINT',
+    'PRIORITY_REPORT',
+    'PRIORITY_IDLE',
+    'FiscalDriver',
+    'WIN32_AVAILABLE',
+    'make_driver_factory',
+    'ShtrihSimulator',
+    'KktPool',
+    'KktDevice',
+    'KktDeviceNotFound',
+    'KktStatusPoller',
+    'KktState',
+    'DriverMetrics',
+    'InstrumentedDriver',
+    'begin_trace',
+    'end_trace',
+    'FiscalJournal',
+    'reconcile',
+    'receipt_fiscalized'
+]
@@ -0,0 +1,88 @@
+import os
+from typing import Protocol
+
+from loguru import logger
+
+try:
+    import win32com.client
+    WIN32_AVAILABLE = True
+except ImportError:
+    WIN32_AVAILABLE = False
+    logger.warning("win32com недоступен - доступен только симулятор ККТ (KKT_DRIVER=simulator)")
+
+
+class FiscalDriver(Protocol):
+    """
+    Интерфейс драйвера ККТ в стиле DRvFR: входные и выходные параметры
+    передаются через свойства, команды - методы без аргументов,
+    результат команды - в ResultCode/ResultCodeDescription.
+    """
+
+    Password: int
+    ResultCode: int
+    ResultCodeDescription: str
+    ECRMode: int
+    ECRModeDescription: str
+    ECRAdvancedMode: int
+    DocumentNumber: int
+    SessionNumber: int
+    FiscalSign: str
+
+    def Connect(self) -> int: ...
+    def Disconnect(self) -> int: ...
+    def GetECRStatus(self) -> int: ...
+    def ContinuePrint(self) -> int: ...
+    def SysAdminCancelCheck(self) -> int: ...
+    def FNOperation(self) -> int: ...
+    def FNSendItemBarcode(self) -> int: ...
+    def FNCheckItemBarcode(self) -> int: ...
+    def FNAcceptMarkingCode(self) -> int: ...
+    def FNSendTag(self) -> int: ...
+    def FNSendTagOperation(self) -> int: ...
+    def FNCloseCheckEx(self) -> int: ...
+    def FNGetCurrentSessionParams(self) -> int: ...
+    def FNGetStatus(self) -> int: ...
+    def FNGetFiscalizationResult(self) -> int: ...
+    def FNGetExpirationTime(self) -> int: ...
+    def FNGetSerial(self) -> int: ...
+    def FNBeginCloseSession(self) -> int: ...
+    def FNCloseSession(self) -> int: ...
+    def ReadSerialNumber(self) -> int: ...
+    def PrintString(self) -> int: ...
+    def PrintWideString(self) -> int: ...
+    def FeedDocument(self) -> int: ...
+    def CutCheck(self) -> int: ...
+    def LoadAndPrint2DBarcode(self) -> int: ...
+    def PrintReportWithoutCleaning(self) -> int: ...
+    def WaitForPrinting(self) -> int: ...
+
+
+def make_driver_factory(kind=None, ld_number=None):
+    """
+    Фабрика драйвера ККТ по KKT_DRIVER: com (DRvFR, по умолчанию) или simulator
+
+    :param ld_number: номер логического устройства DRvFR (для нескольких ККТ)
+    :return: функция без аргументов, возвращающая объект драйвера
+    """
+    kind = (kind or os.getenv('KKT_DRIVER', 'com')).lower()
+    if kind == 'simulator':
+        from .simulator import ShtrihSimulator
+        # Состояние симулятора (смена, номера документов) переживает переподключения
+        simulator = ShtrihSimulator.from_env()
+        if ld_number is not None:
+            simulator.KKTSerialNumber = f"SIM{ld_number:011d}"
+            simulator.FNSerialNumber = f"99990789{ld_number:08d}"
+        logger.warning("Используется симулятор ККТ - фискальные документы не формируются")
+        return lambda: simulator
+    if kind == 'com':
+        def factory():
+            if not WIN32_AVAILABLE:
+                raise RuntimeError("win32com недоступен, для работы без ККТ укажите KKT_DRIVER=simulator")
+            fr = win32com.client.Dispatch('Addin.DRvFR')
+            if ld_number is not None:
+                # Параметры подключения берутся из логического устройства драйвера
+                fr.LDNumber = ld_number
+                fr.SetActiveLD()
+            return fr
+        return factory
+    raise ValueError(f"Неизвестный драйвер ККТ: {kind}")
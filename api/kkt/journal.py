@@ -0,0 +1,214 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from loguru import logger
+
+from .state import MODE_SESSION_CLOSED
+
+MODE_DOCUMENT_OPEN = 8
+
+# События, после которых операция считается завершенной
+TERMINAL_EVENTS = ('closed', 'resolved')
+
+
+def receipt_fiscalized(before, after, mode_before=None):
+    """
+    Был ли пробит чек по номерам документов ККТ до и после операции
+
+    :param mode_before: режим ККТ до чека (в закрытой смене чек добавляет
+        еще и документ открытия смены)
+    :return: True/False, None - номера неизвестны
+    """
+    if before is None or after is None:
+        return None
+    return after >= before + (2 if mode_before == MODE_SESSION_CLOSED else 1)
+
+
+class FiscalJournal:
+    """
+    Журнал упреждающей записи фискальных операций (JSON Lines, только дозапись).
+
+    Для каждого чека записываются намерение (заказ, номер последнего документа
+    ККТ до чека), отправленные позиции с суммой оплаты и результат закрытия.
+    Каждая запись сбрасывается на диск (fsync) до следующей команды ККТ, поэтому
+    после падения процесса по журналу видно, на каком шаге прервался чек.
+    Незавершенные операции разбираются при запуске (reconcile).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.last_recovery = []
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _append(self, record):
+        record['ts'] = time.time()
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def begin(self, device_id, order_num, type_pay, order_data, document_before, mode_before=None):
+        """
+        Намерение пробить чек
+
+        :param document_before: номер последнего фискального документа ККТ до чека
+        :param mode_before: режим ККТ до чека (в закрытой смене чек добавляет
+            еще и документ открытия смены)
+        :return: идентификатор операции
+        """
+        op_id = uuid.uuid4().hex
+        self._append({
+            'op': op_id,
+            'event': 'begin',
+            'device': device_id,
+            'order': order_num,
+            'type_pay': type_pay,
+            'document_before': document_before,
+            'mode_before': mode_before,
+            'order_data': order_data
+        })
+        return op_id
+
+    def items(self, op_id, count, summ, type_pay):
+        """Все позиции переданы в ККТ, осталось закрыть чек на сумму summ"""
+        self._append({'op': op_id, 'event': 'items', 'count': count, 'summ': summ, 'type_pay': type_pay})
+
+    def closed(self, op_id, result_code, document_number=None, fiscal_sign=None):
+        """Результат FNCloseCheckEx"""
+        self._append({
+            'op': op_id,
+            'event': 'closed',
+            'result_code': result_code,
+            'document_number': document_number,
+            'fiscal_sign': fiscal_sign
+        })
+
+    def resolve(self, op_id, outcome, **details):
+        """Незавершенная операция разобрана: completed, fiscalized, cancelled, not_printed, unknown"""
+        self._append({'op': op_id, 'event': 'resolved', 'outcome': outcome, **details})
+
+    def pending(self, device_id=None):
+        """
+        Незавершенные операции (в порядке начала), при device_id - только этой ККТ
+
+        В document_after операции - номер последнего документа ККТ перед
+        следующей операцией той же ККТ (в том числе завершенной); ключа нет,
+        если операция на ККТ последняя.
+        """
+        operations = {}
+        last_op = {}
+        with self._lock:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.readlines()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Недописанная последняя строка при падении процесса
+                logger.warning(f"Пропущена поврежденная запись журнала ККТ: {line[:100]!r}")
+                continue
+            op_id = record.get('op')
+            if record.get('event') == 'begin':
+                previous = last_op.get(record.get('device'))
+                # После compact номер уже записан в операции - следующая в файле может быть не следующей на ККТ
+                if previous is not None and 'document_after' not in previous:
+                    previous['document_after'] = record.get('document_before')
+                operations[op_id] = dict(record)
+                last_op[record.get('device')] = operations[op_id]
+            elif op_id in operations:
+                if record.get('event') in TERMINAL_EVENTS:
+                    del operations[op_id]
+                else:
+                    operations[op_id][record['event']] = record
+        result = list(operations.values())
+        if device_id is not None:
+            result = [op for op in result if op.get('device') == device_id]
+        return result
+
+    def resolve_open(self, device_id, outcome, **details):
+        """Разобрать все незавершенные операции ККТ (например, после SysAdminCancelCheck)"""
+        operations = self.pending(device_id)
+        for op in operations:
+            self.resolve(op['op'], outcome, **details)
+        return operations
+
+    def compact(self):
+        """Переписать журнал, оставив только незавершенные операции"""
+        operations = self.pending()
+        tmp_path = self.path + ".tmp"
+        with self._lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for op in operations:
+                    begin = {k: v for k, v in op.items() if k != 'items'}
+                    f.write(json.dumps(begin, ensure_ascii=False, default=str) + "\n")
+                    if 'items' in op:
+                        f.write(json.dumps(op['items'], ensure_ascii=False, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+
+def reconcile(fr, operations):
+    """
+    Сверить незавершенные операции ККТ с номером последнего документа
+    (выполняется в потоке ККТ при запуске)
+
+    Открытый документ последней операции закрывается, если все позиции были
+    переданы (сумма оплаты известна), иначе аннулируется. Для остальных
+    операций номер документа ККТ показывает, был ли чек пробит до падения.
+
+    :param operations: незавершенные операции этой ККТ из FiscalJournal.pending()
+        (номер следующего документа берется из document_after - он учитывает
+        и завершенные операции)
+    :return: список {"op", "order", "outcome", ...}
+    """
+    fr.GetECRStatus()
+    if fr.ResultCode != 0:
+        raise ConnectionError(f"Ошибка получения режима ККТ: {fr.ResultCode}, {fr.ResultCodeDescription}")
+    mode = fr.ECRMode
+    last_document = fr.DocumentNumber
+    results = []
+    for op in operations:
+        result = {'op': op['op'], 'order': op.get('order'), 'device': op.get('device')}
+        # Открытым может остаться только документ последней начатой на ККТ операции
+        is_last = 'document_after' not in op
+        before = op.get('document_before')
+        # Следующий документ после этой операции - начало следующей операции или текущий номер ККТ
+        after = last_document if is_last else op['document_after']
+        fiscalized = receipt_fiscalized(before, after, op.get('mode_before'))
+
+        if is_last and mode == MODE_DOCUMENT_OPEN:
+            items = op.get('items')
+            if items:
+                if items['type_pay'] == "card":
+                    fr.Summ2 = items['summ']
+                else:
+                    fr.Summ1 = items['summ']
+                fr.FNCloseCheckEx()
+                if fr.ResultCode == 0:
+                    result.update(outcome='completed', document_number=fr.DocumentNumber, fiscal_sign=fr.FiscalSign)
+                else:
+                    result['error'] = f"{fr.ResultCode}, {fr.ResultCodeDescription}"
+            if 'outcome' not in result:
+                fr.Password = 30
+                fr.SysAdminCancelCheck()
+                result.update(outcome='cancelled', result_code=fr.ResultCode)
+        elif fiscalized is None:
+            result['outcome'] = 'unknown'
+        elif fiscalized:
+            result.update(outcome='fiscalized', document_number=after if is_last else None)
+        else:
+            result['outcome'] = 'not_printed'
+        logger.warning(f"Восстановление операции ККТ: заказ {result['order']} - {result['outcome']}")
+        results.append(result)
+    return results
@@ -0,0 +1,174 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Границы корзин гистограммы задержек, мс
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Свойства, которые читаются только для отладочного лога: каждое чтение -
+# лишний вызов через COM, если уровень DEBUG выключен
+DEBUG_PROPERTIES = frozenset({'MarkingType', 'MarkingTypeEx', 'CheckItemLocalResult'})
+
+
+class _Stat:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect_left(LATENCY_BUCKETS, ms)] += 1
+
+    def as_dict(self):
+        histogram = {f"le_{bound}": n for bound, n in zip(LATENCY_BUCKETS, self.buckets)}
+        histogram['inf'] = self.buckets[-1]
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'avg_ms': round(self.total / self.count, 3) if self.count else 0,
+            'max_ms': round(self.max, 3),
+            'histogram': histogram
+        }
+
+
+class DriverMetrics:
+    """
+    Счетчики и гистограммы задержек вызовов драйвера ККТ.
+
+    Ключ - "call:Метод", "get:Свойство" или "set:Свойство". Заполняется из
+    потока ККТ, читается из API - поэтому под блокировкой.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.debug_reads = 0
+        self.started_at = time.time()
+
+    def record(self, key, ms):
+        with self._lock:
+            stat = self._stats.get(key)
+            if stat is None:
+                stat = self._stats[key] = _Stat()
+            stat.add(ms)
+
+    def record_debug_read(self):
+        with self._lock:
+            self.debug_reads += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.debug_reads = 0
+            self.started_at = time.time()
+
+    def as_dict(self):
+        with self._lock:
+            stats = {key: stat.as_dict() for key, stat in self._stats.items()}
+            debug_reads = self.debug_reads
+        return {
+            'since': self.started_at,
+            'calls': sum(s['count'] for s in stats.values()),
+            'total_ms': round(sum(s['total_ms'] for s in stats.values()), 3),
+            'debug_reads': debug_reads,
+            'stats': dict(sorted(stats.items(), key=lambda kv: kv[1]['total_ms'], reverse=True))
+        }
+
+
+class InstrumentedDriver:
+    """
+    Обертка драйвера ККТ: замеряет каждый вызов метода, чтение и запись свойства.
+
+    Для COM-драйвера каждое обращение к свойству - отдельный вызов через
+    границу COM. Помимо общих гистограмм (DriverMetrics) может собирать
+    разбивку одной операции: begin_trace() ... end_trace().
+    """
+
+    def __init__(self, fr, metrics):
+        object.__setattr__(self, '_fr', fr)
+        object.__setattr__(self, '_metrics', metrics)
+        object.__setattr__(self, '_trace', None)
+
+    def _record(self, key, started):
+        ms = (time.perf_counter() - started) * 1000
+        self._metrics.record(key, ms)
+        trace = self._trace
+        if trace is not None:
+            entry = trace.get(key)
+            if entry is None:
+                trace[key] = [1, ms]
+            else:
+                entry[0] += 1
+                entry[1] += ms
+
+    def __getattr__(self, name):
+        started = time.perf_counter()
+        value = getattr(self._fr, name)
+        if not callable(value):
+            self._record(f"get:{name}", started)
+            if name in DEBUG_PROPERTIES:
+                self._metrics.record_debug_read()
+            return value
+
+        def call(*args):
+            call_started = time.perf_counter()
+            try:
+                return value(*args)
+            finally:
+                self._record(f"call:{name}", call_started)
+        return call
+
+    def __setattr__(self, name, value):
+        started = time.perf_counter()
+        setattr(self._fr, name, value)
+        self._record(f"set:{name}", started)
+
+    def begin_trace(self):
+        """Начать разбивку вызовов текущей операции (например, чека)"""
+        object.__setattr__(self, '_trace', {})
+
+    def end_trace(self):
+        """
+        Закончить разбивку
+
+        :return: {"calls", "total_ms", "debug_reads", "stats": {ключ: {"count", "ms"}}} или None
+        """
+        trace = self._trace
+        object.__setattr__(self, '_trace', None)
+        if trace is None:
+            return None
+        stats = {
+            key: {'count': count, 'ms': round(ms, 3)}
+            for key, (count, ms) in sorted(trace.items(), key=lambda kv: kv[1][1], reverse=True)
+        }
+        return {
+            'calls': sum(s['count'] for s in stats.values()),
+            'total_ms': round(sum(s['ms'] for s in stats.values()), 3),
+            'debug_reads': sum(stats.get(f"get:{name}", {}).get('count', 0) for name in DEBUG_PROPERTIES),
+            'stats': stats
+        }
+
+
+def begin_trace(fr):
+    """Начать разбивку вызовов, если драйвер инструментирован"""
+    if isinstance(fr, InstrumentedDriver):
+        fr.begin_trace()
+
+
+def end_trace(fr):
+    """Закончить разбивку вызовов, если драйвер инструментирован"""
+    if isinstance(fr, InstrumentedDriver):
+        return fr.end_trace()
+    return None
+
+
+def instrument_factory(factory, metrics):
+    """Фабрика драйвера, оборачивающая каждый созданный драйвер в InstrumentedDriver"""
+    return lambda: InstrumentedDriver(factory(), metrics)
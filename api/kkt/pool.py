@@ -0,0 +1,206 @@
+import os
+import time
+
+from loguru import logger
+
+from .driver import make_driver_factory
+from .metrics import DriverMetrics, instrument_factory
+from .state import KktState
+from .worker import KktWorker, KktQueueFull, KktTimeout, PRIORITY_REPORT
+
+
+class KktDeviceNotFound(Exception):
+    """ККТ с указанным идентификатором нет в пуле"""
+
+
+class KktDevice:
+    """
+    ККТ в пуле: поток-владелец, кэш реквизитов и состояние работоспособности
+    """
+
+    def __init__(self, device_id, worker, fail_threshold=3, state_ttl=300, metrics=None):
+        self.id = device_id
+        self.worker = worker
+        self.fail_threshold = fail_threshold
+        # Замеры вызовов драйвера (None - драйвер не инструментирован)
+        self.metrics = metrics
+        # Режим, смена и номер документа по результатам наших команд
+        self.state = KktState(state_ttl)
+        self.worker.on_reset = self.state.invalidate
+        self.cache = {
+            'INN': None,
+            'KKTRegistrationNumber': None,
+            'KKTSerialNumber': None,
+            'FNSerialNumber': None,
+            'initialized': False
+        }
+        self.healthy = True
+        self.failures = 0
+        self.failed_at = None
+        self.last_error = None
+        self.in_flight = 0
+        self.snapshot = None  # Последний снимок состояния ККТ и ФН
+        self.snapshot_at = None
+
+    @property
+    def load(self):
+        """Команды в очереди и в работе"""
+        return self.in_flight
+
+    async def run(self, func, *args, priority=PRIORITY_REPORT, timeout=None, then=None, **kwargs):
+        """
+        Выполнить команду на этой ККТ с учетом ошибок для вывода из ротации
+        """
+        self.in_flight += 1
+        try:
+            result = await self.worker.run(func, *args, priority=priority, timeout=timeout, then=then, **kwargs)
+        except (KktQueueFull, KktTimeout):
+            # Переполнение очереди и ожидание - не ошибки самой ККТ
+            raise
+        except Exception as e:
+            self._register_failure(e)
+            raise
+        finally:
+            self.in_flight -= 1
+        self._register_success()
+        return result
+
+    def _register_failure(self, error):
+        self.failures += 1
+        self.failed_at = time.monotonic()
+        self.last_error = str(error)
+        if self.healthy and self.failures >= self.fail_threshold:
+            self.healthy = False
+            logger.error(f"ККТ {self.id} выведен из ротации после {self.failures} ошибок подряд: {error}")
+
+    def _register_success(self):
+        if not self.healthy:
+            logger.success(f"ККТ {self.id} возвращен в ротацию")
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+
+    def status(self):
+        return {
+            'id': self.id,
+            'healthy': self.healthy,
+            'connected': self.worker.connected,
+            'busy': self.worker.busy,
+            'queue_depth': self.worker.depth,
+            'in_flight': self.in_flight,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'state': self.state.as_dict(),
+            'snapshot_age': round(time.monotonic() - self.snapshot_at, 1) if self.snapshot_at else None,
+            'cache': self.cache
+        }
+
+
+class KktPool:
+    """
+    Пул ККТ с маршрутизацией чеков.
+
+    Чек направляется на закрепленную за залом/столом ККТ (если она в строю),
+    иначе на наименее загруженную. ККТ с fail_threshold ошибками подряд
+    выводится из ротации и получает пробную команду через retry_after секунд.
+    """
+
+    def __init__(self, fail_threshold=3, retry_after=60, routes=None):
+        """
+        :param fail_threshold: число ошибок подряд для вывода ККТ из ротации
+        :param retry_after: через сколько секунд снова пробовать ККТ, сек
+        :param routes: закрепление залов и столов за ККТ {"зал" или "зал/стол": id ККТ}
+        """
+        self.fail_threshold = fail_threshold
+        self.retry_after = retry_after
+        self.routes = routes or {}
+        self.devices = {}
+
+    @classmethod
+    def from_env(cls, worker_options=None):
+        """
+        Создать пул по переменным окружения:
+        KKT_DEVICES - список ККТ "id:номер логического устройства DRvFR,..."
+            (если не задан - одна ККТ "kkt" с текущими настройками драйвера);
+        KKT_HALL_ROUTES - закрепление "зал:id,зал/стол:id";
+        KKT_FAIL_THRESHOLD, KKT_RETRY_AFTER - вывод из ротации и повторная проба;
+        KKT_STATE_TTL - как долго доверять отслеживаемому режиму ККТ без перепроверки;
+        KKT_METRICS - замерять вызовы драйвера (true по умолчанию)
+        """
+        routes = {}
+        for pair in os.getenv('KKT_HALL_ROUTES', '').split(','):
+            if ':' in pair:
+                key, device_id = pair.rsplit(':', 1)
+                routes[key.strip()] = device_id.strip()
+        pool = cls(
+            fail_threshold=int(os.getenv('KKT_FAIL_THRESHOLD', '3')),
+            retry_after=float(os.getenv('KKT_RETRY_AFTER', '60')),
+            routes=routes
+        )
+        devices = [d.strip() for d in os.getenv('KKT_DEVICES', '').split(',') if d.strip()]
+        if not devices:
+            devices = ['kkt']
+        instrument = os.getenv('KKT_METRICS', 'true').lower() == 'true'
+        for spec in devices:
+            device_id, _, ld_number = spec.partition(':')
+            factory = make_driver_factory(ld_number=int(ld_number) if ld_number else None)
+            metrics = None
+            if instrument:
+                metrics = DriverMetrics()
+                factory = instrument_factory(factory, metrics)
+            worker = KktWorker(factory, name=device_id, **(worker_options or {}))
+            pool.add(KktDevice(
+                device_id,
+                worker,
+                fail_threshold=pool.fail_threshold,
+                state_ttl=float(os.getenv('KKT_STATE_TTL', '300')),
+                metrics=metrics
+            ))
+        return pool
+
+    def add(self, device):
+        self.devices[device.id] = device
+
+    def get(self, device_id=None):
+        """ККТ по идентификатору, без идентификатора - первая в пуле"""
+        if device_id is None:
+            return next(iter(self.devices.values()))
+        device = self.devices.get(device_id)
+        if device is None:
+            raise KktDeviceNotFound(f"ККТ {device_id} не найден")
+        return device
+
+    def _available(self, device):
+        if device.healthy:
+            return True
+        # Пробная команда на выведенную из ротации ККТ
+        return time.monotonic() - device.failed_at >= self.retry_after
+
+    def route(self, hall=None, table=None):
+        """
+        Выбрать ККТ для документа зала/стола
+        """
+        hall = hall.strip() if hall else None
+        table = table.strip() if table else None
+        keys = [f"{hall}/{table}", hall] if hall and table else [hall]
+        for key in keys:
+            device_id = self.routes.get(key) if key else None
+            if device_id in self.devices and self._available(self.devices[device_id]):
+                return self.devices[device_id]
+
+        candidates = [d for d in self.devices.values() if self._available(d)]
+        if not candidates:
+            # Все ККТ выведены из ротации - пробуем все, чтобы не отказывать сразу
+            candidates = list(self.devices.values())
+        return min(candidates, key=lambda d: d.load)
+
+    def start(self):
+        for device in self.devices.values():
+            device.worker.start()
+
+    def stop(self):
+        for device in self.devices.values():
+            device.worker.stop()
+
+    def status(self):
+        return [device.status() for device in self.devices.values()]
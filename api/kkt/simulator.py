@@ -0,0 +1,345 @@
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from functools import wraps
+
+
+# Режимы ККТ (ECRMode)
+MODE_SESSION_OPEN = 2
+MODE_SESSION_EXPIRED = 3
+MODE_SESSION_CLOSED = 4
+MODE_DOCUMENT_OPEN = 8
+
+MODE_DESCRIPTIONS = {
+    MODE_SESSION_OPEN: "Открытая смена, 24 часа не кончились",
+    MODE_SESSION_EXPIRED: "Открытая смена, 24 часа кончились",
+    MODE_SESSION_CLOSED: "Закрытая смена",
+    MODE_DOCUMENT_OPEN: "Открытый документ",
+}
+
+# Коды ошибок (ResultCode)
+RESULT_OK = 0
+RESULT_NO_CONNECTION = -1
+RESULT_PAYMENT_LESS_THAN_TOTAL = 0x45
+RESULT_DOCUMENT_OPEN = 0x4A
+RESULT_SESSION_EXPIRED = 0x4E
+RESULT_WRONG_MODE = 0x73
+
+RESULT_DESCRIPTIONS = {
+    RESULT_OK: "Ошибок нет",
+    RESULT_NO_CONNECTION: "Нет связи",
+    RESULT_PAYMENT_LESS_THAN_TOTAL: "Cумма всех типов оплаты меньше итога чека",
+    RESULT_DOCUMENT_OPEN: "Открыт чек - операция невозможна",
+    RESULT_SESSION_EXPIRED: "Смена превысила 24 часа",
+    RESULT_WRONG_MODE: "Команда не поддерживается в данном режиме",
+}
+
+
+def _command(method):
+    """Команда драйвера: задержка, проверка связи, код результата"""
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self):
+        delay = self.latency_map.get(name, self.latency)
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            if not self._connected and name != 'Connect':
+                return self._result(RESULT_NO_CONNECTION)
+            return self._result(method(self) or RESULT_OK)
+    return wrapper
+
+
+class ShtrihSimulator:
+    """
+    Симулятор ККТ Штрих-М с интерфейсом DRvFR.
+
+    Моделирует режимы ККТ, открытие и закрытие смены, номера фискальных
+    документов и чеков, а также задержку каждой команды. Используется для
+    нагрузочного тестирования на машинах без ККТ (KKT_DRIVER=simulator).
+    """
+
+    def __init__(self, latency=0.0, latency_map=None, mode=MODE_SESSION_CLOSED,
+                 session_number=0, document_number=0, shift_hours=24):
+        """
+        :param latency: задержка любой команды по умолчанию, сек
+        :param latency_map: задержки отдельных команд {имя метода: сек}
+        :param mode: начальный режим ККТ
+        :param session_number: номер последней смены
+        :param document_number: номер последнего фискального документа
+        :param shift_hours: длительность смены до перехода в режим 3
+        """
+        self.latency = latency
+        self.latency_map = latency_map or {}
+        self.shift_duration = timedelta(hours=shift_hours)
+        self._lock = threading.Lock()
+        self._connected = False
+        self._mode = mode
+        self._session_opened_at = datetime.now() if mode in (MODE_SESSION_OPEN, MODE_DOCUMENT_OPEN) else None
+        self._receipt_total = 0.0
+        self.printed = deque(maxlen=1000)  # Последние напечатанные строки
+
+        # Входные параметры
+        self.Password = 0
+        self.StringForPrinting = ""
+        self.StringQuantity = 1
+        self.Price = 0
+        self.Quantity = 0
+        self.Summ1 = 0
+        self.Summ2 = 0
+        self.Barcode = ""
+        self.BarCode = ""
+        self.TagNumber = 0
+        self.TagType = 0
+        self.TagValueStr = ""
+        self.LDNumber = 0
+
+        # Выходные параметры
+        self.ResultCode = RESULT_OK
+        self.ResultCodeDescription = RESULT_DESCRIPTIONS[RESULT_OK]
+        self.ECRMode = mode
+        self.ECRModeDescription = MODE_DESCRIPTIONS.get(mode, "")
+        self.ECRAdvancedMode = 0
+        self.DocumentNumber = document_number
+        self.SessionNumber = session_number
+        self.ReceiptNumber = 0
+        self.FNSessionState = 1 if self._session_opened_at else 0
+        self.FiscalSign = ""
+        self.INN = "000000000000"
+        self.SerialNumber = ""
+        self.KKTRegistrationNumber = "0000000000000000"
+        self.KKTSerialNumber = "SIM00000000001"
+        self.FNSerialNumber = "9999078900000001"
+        self.Date = datetime.now().date()
+        self.Time = datetime.now().time()
+        self.FNLifeState = 3
+        self.FNCurrentDocument = 0
+        self.FNDocumentData = 0
+        self.FNWarningFlags = 0
+        self.TaxType = 1
+        self.WorkMode = 0
+        self.RegistrationReasonCode = 0
+        self.MarkingType = 0
+        self.MarkingTypeEx = 0
+        self.CheckItemLocalResult = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Создать симулятор по переменным окружения:
+        KKT_SIM_LATENCY_MS - задержка команды, мс;
+        KKT_SIM_LATENCY - задержки отдельных команд, "FNCloseCheckEx=400,FNOperation=30" (мс);
+        KKT_SIM_MODE - начальный режим ККТ
+        """
+        latency_map = {}
+        for pair in os.getenv('KKT_SIM_LATENCY', '').split(','):
+            if '=' in pair:
+                name, ms = pair.split('=', 1)
+                latency_map[name.strip()] = float(ms) / 1000
+        return cls(
+            latency=float(os.getenv('KKT_SIM_LATENCY_MS', '0')) / 1000,
+            latency_map=latency_map,
+            mode=int(os.getenv('KKT_SIM_MODE', str(MODE_SESSION_CLOSED)))
+        )
+
+    def _result(self, code):
+        self.ResultCode = code
+        self.ResultCodeDescription = RESULT_DESCRIPTIONS.get(code, f"Ошибка {code}")
+        return code
+
+    def _current_mode(self):
+        if self._mode == MODE_SESSION_OPEN and datetime.now() - self._session_opened_at > self.shift_duration:
+            self._mode = MODE_SESSION_EXPIRED
+        return self._mode
+
+    def _set_mode(self, mode):
+        self._mode = mode
+        self.ECRMode = mode
+        self.ECRModeDescription = MODE_DESCRIPTIONS.get(mode, "")
+
+    def _next_document(self):
+        self.DocumentNumber += 1
+        self.FNCurrentDocument = self.DocumentNumber
+        digest = hashlib.sha1(f"{self.FNSerialNumber}:{self.DocumentNumber}".encode()).hexdigest()
+        self.FiscalSign = str(int(digest[:8], 16))
+
+    def _print(self, line):
+        self.printed.append(line)
+
+    # ---- Подключение ----
+
+    @_command
+    def Connect(self):
+        self._connected = True
+
+    @_command
+    def Disconnect(self):
+        self._connected = False
+
+    # ---- Состояние ----
+
+    @_command
+    def GetECRStatus(self):
+        self._set_mode(self._current_mode())
+
+    @_command
+    def ContinuePrint(self):
+        self.ECRAdvancedMode = 0
+
+    @_command
+    def WaitForPrinting(self):
+        self.ECRAdvancedMode = 0
+
+    @_command
+    def SetActiveLD(self):
+        pass
+
+    @_command
+    def ReadSerialNumber(self):
+        self.SerialNumber = self.KKTSerialNumber
+
+    @_command
+    def FNGetSerial(self):
+        self.SerialNumber = self.FNSerialNumber
+
+    @_command
+    def FNGetStatus(self):
+        self.FNSessionState = 1 if self._session_opened_at else 0
+        self.SerialNumber = self.FNSerialNumber
+        self.Date = datetime.now().date()
+        self.Time = datetime.now().time()
+
+    @_command
+    def FNGetFiscalizationResult(self):
+        self.Date = datetime.now().date()
+
+    @_command
+    def FNGetExpirationTime(self):
+        self.Date = (datetime.now() + timedelta(days=365)).date()
+
+    @_command
+    def FNGetCurrentSessionParams(self):
+        self.FNSessionState = 1 if self._session_opened_at else 0
+
+    # ---- Чек ----
+
+    @_command
+    def FNOperation(self):
+        mode = self._current_mode()
+        if mode == MODE_SESSION_EXPIRED:
+            return RESULT_SESSION_EXPIRED
+        if mode == MODE_SESSION_CLOSED:
+            # Как и ККТ, открываем смену автоматически при первой продаже
+            self.SessionNumber += 1
+            self.ReceiptNumber = 0
+            self._session_opened_at = datetime.now()
+            self._next_document()
+        elif mode != MODE_SESSION_OPEN and mode != MODE_DOCUMENT_OPEN:
+            return RESULT_WRONG_MODE
+        if mode != MODE_DOCUMENT_OPEN:
+            self._receipt_total = 0.0
+            self._set_mode(MODE_DOCUMENT_OPEN)
+        self._receipt_total += round(float(self.Price) * float(self.Quantity), 2)
+        self._print(f"{self.StringForPrinting} {self.Quantity} x {self.Price}")
+
+    @_command
+    def FNCheckItemBarcode(self):
+        self.MarkingType = 1
+        self.MarkingTypeEx = 1
+        self.CheckItemLocalResult = 0
+
+    @_command
+    def FNAcceptMarkingCode(self):
+        pass
+
+    @_command
+    def FNSendItemBarcode(self):
+        if self._mode != MODE_DOCUMENT_OPEN:
+            return RESULT_WRONG_MODE
+
+    @_command
+    def FNSendTag(self):
+        pass
+
+    @_command
+    def FNSendTagOperation(self):
+        if self._mode != MODE_DOCUMENT_OPEN:
+            return RESULT_WRONG_MODE
+
+    @_command
+    def FNCloseCheckEx(self):
+        if self._mode != MODE_DOCUMENT_OPEN:
+            return RESULT_WRONG_MODE
+        if round(float(self.Summ1) + float(self.Summ2), 2) + 0.005 < round(self._receipt_total, 2):
+            return RESULT_PAYMENT_LESS_THAN_TOTAL
+        self.ReceiptNumber += 1
+        self._next_document()
+        self._receipt_total = 0.0
+        self.Summ1 = 0
+        self.Summ2 = 0
+        self._set_mode(MODE_SESSION_OPEN)
+
+    @_command
+    def SysAdminCancelCheck(self):
+        if self._mode == MODE_DOCUMENT_OPEN:
+            self._receipt_total = 0.0
+            self._set_mode(MODE_SESSION_OPEN)
+
+    # ---- Печать ----
+
+    @_command
+    def PrintString(self):
+        self._print(self.StringForPrinting)
+
+    @_command
+    def PrintWideString(self):
+        self._print(self.StringForPrinting)
+
+    @_command
+    def FeedDocument(self):
+        for _ in range(int(self.StringQuantity)):
+            self._print("")
+
+    @_command
+    def CutCheck(self):
+        self._print("--- отрез ---")
+
+    @_command
+    def LoadAndPrint2DBarcode(self):
+        self._print(f"[QR] {self.Barcode}")
+
+    # ---- Отчеты и смена ----
+
+    @_command
+    def PrintReportWithoutCleaning(self):
+        if self._current_mode() == MODE_DOCUMENT_OPEN:
+            return RESULT_DOCUMENT_OPEN
+        self._print("X-ОТЧЕТ")
+
+    @_command
+    def FNOpenSession(self):
+        if self._current_mode() != MODE_SESSION_CLOSED:
+            return RESULT_WRONG_MODE
+        self.SessionNumber += 1
+        self.ReceiptNumber = 0
+        self._session_opened_at = datetime.now()
+        self._next_document()
+        self._set_mode(MODE_SESSION_OPEN)
+
+    @_command
+    def FNBeginCloseSession(self):
+        if self._current_mode() not in (MODE_SESSION_OPEN, MODE_SESSION_EXPIRED):
+            return RESULT_WRONG_MODE
+
+    @_command
+    def FNCloseSession(self):
+        if self._current_mode() not in (MODE_SESSION_OPEN, MODE_SESSION_EXPIRED):
+            return RESULT_WRONG_MODE
+        self._next_document()
+        self._session_opened_at = None
+        self._set_mode(MODE_SESSION_CLOSED)
+        self._print("Z-ОТЧЕТ")
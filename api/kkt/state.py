@@ -0,0 +1,67 @@
+import time
+
+# Режимы ККТ, в которых можно сразу открывать чек
+READY_MODES = (2, 4)  # 2 - открытая смена, 4 - закрытая смена
+MODE_SESSION_OPEN = 2
+MODE_SESSION_CLOSED = 4
+
+
+class KktState:
+    """
+    Отслеживаемое состояние ККТ: режим, номер смены и номер последнего документа.
+
+    Обновляется по результатам наших же команд, поэтому перед чеком не нужен
+    запрос GetECRStatus, а после чека - FNGetCurrentSessionParams. Состояние
+    сбрасывается при любой ошибке и перепроверяется не реже чем раз в ttl секунд
+    (например, чтобы заметить истечение 24 часов смены).
+    Используется только из потока ККТ.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.mode = None
+        self.session_number = None
+        self.document_number = None
+        self.synced_at = None
+
+    def is_ready(self):
+        """ККТ заведомо готова к чеку без запроса режима"""
+        if self.mode is None or self.synced_at is None:
+            return False
+        if time.monotonic() - self.synced_at > self.ttl:
+            return False
+        return self.mode in READY_MODES
+
+    def invalidate(self):
+        self.mode = None
+        self.session_number = None
+        self.synced_at = None
+
+    def sync(self, mode, session_number=None, document_number=None):
+        """Состояние прочитано с ККТ (GetECRStatus, FNGetCurrentSessionParams)"""
+        self.mode = mode
+        if session_number is not None:
+            self.session_number = session_number
+        if document_number is not None:
+            self.document_number = document_number
+        self.synced_at = time.monotonic()
+
+    def on_receipt_closed(self, document_number):
+        """Чек закрыт: в закрытой смене ККТ открывает смену автоматически"""
+        if self.mode == MODE_SESSION_CLOSED and self.session_number is not None:
+            self.session_number += 1
+        self.mode = MODE_SESSION_OPEN
+        self.document_number = document_number
+
+    def on_session_closed(self):
+        """Смена закрыта (Z-отчет)"""
+        self.mode = MODE_SESSION_CLOSED
+        self.document_number = None
+
+    def as_dict(self):
+        return {
+            'mode': self.mode,
+            'session_number': self.session_number,
+            'document_number': self.document_number,
+            'ready': self.is_ready()
+        }
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from loguru import logger
+
+from .worker import PRIORITY_IDLE, PRIORITY_REPORT
+
+
+class KktStatusPoller:
+    """
+    Фоновый опрос состояния ККТ и ФН.
+
+    Раз в interval секунд для каждой ККТ пула выполняет collect(fr, device) в
+    свободные промежутки очереди (когда ККТ не занята чеками) и сохраняет
+    результат в device.snapshot. API отдает снимок вместо обращения к ККТ.
+    """
+
+    def __init__(self, pool, collect, interval=30, idle_wait=1.0):
+        """
+        :param pool: пул ККТ (KktPool)
+        :param collect: функция collect(fr, device) -> dict, выполняется в потоке ККТ
+        :param interval: период опроса, сек (0 - опрос отключен)
+        :param idle_wait: период проверки простоя очереди, сек
+        """
+        self.pool = pool
+        self.collect = collect
+        self.interval = interval
+        self.idle_wait = idle_wait
+        self._tasks = []
+
+    def start(self):
+        if not self.interval:
+            logger.info("Фоновый опрос состояния ККТ отключен")
+            return
+        for device in self.pool.devices.values():
+            self._tasks.append(asyncio.create_task(self._poll(device)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def refresh(self, device, priority=PRIORITY_REPORT):
+        """Обновить снимок состояния ККТ немедленно"""
+        snapshot = await device.run(self.collect, device, priority=priority)
+        device.snapshot = snapshot
+        device.snapshot_at = time.monotonic()
+        return snapshot
+
+    @staticmethod
+    def age(device):
+        """Возраст снимка состояния, сек"""
+        if device.snapshot_at is None:
+            return None
+        return round(time.monotonic() - device.snapshot_at, 1)
+
+    async def _wait_idle(self, device):
+        # Ждем простоя очереди, но не дольше одного периода опроса
+        deadline = time.monotonic() + self.interval
+        while device.load and time.monotonic() < deadline:
+            await asyncio.sleep(self.idle_wait)
+
+    async def _poll(self, device):
+        while True:
+            age = self.age(device)
+            if age is not None and age < self.interval:
+                await asyncio.sleep(self.interval - age)
+                continue
+            await self._wait_idle(device)
+            try:
+                await self.refresh(device, priority=PRIORITY_IDLE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Ошибка опроса состояния ККТ {device.id}: {e}")
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,207 @@
+import asyncio
+import itertools
+import queue
+import threading
+
+from loguru import logger
+
+try:
+    import pythoncom
+except ImportError:
+    pythoncom = None
+
+
+# Классы приоритета команд ККТ (меньше - раньше)
+PRIORITY_PAYMENT = 0  # Чеки оплаты, отмена документа
+PRIORITY_PRINT = 1    # Счета, QR-коды ЕГАИС
+PRIORITY_REPORT = 2   # Отчеты и запросы информации
+PRIORITY_IDLE = 3     # Фоновый опрос состояния
+
+# Команда остановки идет после всех заданий, чтобы очередь успела опустеть
+_PRIORITY_STOP = 100
+
+
+class KktQueueFull(Exception):
+    """Очередь команд ККТ переполнена"""
+
+
+class KktTimeout(Exception):
+    """Команда ККТ не дождалась выполнения за отведенное время"""
+
+
+class _Job:
+    __slots__ = ('func', 'args', 'kwargs', 'then', 'loop', 'future', 'started')
+
+    def __init__(self, func, args, kwargs, then, loop, future):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.then = then
+        self.loop = loop
+        self.future = future
+        self.started = False
+
+
+class KktWorker:
+    """
+    Поток-владелец ККТ.
+
+    Держит один подключенный экземпляр драйвера на всё время жизни процесса
+    и выполняет команды строго последовательно. Команды передаются из
+    asyncio через очередь с приоритетами, результат возвращается через future.
+    """
+
+    def __init__(self, factory, name="kkt", maxsize=100, timeout=60):
+        """
+        :param factory: функция без аргументов, создающая объект драйвера (DRvFR)
+        :param name: имя потока (для логов)
+        :param maxsize: максимальная глубина очереди команд
+        :param timeout: время ожидания команды в очереди по умолчанию, сек
+        """
+        self.name = name
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self._factory = factory
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._fr = None
+        self._busy = False
+        # Вызывается в потоке ККТ при сбросе подключения (ошибка, потеря связи)
+        self.on_reset = None
+
+    @property
+    def connected(self):
+        return self._fr is not None
+
+    @property
+    def busy(self):
+        return self._busy
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name=f"{self.name}-worker", daemon=True)
+        self._thread.start()
+        logger.info(f"Поток ККТ {self.name} запущен")
+
+    def stop(self, timeout=10):
+        if not self._thread:
+            return
+        self._queue.put((_PRIORITY_STOP, next(self._seq), None))
+        self._thread.join(timeout)
+        self._thread = None
+        logger.info(f"Поток ККТ {self.name} остановлен")
+
+    async def run(self, func, *args, priority=PRIORITY_REPORT, timeout=None, then=None, **kwargs):
+        """
+        Выполнить func(fr, *args, **kwargs) в потоке ККТ и дождаться результата
+
+        :param priority: класс приоритета (PRIORITY_*)
+        :param timeout: сколько команда может ждать в очереди, сек.
+            Начатая команда всегда доводится до конца - фискальную
+            операцию нельзя прервать на середине.
+        :param then: завершение then(fr, result) - выполняется сразу после
+            func, до следующей команды, но результат возвращается не дожидаясь
+            его (например, подача и отрезка бумаги после закрытия чека)
+        :raises KktQueueFull: очередь переполнена
+        :raises KktTimeout: команда не начала выполняться за timeout
+        """
+        if self.maxsize and self._queue.qsize() >= self.maxsize:
+            raise KktQueueFull(f"Очередь ККТ {self.name} переполнена ({self.maxsize} команд)")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        job = _Job(func, args, kwargs, then, loop, future)
+        self._queue.put((priority, next(self._seq), job))
+
+        timeout = self.timeout if timeout is None else timeout
+        if timeout:
+            handle = loop.call_later(timeout, self._expire, job, timeout)
+            future.add_done_callback(lambda f: handle.cancel())
+        return await future
+
+    def _expire(self, job, timeout):
+        with self._lock:
+            if job.started or job.future.done():
+                return
+            job.future.set_exception(KktTimeout(f"Команда ККТ {self.name} не выполнена за {timeout} сек"))
+
+    def _connect(self):
+        fr = self._factory()
+        fr.Connect()
+        if fr.ResultCode != 0:
+            raise ConnectionError(f"Ошибка подключения к ККТ: {fr.ResultCode}, {fr.ResultCodeDescription}")
+        logger.info(f"ККТ {self.name} подключен")
+        return fr
+
+    def _disconnect(self):
+        if self._fr is None:
+            return
+        try:
+            self._fr.Disconnect()
+        except Exception as e:
+            logger.warning(f"Ошибка отключения ККТ {self.name}: {e}")
+        self._fr = None
+        if self.on_reset:
+            self.on_reset()
+
+    def _loop(self):
+        if pythoncom:
+            pythoncom.CoInitialize()
+        try:
+            while True:
+                _, _, job = self._queue.get()
+                if job is None:
+                    break
+                # Задание, снятое по таймауту или отмененное клиентом, не выполняем
+                with self._lock:
+                    if job.future.done():
+                        continue
+                    job.started = True
+                self._busy = True
+                try:
+                    if self._fr is None:
+                        self._fr = self._connect()
+                    result = job.func(self._fr, *job.args, **job.kwargs)
+                except Exception as e:
+                    # При любой ошибке сбрасываем подключение - следующая команда переподключится
+                    logger.error(f"Ошибка выполнения команды ККТ {self.name}: {e}")
+                    self._disconnect()
+                    job.loop.call_soon_threadsafe(_set_exception, job.future, e)
+                    continue
+                finally:
+                    self._busy = False
+                job.loop.call_soon_threadsafe(_set_result, job.future, result)
+                if job.then:
+                    self._busy = True
+                    try:
+                        job.then(self._fr, result)
+                    except Exception as e:
+                        logger.error(f"Ошибка завершения команды ККТ {self.name}: {e}")
+                        self._disconnect()
+                        continue
+                    finally:
+                        self._busy = False
+                # Отрицательный код результата - нет связи с ККТ
+                if self._fr.ResultCode < 0:
+                    logger.warning(f"Потеряна связь с ККТ {self.name}: {self._fr.ResultCode}, {self._fr.ResultCodeDescription}")
+                    self._disconnect()
+        finally:
+            self._disconnect()
+            if pythoncom:
+                pythoncom.CoUninitialize()
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
@@ -5,6 +5,8 @@ from .product import Product
 from .user import User
 from .area import Area
 from .seat import Seat
+from .payment_idempotency import PaymentIdempotency
+from .egais_outbox import EgaisOutbox
 
 __all__ = [
     'CheckLog',
@@ -13,5 +15,7 @@ __all__ = [
     'Product',
     'User',
     'Area',
-    'Seat'
+    'Seat',
+    'PaymentIdempotency',
+    'EgaisOutbox'
 ]
@@ -8,6 +8,8 @@ class Category(Model):
     description = fields.TextField(null=True)
     legacy_id = fields.CharField(max_length=100, null=True)  # ID из старой системы (1С)
     parent = fields.ForeignKeyField('models.Category', related_name='children', null=True, on_delete=fields.SET_NULL)  # Родительская категория
+    kitchen_station = fields.CharField(max_length=50, null=True)  # Станция кухонных марок (БАР, ГОРЯЧИЙ ЦЕХ)
+    kitchen_printer = fields.CharField(max_length=100, null=True)  # Принтер станции host[:port]; наследуется подкатегориями
     is_active = fields.BooleanField(default=True)
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
@@ -15,6 +15,7 @@ class CheckLog(Model):
     document_number = fields.CharField(max_length=50, null=True)  # Номер чека
     fiscal_sign = fields.CharField(max_length=50, null=True)  # Фискальный признак
     legacynum = fields.CharField(max_length=100, null=True)  # Order.num
+    device_stats = fields.JSONField(null=True)  # Разбивка вызовов драйвера ККТ по чеку
 
     class Meta:
         table = "check_logs"
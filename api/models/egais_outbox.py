@@ -0,0 +1,27 @@
+from tortoise.models import Model
+from tortoise import fields
+
+
+class EgaisOutbox(Model):
+    """Очередь отправки чеков в УТМ ЕГАИС (чек удаляется из очереди только после ответа УТМ)"""
+    id = fields.IntField(pk=True)
+    register = fields.CharField(max_length=50)  # Касса: чеки одной кассы уходят в УТМ по порядку
+    status = fields.CharField(max_length=20, default="pending")  # pending, sending, sent, failed
+    attempts = fields.IntField(default=0)
+    next_attempt_at = fields.DatetimeField(null=True)
+    last_error = fields.TextField(null=True)
+    xml_data = fields.TextField()
+    order_data = fields.JSONField(null=True)
+    legacynum = fields.CharField(max_length=100, null=True)  # Order.num
+    xml_file = fields.CharField(max_length=255, null=True)
+    device_id = fields.CharField(max_length=50, null=True)  # ККТ для печати QR-кода
+    print_qr = fields.BooleanField(default=False)
+    egais_log_id = fields.IntField(null=True)  # Запись EgaisLog, из которой чек отправлен повторно
+    response_data = fields.TextField(null=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+    updated_at = fields.DatetimeField(auto_now=True)
+    sent_at = fields.DatetimeField(null=True)
+
+    class Meta:
+        table = "egais_outbox"
+        indexes = (("register", "status"),)
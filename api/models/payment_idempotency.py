@@ -0,0 +1,13 @@
+from tortoise.models import Model
+from tortoise import fields
+
+
+class PaymentIdempotency(Model):
+    """Результаты оплат по ключу идемпотентности (Order.num или Idempotency-Key)"""
+    id = fields.IntField(pk=True)
+    key = fields.CharField(max_length=255, unique=True)
+    response = fields.JSONField()  # Ответ, отданный клиенту при первой попытке
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "payment_idempotency"
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from loguru import logger
+
+
+class ReceiptPipeline:
+    """
+    Фоновые этапы обработки чека после закрытия фискального документа.
+
+    Клиент получает ответ сразу после FNCloseCheckEx, а запись в журнал,
+    отправка в ЕГАИС и печать QR-кода выполняются последовательно в фоне.
+    Статус каждого этапа хранится по номеру заказа (последние max_orders
+    заказов) и доступен через API.
+    """
+
+    def __init__(self, max_orders=1000):
+        """
+        :param max_orders: сколько последних заказов хранить в реестре статусов
+        """
+        self.max_orders = max_orders
+        self._orders = OrderedDict()
+        self._tasks = set()
+
+    def start(self, order_num, stages):
+        """
+        Запустить этапы заказа в фоне
+
+        :param order_num: номер заказа (Order.num)
+        :param stages: список (имя этапа, функция без аргументов -> корутина).
+            Этап, вернувший None, считается пропущенным.
+        :return: dict статуса заказа
+        """
+        record = {
+            'order': order_num,
+            'created_at': datetime.now().isoformat(),
+            'finished': False,
+            'stages': {name: {'status': 'pending'} for name, _ in stages}
+        }
+        self._orders[order_num] = record
+        self._orders.move_to_end(order_num)
+        while len(self._orders) > self.max_orders:
+            self._orders.popitem(last=False)
+
+        task = asyncio.create_task(self._run(record, stages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return record
+
+    def get(self, order_num):
+        """Статус этапов заказа или None"""
+        return self._orders.get(order_num)
+
+    @property
+    def pending(self):
+        """Число заказов с незавершенными этапами"""
+        return len(self._tasks)
+
+    async def drain(self, timeout=30):
+        """Дождаться завершения фоновых этапов (при остановке сервиса)"""
+        if not self._tasks:
+            return
+        logger.info(f"Ожидание завершения фоновых этапов чеков: {len(self._tasks)}")
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Фоновые этапы не завершены за {timeout} сек: {len(pending)}")
+
+    async def _run(self, record, stages):
+        for name, stage in stages:
+            info = record['stages'][name]
+            info['status'] = 'running'
+            started = time.monotonic()
+            try:
+                result = await stage()
+            except Exception as e:
+                logger.error(f"Ошибка этапа {name} заказа {record['order']}: {e}")
+                info.update(status='error', error=str(e))
+            else:
+                if result is None:
+                    info['status'] = 'skipped'
+                else:
+                    info.update(status='done', result=result)
+            info['duration'] = round(time.monotonic() - started, 3)
+        record['finished'] = True
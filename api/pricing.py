@@ -0,0 +1,90 @@
+import os
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+KOPECK = Decimal('0.01')
+HUNDRED = Decimal('100')
+
+
+def to_money(value):
+    """Округление до копеек (как у ККТ - половина вверх)"""
+    return value.quantize(KOPECK, rounding=ROUND_HALF_UP)
+
+
+def parse_decimal(value, field, name=None, default=None):
+    """Строковое поле заказа (1С) в Decimal; запятая допускается как разделитель"""
+    if value is None or str(value).strip() == "":
+        if default is not None:
+            return default
+        raise ValueError(f"Не заполнено поле {field}" + (f" позиции {name}" if name else ""))
+    try:
+        result = Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"Некорректное значение {field}={value!r}" + (f" позиции {name}" if name else ""))
+    if not result.is_finite() or result < 0:
+        raise ValueError(f"Некорректное значение {field}={value!r}" + (f" позиции {name}" if name else ""))
+    return result
+
+
+class PricedLine:
+    """Позиция заказа с разобранными количеством, ценой и скидкой"""
+    __slots__ = ('item', 'quantity', 'price', 'discount', 'capped', 'unit_price', 'amount_full', 'amount')
+
+    def __init__(self, item, quantity, price, discount, capped):
+        self.item = item
+        self.quantity = quantity
+        self.price = price
+        self.discount = discount  # Доля скидки позиции (0..1)
+        self.capped = capped  # Скидка ограничена максимальной скидкой товара
+        # Цена со скидкой округляется до копеек, как ее примет ККТ
+        self.unit_price = to_money(price * (1 - discount))
+        self.amount_full = to_money(price * quantity)
+        self.amount = to_money(self.unit_price * quantity)
+
+
+class PricedOrder:
+    """Расчет заказа: позиции, скидка и итоги в копейках"""
+    __slots__ = ('lines', 'discount_percent', 'total_full', 'total', 'has_capped')
+
+    def __init__(self, lines, discount_percent):
+        self.lines = lines
+        self.discount_percent = discount_percent
+        self.total_full = sum((line.amount_full for line in lines), Decimal(0))
+        self.total = sum((line.amount for line in lines), Decimal(0))
+        self.has_capped = any(line.capped for line in lines)
+
+    @property
+    def has_discount(self):
+        return self.discount_percent > 0
+
+
+def price_order(order, max_discount=None):
+    """
+    Разобрать и рассчитать заказ за один проход по позициям
+
+    Скидка заказа (alldiscount, 0..100%) применяется к каждой позиции; при
+    MAX_DISCOUNT=True она ограничивается максимальной скидкой товара (maxdiscont).
+    Суммы считаются в Decimal с округлением до копеек.
+
+    :param max_discount: учитывать maxdiscont (по умолчанию - из MAX_DISCOUNT)
+    :raises ValueError: некорректные количество, цена или скидка
+    """
+    if max_discount is None:
+        max_discount = os.getenv('MAX_DISCOUNT', 'False') in ['True']
+    discount_percent = parse_decimal(order.alldiscount, 'alldiscount', default=Decimal(0))
+    if discount_percent > HUNDRED:
+        discount_percent = Decimal(0)
+    discount = discount_percent / HUNDRED
+
+    lines = []
+    for item in order.products or []:
+        quantity = parse_decimal(item.kolvo, 'kolvo', item.name)
+        price = parse_decimal(item.price, 'price', item.name)
+        item_discount = discount
+        capped = False
+        if max_discount and discount:
+            limit = parse_decimal(item.maxdiscont, 'maxdiscont', item.name, default=HUNDRED) / HUNDRED
+            if limit < discount:
+                item_discount = limit
+                capped = True
+        lines.append(PricedLine(item, quantity, price, item_discount, capped))
+    return PricedOrder(lines, discount_percent)
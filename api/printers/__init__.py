@@ -0,0 +1,19 @@
+from .network import parse_address
+from .pool import PrinterPool, PrinterConnection
+from .routing import KitchenRouter
+from .queue import KitchenQueue
+from .health import PrinterProber, parse_status
+from .invoice import render_invoice
+from .kitchen import render_kitchen_ticket
+
+__all__ = [
+    'parse_address',
+    'PrinterPool',
+    'PrinterConnection',
+    'KitchenRouter',
+    'KitchenQueue',
+    'PrinterProber',
+    'parse_status',
+    'render_invoice',
+    'render_kitchen_ticket'
+]
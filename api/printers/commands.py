@@ -0,0 +1,36 @@
+# Команды ESC/POS, общие для кухонных принтеров и принтеров счетов
+
+ESC_INIT = b'\x1b\x40'  # Сброс настроек принтера
+FS_CHINESE_OFF = b'\x1c\x2e'  # Отключение китайского режима
+CODEPAGE_CP866 = b'\x1b\x74\x10'  # Кодовая таблица CP866 (русский язык)
+ENCODING = 'cp866'
+
+ALIGN_LEFT = b'\x1b\x61\x00'
+ALIGN_CENTER = b'\x1b\x61\x01'
+
+CUT_PARTIAL = b'\x1d\x56\x01'
+
+# Запросы состояния в реальном времени (DLE EOT n), ответ - один байт
+STATUS_PRINTER = b'\x10\x04\x01'  # Состояние принтера
+STATUS_OFFLINE = b'\x10\x04\x02'  # Причина перехода в offline
+STATUS_PAPER = b'\x10\x04\x04'  # Датчики бумаги
+
+
+def size(width=1, height=1):
+    """Размер символов GS ! n (кратность 1..8 по ширине и высоте)"""
+    return b'\x1d\x21' + bytes([((width - 1) << 4) | (height - 1)])
+
+
+def feed(lines):
+    """Подача бумаги на lines строк (ESC d n)"""
+    data = b''
+    while lines > 0:
+        chunk = min(lines, 255)
+        data += b'\x1b\x64' + bytes([chunk])
+        lines -= chunk
+    return data
+
+
+def encode(text):
+    """Текст в кодировке принтера; символы вне CP866 заменяются на '?'"""
+    return text.encode(ENCODING, errors='replace')
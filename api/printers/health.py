@@ -0,0 +1,151 @@
+import asyncio
+import time
+from datetime import datetime
+
+from loguru import logger
+
+from .commands import STATUS_PRINTER, STATUS_OFFLINE, STATUS_PAPER
+
+
+def _valid(byte):
+    # Фиксированные биты ответа DLE EOT: 0xx1xx10
+    return byte is not None and byte & 0x93 == 0x12
+
+
+def parse_status(replies):
+    """
+    Ответы DLE EOT 1, 2, 4 -> состояние принтера
+
+    :param replies: [состояние, причина offline, датчики бумаги] или None
+    :return: dict; None в поле - принтер не сообщил это состояние
+    """
+    printer, offline, paper = (list(replies or []) + [None] * 3)[:3]
+    status = {'offline': None, 'cover_open': None, 'paper_out': None, 'paper_near_end': None, 'printer_error': None}
+    if _valid(printer):
+        status['offline'] = bool(printer & 0x08)
+    if _valid(offline):
+        status['cover_open'] = bool(offline & 0x04)
+        status['paper_out'] = bool(offline & 0x20)
+        status['printer_error'] = bool(offline & 0x40)
+    if _valid(paper):
+        status['paper_near_end'] = bool(paper & 0x0C)
+        status['paper_out'] = bool(paper & 0x60) or bool(status['paper_out'])
+    return status
+
+
+class PrinterProber:
+    """
+    Фоновый опрос сетевых принтеров кухонных марок.
+
+    Раз в interval секунд каждому известному принтеру отправляются запросы
+    реального времени DLE EOT (через постоянное подключение пула), результат
+    с временем опроса хранится в памяти. Принтер не готов, если к нему нет
+    подключения, он offline, открыта крышка или кончилась бумага. Очередь марок
+    и маршрутизация спрашивают ready() и не ждут таймаута подключения к
+    заведомо недоступному принтеру. Принтер, который не отвечает на DLE EOT,
+    но принимает подключение, считается готовым.
+    """
+
+    def __init__(self, pool, addresses, interval=10, timeout=1, on_change=None):
+        """
+        :param pool: пул подключений (PrinterPool)
+        :param addresses: async addresses() -> адреса принтеров для опроса
+        :param interval: период опроса, сек (0 - опрос отключен)
+        :param timeout: ожидание ответа на DLE EOT, сек
+        :param on_change: on_change(address, ready) - готовность принтера изменилась
+        """
+        self.pool = pool
+        self.addresses = addresses
+        self.interval = interval
+        self.timeout = timeout
+        self.on_change = on_change
+        # Результат старше max_age не учитывается (опрос остановился или отключен)
+        self.max_age = 3 * interval if interval else 60
+        self._status = {}
+        self._task = None
+
+    def start(self):
+        if not self.interval:
+            logger.info("Фоновый опрос принтеров кухонных марок отключен")
+            return
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def probe(self, address):
+        """Опросить принтер (блокирующий вызов)"""
+        started = time.monotonic()
+        result = {'printer': address, 'connected': False, 'ready': False, 'responded': False,
+                  **parse_status(None), 'error': None}
+        try:
+            replies = self.pool.query(address, (STATUS_PRINTER, STATUS_OFFLINE, STATUS_PAPER), self.timeout)
+            result['connected'] = True
+            result['responded'] = replies is not None
+            result.update(parse_status(replies))
+            result['ready'] = not (result['offline'] or result['cover_open'] or result['paper_out'])
+        except Exception as e:
+            result['error'] = str(e)
+        result['latency_ms'] = round((time.monotonic() - started) * 1000, 1)
+        result['checked_at'] = datetime.now().isoformat()
+        result['checked'] = time.monotonic()
+        return result
+
+    async def refresh(self, addresses=None):
+        """Опросить принтеры немедленно (все известные или указанные)"""
+        if addresses is None:
+            addresses = await self.addresses()
+        results = await asyncio.gather(*[asyncio.to_thread(self.probe, address) for address in addresses])
+        for result in results:
+            address = result['printer']
+            previous = self._status.get(address)
+            self._status[address] = result
+            if previous is not None and previous['ready'] == result['ready']:
+                continue
+            if result['ready']:
+                if previous is not None:
+                    logger.info(f"Принтер {address} снова готов к печати")
+            else:
+                logger.warning(f"Принтер {address} не готов к печати: {self.describe(result)}")
+            if self.on_change:
+                self.on_change(address, result['ready'])
+        return results
+
+    @staticmethod
+    def describe(result):
+        if not result['connected']:
+            return f"нет подключения ({result['error']})"
+        problems = [text for key, text in (
+            ('offline', "offline"), ('cover_open', "открыта крышка"),
+            ('paper_out', "нет бумаги"), ('printer_error', "ошибка принтера")
+        ) if result.get(key)]
+        return ", ".join(problems) or "готов"
+
+    def ready(self, address):
+        """Принтер готов по последнему опросу (нет свежих данных - считаем готовым)"""
+        result = self._status.get(address)
+        if result is None or time.monotonic() - result['checked'] > self.max_age:
+            return True
+        return result['ready']
+
+    def status(self):
+        """Последние результаты опроса с возрастом в секундах"""
+        now = time.monotonic()
+        return [
+            {**{key: value for key, value in result.items() if key != 'checked'},
+             'age': round(now - result['checked'], 1)}
+            for result in self._status.values()
+        ]
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Ошибка опроса принтеров: {e}")
+            await asyncio.sleep(self.interval)
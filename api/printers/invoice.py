@@ -0,0 +1,20 @@
+from api.templates import PRINT_FEED, PRINT_WIDE
+
+from .commands import ESC_INIT, FS_CHINESE_OFF, CODEPAGE_CP866, CUT_PARTIAL, size, feed, encode
+
+
+def render_invoice(ops):
+    """
+    Счет, отрисованный по шаблону (InvoiceTemplate.render), в буфер ESC/POS:
+    широкие строки - двойной ширины, в конце частичная обрезка
+    """
+    data = bytearray(ESC_INIT + FS_CHINESE_OFF + CODEPAGE_CP866)
+    for kind, value in ops:
+        if kind == PRINT_FEED:
+            data += feed(value)
+        elif kind == PRINT_WIDE:
+            data += size(width=2) + encode(value) + b'\n' + size()
+        else:
+            data += encode(value) + b'\n'
+    data += CUT_PARTIAL
+    return bytes(data)
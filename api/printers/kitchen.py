@@ -0,0 +1,60 @@
+from datetime import datetime
+from functools import lru_cache
+
+from .commands import (
+    FS_CHINESE_OFF, CODEPAGE_CP866, ALIGN_LEFT, ALIGN_CENTER, CUT_PARTIAL,
+    size, feed, encode
+)
+
+TICKET_WIDTH = 48  # Символов в строке шрифтом A на ленте 80 мм
+NAME_WIDTH = 35  # Длинные названия блюд обрезаются
+
+# Начало марки: китайский режим выключен, CP866, заголовок по центру двойной ширины
+TICKET_HEADER = FS_CHINESE_OFF + CODEPAGE_CP866 + ALIGN_CENTER + size(2, 1)
+
+
+@lru_cache(maxsize=8)
+def _separator(width):
+    return encode("=" * width) + b'\n'
+
+
+@lru_cache(maxsize=32)
+def _kitchen_banner(kitchen_type):
+    """Тип кухни ("КУХНЯ", "БАР") крупным шрифтом; после него - обычный текст слева"""
+    return size(2, 2) + encode(f"== {kitchen_type.upper()} ==") + b'\n' + ALIGN_LEFT + size()
+
+
+@lru_cache(maxsize=8)
+def _footer(width):
+    """Конец марки: разделитель, подача и частичная обрезка"""
+    return _separator(width) + feed(2) + feed(6) + CUT_PARTIAL + feed(2)
+
+
+def dotted_line(name, quantity, width=TICKET_WIDTH):
+    """Строка позиции: название, точки до правого края и количество"""
+    name = name[:NAME_WIDTH]
+    qty_str = f"{quantity} шт"
+    dots = "." * (width - len(name) - len(qty_str))
+    return f"{name}{dots}{qty_str}"
+
+
+def render_kitchen_ticket(order, now=None, width=TICKET_WIDTH):
+    """
+    Кухонная марка одним буфером ESC/POS (отправляется на принтер одной записью)
+
+    :param order: KitchenMarkRequest
+    :param now: время печати (по умолчанию - текущее)
+    """
+    now = (now or datetime.now()).strftime("%d.%m.%Y %H:%M")
+    separator = _separator(width)
+    data = bytearray(TICKET_HEADER)
+    data += encode(f"ЗАКАЗ №{order.order_number}") + b'\n'
+    data += _kitchen_banner(order.kitchen_type)
+    data += separator
+    data += encode(f"СТОЛ: {order.table_number:<5}   ОФИЦИАНТ: {order.waiter_name:<20}") + b'\n'
+    data += encode(f"ВРЕМЯ: {now}") + b'\n'
+    data += separator
+    for item in order.products or []:
+        data += encode(dotted_line(item.name, item.kolvo, width)) + b'\n'
+    data += _footer(width)
+    return bytes(data)
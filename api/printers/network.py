@@ -0,0 +1,7 @@
+DEFAULT_PORT = 9100
+
+
+def parse_address(address):
+    """Адрес принтера "host[:port]" -> (host, port)"""
+    host, _, port = address.strip().partition(':')
+    return host, int(port) if port else DEFAULT_PORT
@@ -0,0 +1,202 @@
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from escpos.exceptions import DeviceNotFoundError
+from escpos.printer import Network
+from loguru import logger
+
+from .network import parse_address
+
+
+class PrinterConnection:
+    """
+    Постоянное подключение к сетевому ESC/POS-принтеру.
+
+    Сокет открывается при первой печати и переиспользуется: TCP keepalive
+    держит его открытым, TCP_NODELAY отключает задержку Nagle для коротких
+    команд. Закрытое принтером подключение обнаруживается перед печатью и
+    открывается заново. Блокировка не дает перемешаться двум билетам.
+    """
+
+    def __init__(self, address, timeout=5, idle_timeout=300):
+        self.address = address
+        self.host, self.port = parse_address(address)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.printer = None
+        self.last_used = None
+        self.connects = 0
+        self.last_error = None
+
+    def _open(self):
+        printer = Network(self.host, port=self.port, timeout=self.timeout)
+        try:
+            printer.open()
+        except DeviceNotFoundError as e:
+            # escpos оборачивает ошибку сокета в свое исключение - приводим к OSError, как ошибки записи
+            raise ConnectionError(f"Нет подключения к принтеру {self.address}: {e}") from e
+        sock = printer.device
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        self.printer = printer
+        self.connects += 1
+        logger.info(f"Подключение к принтеру {self.address} открыто")
+
+    def _alive(self):
+        """Сокет не закрыт принтером (проверка без блокировки)"""
+        sock = self.printer.device
+        try:
+            sock.setblocking(False)
+            try:
+                return sock.recv(1, socket.MSG_PEEK) != b''
+            except BlockingIOError:
+                return True
+            finally:
+                sock.settimeout(self.timeout)
+        except OSError:
+            return False
+
+    def _ensure(self):
+        if self.printer is not None:
+            idle = time.monotonic() - self.last_used if self.last_used else 0
+            if idle > self.idle_timeout or not self._alive():
+                self.close()
+        if self.printer is None:
+            self._open()
+
+    def close(self):
+        if self.printer is None:
+            return
+        try:
+            self.printer.close()
+        except Exception:
+            pass
+        self.printer = None
+
+    @contextmanager
+    def acquire(self):
+        """Принтер (escpos Network) под блокировкой; при ошибке подключение сбрасывается"""
+        with self.lock:
+            try:
+                self._ensure()
+                yield self.printer
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                self.close()
+                raise
+            finally:
+                self.last_used = time.monotonic()
+
+    def send(self, data):
+        """
+        Отправить готовый буфер одной записью. Если подключение оборвалось до
+        отправки, переподключаемся и повторяем один раз.
+        """
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    self._ensure()
+                    self.printer._raw(data)
+                    self.last_error = None
+                    self.last_used = time.monotonic()
+                    return
+                except OSError as e:
+                    self.last_error = str(e)
+                    self.close()
+                    if attempt == 2:
+                        raise
+                    logger.warning(f"Ошибка печати на {self.address}: {e}, переподключаемся")
+
+    def query(self, commands, timeout=1):
+        """
+        Запросы реального времени (DLE EOT), на каждый принтер отвечает одним байтом
+
+        :return: список байтов ответа или None, если принтер не ответил за timeout
+            (подключение при этом сохраняется - не все принтеры поддерживают DLE EOT)
+        """
+        with self.acquire() as printer:
+            sock = printer.device
+            # Отбрасываем запоздавшие ответы прошлых запросов
+            sock.setblocking(False)
+            try:
+                while sock.recv(64):
+                    pass
+            except BlockingIOError:
+                pass
+            sock.settimeout(timeout)
+            try:
+                replies = []
+                for command in commands:
+                    sock.sendall(command)
+                    reply = sock.recv(1)
+                    if not reply:
+                        raise ConnectionError("Принтер закрыл подключение")
+                    replies.append(reply[0])
+                return replies
+            except socket.timeout:
+                return None
+            finally:
+                sock.settimeout(self.timeout)
+
+    def status(self):
+        return {
+            'address': self.address,
+            'connected': self.printer is not None,
+            'busy': self.lock.locked(),
+            'connects': self.connects,
+            'idle': round(time.monotonic() - self.last_used, 1) if self.last_used else None,
+            'last_error': self.last_error
+        }
+
+
+class PrinterPool:
+    """
+    Пул подключений к сетевым принтерам: одно подключение на адрес host[:port].
+    Методы блокирующие - из async-кода вызываются через asyncio.to_thread.
+    """
+
+    def __init__(self, timeout=5, idle_timeout=300):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def get(self, address):
+        with self._lock:
+            connection = self._connections.get(address)
+            if connection is None:
+                connection = PrinterConnection(address, self.timeout, self.idle_timeout)
+                self._connections[address] = connection
+            return connection
+
+    def send(self, address, data):
+        """Отправить буфер ESC/POS на принтер"""
+        self.get(address).send(data)
+
+    def query(self, address, commands, timeout=1):
+        """Запросы состояния принтера (см. PrinterConnection.query)"""
+        return self.get(address).query(commands, timeout)
+
+    def printer(self, address):
+        """Контекстный менеджер с принтером escpos под блокировкой"""
+        return self.get(address).acquire()
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+        for connection in connections:
+            with connection.lock:
+                connection.close()
+
+    def status(self):
+        with self._lock:
+            connections = list(self._connections.values())
+        return [connection.status() for connection in connections]
@@ -0,0 +1,234 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from collections import deque
+from itertools import count
+
+from loguru import logger
+
+
+class KitchenQueue:
+    """
+    Очередь кухонных марок с сохранением на диск, своя для каждого принтера.
+
+    Марка записывается в каталог очереди (один JSON-файл, fsync) до ответа
+    клиенту и удаляется только после отправки на принтер, поэтому переживает
+    перезапуск сервиса. Для каждого принтера работает отдельная задача: марки
+    отправляются строго по порядку, при ошибке первая марка повторяется с
+    растущей паузой (retry_base * 2^n, не больше retry_max), остальные ждут.
+    Недоступный принтер не задерживает ответы API и другие принтеры.
+    """
+
+    def __init__(self, directory, send, retry_base=2, retry_max=60, ready=None):
+        """
+        :param directory: каталог очереди
+        :param send: send(address, data) - блокирующая отправка буфера на принтер
+        :param ready: ready(address) -> False, если принтер заведомо не готов
+            (по данным опроса) - марка ждет без попытки подключения
+        """
+        self.directory = directory
+        self.send = send
+        self.ready = ready
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._queues = {}  # адрес -> deque марок в порядке поступления
+        self._state = {}  # адрес -> попытки, последняя ошибка, время следующей попытки
+        self._locks = {}
+        self._workers = {}
+        self._wakeups = {}
+        self._seq = count()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, ticket_id):
+        return os.path.join(self.directory, f"{ticket_id}.json")
+
+    def _write(self, ticket):
+        """Атомарная запись марки: временный файл, fsync, переименование"""
+        record = {key: value for key, value in ticket.items() if key != 'data'}
+        record['data'] = base64.b64encode(ticket['data']).decode('ascii')
+        path = self._path(ticket['id'])
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _remove(self, ticket):
+        try:
+            os.remove(self._path(ticket['id']))
+        except FileNotFoundError:
+            pass
+
+    def _lock(self, address):
+        lock = self._locks.get(address)
+        if lock is None:
+            lock = self._locks[address] = asyncio.Lock()
+        return lock
+
+    def wake(self, address):
+        """Прервать паузу перед повтором (принтер снова готов)"""
+        event = self._wakeups.get(address)
+        if event is not None:
+            event.set()
+
+    def _ensure_worker(self, address):
+        worker = self._workers.get(address)
+        if worker is None or worker.done():
+            self._workers[address] = asyncio.create_task(self._worker(address))
+
+    def load(self):
+        """Марки, оставшиеся в каталоге после перезапуска"""
+        loaded = 0
+        known = {ticket['id'] for queue in self._queues.values() for ticket in queue}
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                # Марка не успела записаться - клиент не получил подтверждения
+                os.remove(path)
+                continue
+            if not name.endswith(".json") or name[:-len(".json")] in known:
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    ticket = json.load(f)
+                ticket['data'] = base64.b64decode(ticket['data'])
+            except Exception as e:
+                logger.error(f"Поврежденная марка в очереди {path}: {e}")
+                os.replace(path, path + ".bad")
+                continue
+            self._queues.setdefault(ticket['printer'], deque()).append(ticket)
+            loaded += 1
+        if loaded:
+            logger.warning(f"В очереди кухонных марок осталось {loaded} марок, продолжаем печать")
+        return loaded
+
+    def start(self):
+        self.load()
+        for address, queue in self._queues.items():
+            if queue:
+                self._ensure_worker(address)
+
+    async def stop(self):
+        workers = [worker for worker in self._workers.values() if not worker.done()]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def enqueue(self, address, data, **meta):
+        """
+        Поставить марку в очередь принтера (марка уже на диске, когда метод вернулся)
+
+        :param data: буфер ESC/POS
+        :param meta: данные для статуса (номер заказа, станция)
+        :return: dict марки без буфера
+        """
+        ticket = {
+            'id': f"{time.time_ns():020d}-{next(self._seq):06d}",
+            'printer': address,
+            'created_at': time.time(),
+            'data': data,
+            **meta
+        }
+        await asyncio.to_thread(self._write, ticket)
+        self._queues.setdefault(address, deque()).append(ticket)
+        self._ensure_worker(address)
+        return self._public(ticket)
+
+    async def _worker(self, address):
+        queue = self._queues[address]
+        state = self._state.setdefault(address, {'attempts': 0, 'last_error': None, 'retry_at': None})
+        while queue:
+            ticket = queue[0]
+            delay = None
+            async with self._lock(address):
+                # Пока ждали блокировку, очередь могли перенаправить
+                if not queue or queue[0] is not ticket:
+                    continue
+                try:
+                    if self.ready is not None and not self.ready(address):
+                        raise ConnectionError("принтер не готов по данным опроса")
+                    await asyncio.to_thread(self.send, address, ticket['data'])
+                except Exception as e:
+                    state['attempts'] += 1
+                    state['last_error'] = str(e)
+                    delay = min(self.retry_max, self.retry_base * 2 ** (state['attempts'] - 1))
+                    state['retry_at'] = time.time() + delay
+                    logger.warning(f"Принтер {address} недоступен ({e}), марка {ticket.get('order_number')} "
+                                   f"ждет в очереди ({len(queue)}), повтор через {delay} с")
+                else:
+                    queue.popleft()
+                    await asyncio.to_thread(self._remove, ticket)
+                    if state['attempts']:
+                        logger.info(f"Принтер {address} снова доступен после {state['attempts']} попыток")
+                    state.update(attempts=0, last_error=None, retry_at=None)
+            if delay is not None:
+                event = self._wakeups[address] = asyncio.Event()
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._wakeups.pop(address, None)
+
+    async def reroute(self, source, target):
+        """
+        Перенести все марки очереди source на принтер target (с сохранением порядка)
+
+        :return: число перенесенных марок
+        """
+        if source == target:
+            return 0
+        # Блокировки берутся в одном порядке, чтобы встречные переносы не заблокировали друг друга
+        first, second = sorted((source, target))
+        async with self._lock(first), self._lock(second):
+            moved = list(self._queues.get(source) or [])
+            if not moved:
+                return 0
+            for ticket in moved:
+                ticket['printer'] = target
+                await asyncio.to_thread(self._write, ticket)
+            self._queues[source].clear()
+            self._state.pop(source, None)
+            merged = sorted(list(self._queues.get(target) or []) + moved, key=lambda ticket: ticket['id'])
+            queue = self._queues.setdefault(target, deque())
+            queue.clear()
+            queue.extend(merged)
+        logger.warning(f"Очередь кухонных марок {source} перенаправлена на {target}: {len(moved)} марок")
+        self.wake(source)
+        self.wake(target)
+        self._ensure_worker(target)
+        return len(moved)
+
+    @staticmethod
+    def _public(ticket):
+        return {key: value for key, value in ticket.items() if key != 'data'}
+
+    def status(self):
+        """Глубина очереди, возраст самой старой марки и ошибки по принтерам"""
+        now = time.time()
+        result = []
+        for address, queue in self._queues.items():
+            state = self._state.get(address, {})
+            result.append({
+                'printer': address,
+                'depth': len(queue),
+                'oldest_age': round(now - queue[0]['created_at'], 1) if queue else None,
+                'oldest_order': queue[0].get('order_number') if queue else None,
+                'attempts': state.get('attempts', 0),
+                'last_error': state.get('last_error'),
+                'retry_in': round(max(0, state['retry_at'] - now), 1) if state.get('retry_at') else None
+            })
+        return result
+
+    def printers(self):
+        """Адреса принтеров, для которых есть очередь"""
+        return list(self._queues)
+
+    def pending(self, address=None):
+        """Марки в очереди (без буферов)"""
+        addresses = [address] if address else list(self._queues)
+        return [self._public(ticket) for name in addresses for ticket in self._queues.get(name, ())]
@@ -0,0 +1,141 @@
+import asyncio
+
+from loguru import logger
+
+
+def resolve_stations(categories):
+    """
+    Станции категорий с наследованием от родителя
+
+    :param categories: {id: (parent_id, станция, принтер)}
+    :return: {id: (станция, принтер)} - только категории, у которых (или у предка) задан принтер
+    """
+    resolved = {}
+    for category_id in categories:
+        chain = []
+        current = category_id
+        route = None
+        # Поднимаемся к ближайшему предку с принтером; цикл в иерархии прерывается
+        while current in categories and current not in chain:
+            if current in resolved:
+                route = resolved[current]
+                break
+            chain.append(current)
+            parent_id, station, printer = categories[current]
+            if printer:
+                route = (station or "КУХНЯ", printer)
+                break
+            current = parent_id
+        for passed in chain:
+            resolved[passed] = route
+    return {category_id: route for category_id, route in resolved.items() if route}
+
+
+class KitchenRouter:
+    """
+    Маршрутизация кухонных марок: позиция заказа -> товар -> категория ->
+    станция (бар, горячий цех, холодный цех) и ее принтер.
+
+    Карта маршрутов строится из БД один раз и хранится в памяти до вызова
+    invalidate() (изменение категорий или товаров). Позиции ищутся по коду
+    товара (product = legacy_id товара), затем по штрихкоду и по названию.
+    """
+
+    def __init__(self, load, default_printer=None, default_station="КУХНЯ", ready=None):
+        """
+        :param load: async load() -> (категории {id: (parent_id, станция, принтер)},
+            товары [(legacy_id, штрихкод, название, category_id)])
+        :param default_printer: принтер для позиций без маршрута (None - не печатать)
+        :param ready: ready(address) -> False, если принтер заведомо не готов; марки
+            станции с неготовым принтером печатаются на принтере по умолчанию
+        """
+        self.load = load
+        self.default_printer = default_printer
+        self.default_station = default_station
+        self.ready = ready
+        self._routes = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        """Сбросить карту маршрутов (перестроится при следующей печати)"""
+        self._generation += 1
+        self._routes = None
+
+    async def routes(self):
+        routes = self._routes
+        if routes is not None:
+            return routes
+        async with self._lock:
+            if self._routes is not None:
+                return self._routes
+            generation = self._generation
+            try:
+                categories, products = await self.load()
+            except Exception as e:
+                logger.error(f"Ошибка загрузки маршрутов кухонных марок: {e}")
+                categories, products = {}, []
+            stations = resolve_stations(categories)
+            routes = {'product': {}, 'barcode': {}, 'name': {}}
+            for legacy_id, barcode, name, category_id in products:
+                route = stations.get(category_id)
+                if route is None:
+                    continue
+                for kind, key in (('product', legacy_id), ('barcode', barcode), ('name', name)):
+                    key = (key or "").strip()
+                    if key:
+                        routes[kind].setdefault(key, route)
+            # Карту, устаревшую во время загрузки, не запоминаем
+            if generation == self._generation:
+                self._routes = routes
+                logger.info(f"Маршруты кухонных марок загружены: {len(stations)} категорий, {len(routes['product'])} товаров")
+            return routes
+
+    def _route(self, routes, item):
+        for kind, key in (('product', item.product), ('barcode', item.EAN), ('name', item.name)):
+            route = routes[kind].get((key or "").strip())
+            if route:
+                station, printer = route
+                if (self.ready is not None and self.default_printer and printer != self.default_printer
+                        and not self.ready(printer) and self.ready(self.default_printer)):
+                    # Название станции остается на марке, чтобы ее передали по назначению
+                    return station, self.default_printer
+                return route
+        if self.default_printer:
+            return self.default_station, self.default_printer
+        return None
+
+    async def split(self, products):
+        """
+        Разбить позиции заказа по станциям
+
+        :return: ({(станция, принтер): [позиции]}, [позиции без маршрута])
+        """
+        routes = await self.routes()
+        stations = {}
+        unrouted = []
+        for item in products or []:
+            route = self._route(routes, item)
+            if route is None:
+                unrouted.append(item)
+            else:
+                stations.setdefault(route, []).append(item)
+        return stations, unrouted
+
+    async def printers(self):
+        """Принтеры станций (и принтер по умолчанию)"""
+        routes = await self.routes()
+        printers = {printer for kind in routes.values() for _, printer in kind.values()}
+        if self.default_printer:
+            printers.add(self.default_printer)
+        return printers
+
+    def as_dict(self):
+        routes = self._routes
+        if routes is None:
+            return {'loaded': False}
+        return {
+            'loaded': True,
+            'default': {'station': self.default_station, 'printer': self.default_printer} if self.default_printer else None,
+            'products': {key: {'station': station, 'printer': printer} for key, (station, printer) in routes['product'].items()}
+        }
@@ -0,0 +1,214 @@
+import os
+import string
+import threading
+
+from loguru import logger
+
+# Разметка счета по умолчанию (повторяет прежний макет счета)
+DEFAULT_INVOICE_TEMPLATE = """\
+[header]
+
+^{org_title}
+
+!    СЧЕТ #{num}
+
+ЗАЛ {hall}
+СТОЛ {table}
+Официант {waiter}
+Счет открыт {create}
+
+^Блюда
+[item]
+{name_upper}...{kolvo}x{price}  {amount_full}
+
+[footer]
+?discount @feed 2
+?discount Скидка .. {discount}%
+?capped В чеке присутствуют товары скидка на которые не распространяется!
+?discount Сумма чека без скидки .. {total_full}
+@feed 2
+!ИТОГО К ОПЛАТЕ .. {total}
+@feed 15
+"""
+
+SECTIONS = ('header', 'item', 'footer')
+CONDITIONS = ('discount', 'capped')
+ORDER_FIELDS = {'org_title', 'num', 'hall', 'table', 'waiter', 'create', 'discount', 'total_full', 'total', 'width'}
+ITEM_FIELDS = ORDER_FIELDS | {'name', 'name_upper', 'kolvo', 'price', 'unit_price', 'amount_full', 'amount'}
+
+# Операции печати: строка, широкая строка, подача N строк
+PRINT_TEXT = 'text'
+PRINT_WIDE = 'wide'
+PRINT_FEED = 'feed'
+
+
+class InvoiceTemplate:
+    """
+    Скомпилированный шаблон счета.
+
+    Строки шаблона разбиты на секции [header], [item] (повторяется для каждой
+    позиции) и [footer]. Строка - формат str.format с полями заказа; префиксы:
+    "?discount " / "?capped " - только при скидке / ограничении скидки,
+    "!" - широкая строка, "^" - по центру ширины ленты, "@feed N" - подача
+    N строк, пустая строка - подача одной строки.
+    """
+
+    def __init__(self, source, width=45, name="default"):
+        self.name = name
+        self.width = width
+        self.sections = {section: [] for section in SECTIONS}
+        self._compile(source)
+
+    def _compile(self, source):
+        section = None
+        formatter = string.Formatter()
+        for number, raw in enumerate(source.splitlines(), 1):
+            line = raw.rstrip("\r\n")
+            if line.startswith('#'):
+                continue
+            if line.startswith('[') and line.strip().endswith(']'):
+                section = line.strip()[1:-1]
+                if section not in SECTIONS:
+                    raise ValueError(f"Шаблон {self.name}, строка {number}: неизвестная секция [{section}]")
+                continue
+            if section is None:
+                if line.strip():
+                    raise ValueError(f"Шаблон {self.name}, строка {number}: строка вне секции")
+                continue
+
+            condition = None
+            if line.startswith('?'):
+                condition, _, line = line[1:].partition(' ')
+                if condition not in CONDITIONS:
+                    raise ValueError(f"Шаблон {self.name}, строка {number}: неизвестное условие ?{condition}")
+
+            if not line.strip():
+                self.sections[section].append((condition, PRINT_FEED, 1, False))
+                continue
+            if line.startswith('@feed'):
+                self.sections[section].append((condition, PRINT_FEED, int(line.split()[1]), False))
+                continue
+
+            kind = PRINT_TEXT
+            if line.startswith('!'):
+                kind, line = PRINT_WIDE, line[1:]
+            center = line.startswith('^')
+            if center:
+                line = line[1:]
+            allowed = ITEM_FIELDS if section == 'item' else ORDER_FIELDS
+            for _, field, _, _ in formatter.parse(line):
+                if field is not None and field.split('.')[0].split('[')[0] not in allowed:
+                    raise ValueError(f"Шаблон {self.name}, строка {number}: неизвестное поле {{{field}}}")
+            self.sections[section].append((condition, kind, line, center))
+
+    def _emit(self, ops, section, fields, flags):
+        for condition, kind, value, center in self.sections[section]:
+            if condition and not flags[condition]:
+                continue
+            if kind == PRINT_FEED:
+                # Подряд идущие подачи - одна команда FeedDocument
+                if ops and ops[-1][0] == PRINT_FEED:
+                    ops[-1] = (PRINT_FEED, ops[-1][1] + value)
+                else:
+                    ops.append((PRINT_FEED, value))
+                continue
+            text = value.format(**fields)
+            if center and len(text) < self.width:
+                # Лишний пробел - справа, как в прежнем макете
+                left = (self.width - len(text)) // 2
+                text = " " * left + text + " " * (self.width - len(text) - left)
+            ops.append((kind, text))
+
+    def render(self, order, priced, org_title=""):
+        """
+        Счет целиком
+
+        :param priced: расчет заказа (price_order)
+        :return: список операций печати [(PRINT_TEXT|PRINT_WIDE, строка) | (PRINT_FEED, число строк)]
+        """
+        fields = {
+            'org_title': org_title,
+            'num': (order.num or "").strip(),
+            'hall': (order.hall or "").strip(),
+            'table': (order.table or "").strip(),
+            'waiter': (order.waiter or "").strip(),
+            'create': (order.create or "").strip(),
+            'discount': order.alldiscount,
+            'total_full': priced.total_full,
+            'total': priced.total,
+            'width': self.width
+        }
+        flags = {'discount': priced.has_discount, 'capped': priced.has_capped}
+        ops = []
+        self._emit(ops, 'header', fields, flags)
+        for line in priced.lines:
+            item = line.item
+            self._emit(ops, 'item', {
+                **fields,
+                'name': item.name,
+                'name_upper': item.name.upper(),
+                'kolvo': item.kolvo,
+                'price': item.price,
+                'unit_price': line.unit_price,
+                'amount_full': line.amount_full,
+                'amount': line.amount
+            }, flags)
+        self._emit(ops, 'footer', fields, flags)
+        return ops
+
+
+class InvoiceTemplates:
+    """
+    Кэш скомпилированных шаблонов счета по залам.
+
+    Шаблон зала - файл "<каталог>/<зал>.txt", иначе "<каталог>/default.txt",
+    иначе встроенный макет. Файл перекомпилируется при изменении (по mtime),
+    перезапуск сервиса не нужен. Шаблон с ошибкой не заменяет рабочий.
+    """
+
+    def __init__(self, directory, width=45):
+        self.directory = directory
+        self.width = width
+        self._lock = threading.Lock()
+        self._compiled = {}  # путь -> (mtime, InvoiceTemplate)
+        self._default = InvoiceTemplate(DEFAULT_INVOICE_TEMPLATE, width)
+
+    def _path(self, venue):
+        names = [venue.strip()] if venue and venue.strip() else []
+        names.append("default")
+        root = os.path.realpath(self.directory)
+        for name in names:
+            # Имя зала приходит из заказа - пути и выход из каталога шаблонов не допускаются
+            if os.sep in name or "/" in name or "\\" in name or ".." in name:
+                logger.warning(f"Недопустимое имя зала для шаблона счета: {name!r}")
+                continue
+            path = os.path.join(self.directory, f"{name}.txt")
+            if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                continue
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def get(self, venue=None):
+        """Шаблон зала (с перезагрузкой измененного файла)"""
+        path = self._path(venue)
+        if path is None:
+            return self._default
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return self._default
+        with self._lock:
+            cached = self._compiled.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            try:
+                with open(path, encoding="utf-8") as f:
+                    template = InvoiceTemplate(f.read(), self.width, name=os.path.basename(path))
+            except Exception as e:
+                logger.error(f"Ошибка шаблона счета {path}: {e}")
+                # Оставляем последнюю рабочую версию шаблона
+                return cached[1] if cached else self._default
+            self._compiled[path] = (mtime, template)
+            logger.info(f"Шаблон счета {path} загружен")
+            return template
@@ -0,0 +1,71 @@
+"""
+Сравнение скорости построения XML чека ChequeV3 для ЕГАИС:
+прежний построитель на xml.etree.ElementTree и ChequeBuilder на lxml
+(кэшированный каркас документа). Чеки на 1, 10 и 100 бутылок.
+
+Запуск: python bench_egais_xml.py [--number N]
+"""
+
+import argparse
+import os
+import timeit
+import xml.etree.ElementTree as ET
+
+from lxml import etree
+
+from api.egais import ChequeBuilder
+
+BARCODE = "1873298622547801250013I53GGTQ5VR6LZ5HW2IX53O7NM3KIM6UEVMGWJZXZH3ZYWLL5UCNGCBSAY5FHUWXHLH3WWAMV7TEUPZRHIAE5FHV3WMBY456AVVNP5FBSW32CWGFX43YOHC6CP6QKLBXQ"
+HEADER = ("2025-09-12T10:19:00", "0522810008012872", "300", "8304", "Продажа")
+
+
+def build_etree(date, kassa, shift, number, cheque_type, bottles):
+    """Прежний построитель: весь документ собирается заново, FSRAR_ID читается из окружения"""
+    fsrar_id = os.getenv("FSRAR_ID", "020000347275")
+    documents = ET.Element("ns:Documents")
+    documents.set("Version", "1.0")
+    documents.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    documents.set("xmlns:ns", "http://fsrar.ru/WEGAIS/WB_DOC_SINGLE_01")
+    documents.set("xmlns:ck", "http://fsrar.ru/WEGAIS/ChequeV3")
+    documents.set("xmlns:oref", "http://fsrar.ru/WEGAIS/ClientRef_v2")
+    documents.set("xmlns:pref", "http://fsrar.ru/WEGAIS/ProductRef_v2")
+    owner = ET.SubElement(documents, "ns:Owner")
+    ET.SubElement(owner, "ns:FSRAR_ID").text = fsrar_id
+    document = ET.SubElement(documents, "ns:Document")
+    cheque = ET.SubElement(document, "ns:ChequeV3")
+    header = ET.SubElement(cheque, "ck:Header")
+    for tag, value in zip(("ck:Date", "ck:Kassa", "ck:Shift", "ck:Number", "ck:Type"),
+                          (date, kassa, shift, number, cheque_type)):
+        ET.SubElement(header, tag).text = value
+    content = ET.SubElement(cheque, "ck:Content")
+    for barcode, ean, price in bottles:
+        bottle = ET.SubElement(content, "ck:Bottle")
+        ET.SubElement(bottle, "ck:Barcode").text = barcode
+        ET.SubElement(bottle, "ck:EAN").text = ean
+        ET.SubElement(bottle, "ck:Price").text = price
+    return ET.tostring(documents, encoding='utf-8', xml_declaration=True)
+
+
+def canonical(xml_bytes):
+    return etree.tostring(etree.fromstring(xml_bytes), method="c14n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость построения XML чека ЕГАИС")
+    parser.add_argument("--number", type=int, default=2000, help="повторов для каждого размера чека")
+    args = parser.parse_args()
+
+    builder = ChequeBuilder(os.getenv("FSRAR_ID", "020000347275"))
+    print(f"{'бутылок':>8} {'ElementTree, мкс':>17} {'lxml, мкс':>10} {'ускорение':>10}")
+    for size in (1, 10, 100):
+        bottles = [(BARCODE, "4603514002407", f"{1500 + i}.00") for i in range(size)]
+        # Построители должны давать один и тот же документ
+        assert canonical(build_etree(*HEADER, bottles)) == canonical(builder.build(*HEADER, bottles))
+        number = max(1, args.number // size)
+        old = min(timeit.repeat(lambda: build_etree(*HEADER, bottles), number=number, repeat=5)) / number
+        new = min(timeit.repeat(lambda: builder.build(*HEADER, bottles), number=number, repeat=5)) / number
+        print(f"{size:>8} {old * 1e6:>17.1f} {new * 1e6:>10.1f} {old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,23 @@
 from typing import Union, List, Optional
 from contextlib import asynccontextmanager
+import asyncio
 
-from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, status
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Header, status
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 import jwt
 from passlib.context import CryptContext
 
-from escpos.printer import Network
-
 from datetime import datetime, timedelta
 from loguru import logger
 
-try:
-    import win32com.client
-    WIN32_AVAILABLE = True
-except ImportError:
-    WIN32_AVAILABLE = False
-    logger.warning("win32com недоступен - функции ККТ отключены")
-    # Создаем заглушку для win32com
-    class MockWin32Com:
-        class client:
-            class CDispatch:
-                pass
-    win32com = MockWin32Com()
 import argparse
 import json
 
 from dotenv import load_dotenv
 import os
-import requests
 from lxml import etree
-import xml.etree.ElementTree as ET
 import time
 import traceback
 
@@ -63,17 +49,129 @@ logger.add(
     format="{time:HH:mm:ss} | {level} | {message}"
 )
 
-# Глобальные переменные для кэширования данных ККТ
-KKT_CACHE = {
-    'INN': None,
-    'KKTRegistrationNumber': None,
-    'KKTSerialNumber': None,
-    'FNSerialNumber': None,
-    'initialized': False
-}
-
 # Импорт моделей из api.models
-from api.models import CheckLog, EgaisLog, Category, Product, User, Area, Seat
+from api.models import CheckLog, EgaisLog, Category, Product, User, Area, Seat, PaymentIdempotency, EgaisOutbox
+from api.kkt import (
+    KktPool, KktQueueFull, KktTimeout, KktDeviceNotFound, KktStatusPoller, FiscalDriver,
+    PRIORITY_PAYMENT, PRIORITY_PRINT, PRIORITY_REPORT, begin_trace, end_trace,
+    FiscalJournal, reconcile, receipt_fiscalized
+)
+from api.pipeline import ReceiptPipeline
+from api.idempotency import IdempotencyRegistry
+from api.jobs import JobRegistry
+from api.pricing import price_order
+from api.templates import InvoiceTemplates, PRINT_FEED, PRINT_WIDE
+from api.egais import (
+    UtmClient, OutboxDispatcher, CircuitBreaker, ChequeBuilder, ChequeValidator, parse_utm_response, is_rejection,
+    validate_bottle_fields, receive_xml_upload
+)
+from api.printers import PrinterPool, PrinterProber, KitchenRouter, KitchenQueue, parse_address, render_invoice, render_kitchen_ticket
+
+# Пул ККТ: у каждой ККТ свой поток-владелец с одним подключением драйвера
+# (DRvFR или симулятор) на всё время жизни процесса и свой кэш реквизитов
+kkt_pool = KktPool.from_env(worker_options={
+    'maxsize': int(os.getenv('KKT_QUEUE_MAXSIZE', '100')),
+    'timeout': float(os.getenv('KKT_JOB_TIMEOUT', '60'))
+})
+
+# Журнал фискальных операций для восстановления после падения процесса
+fiscal_journal = FiscalJournal(os.getenv('KKT_JOURNAL_PATH', 'journal/fiscal.jsonl'))
+
+# Шаблоны счета по залам, перечитываются при изменении файла
+invoice_templates = InvoiceTemplates(os.getenv('INVOICE_TEMPLATES_DIR', 'templates/invoice'))
+
+# Сетевые принтеры счетов по залам: "зал:host[:port],..."; INVOICE_PRINTER - для остальных залов.
+# Если принтер не задан или недоступен, счет печатается на ККТ
+INVOICE_PRINTERS = {}
+for pair in os.getenv('INVOICE_PRINTERS', '').split(','):
+    if ':' in pair:
+        hall, _, address = pair.partition(':')
+        INVOICE_PRINTERS[hall.strip()] = address.strip()
+INVOICE_PRINTER = os.getenv('INVOICE_PRINTER', '').strip()
+
+# Постоянные подключения к сетевым принтерам (счета и кухонные марки)
+printer_pool = PrinterPool(
+    timeout=float(os.getenv('PRINTER_TIMEOUT', '5')),
+    idle_timeout=float(os.getenv('PRINTER_IDLE_TIMEOUT', '300'))
+)
+
+async def kitchen_printers():
+    """Принтеры кухонных марок для опроса: станции категорий и принтеры с очередью"""
+    printers = set(kitchen_queue.printers())
+    printers.update(await kitchen_router.printers())
+    return printers
+
+def on_printer_ready_change(address, ready):
+    # Марки, ждущие паузу перед повтором, печатаются сразу после восстановления принтера
+    if ready:
+        kitchen_queue.wake(address)
+
+# Фоновый опрос состояния принтеров кухонных марок (DLE EOT)
+printer_prober = PrinterProber(
+    printer_pool,
+    kitchen_printers,
+    interval=float(os.getenv('PRINTER_PROBE_INTERVAL', '10')),
+    timeout=float(os.getenv('PRINTER_PROBE_TIMEOUT', '1')),
+    on_change=on_printer_ready_change
+)
+
+# Очередь кухонных марок на диске: марка ждет недоступный принтер и переживает перезапуск
+kitchen_queue = KitchenQueue(
+    os.getenv('KITCHEN_QUEUE_DIR', 'queue/kitchen'),
+    printer_pool.send,
+    retry_base=float(os.getenv('KITCHEN_RETRY_BASE', '2')),
+    retry_max=float(os.getenv('KITCHEN_RETRY_MAX', '60')),
+    ready=printer_prober.ready
+)
+
+def on_utm_available():
+    """УТМ снова доступен: очередь ЕГАИС отправляет чеки, не дожидаясь паузы"""
+    egais_outbox.wake_all()
+
+# Автомат защиты УТМ: после серии ошибок чеки не ждут таймаута, а остаются в очереди до успешной проверки
+utm_breaker = CircuitBreaker(
+    "УТМ ЕГАИС",
+    failure_threshold=int(os.getenv('EGAIS_BREAKER_THRESHOLD', '3')),
+    probe=lambda: utm_client.probe(),
+    probe_interval=float(os.getenv('EGAIS_PROBE_INTERVAL', '5')),
+    health_interval=float(os.getenv('EGAIS_HEALTH_INTERVAL', '60')),
+    on_close=on_utm_available
+)
+
+# Клиент УТМ ЕГАИС: постоянные подключения, раздельные таймауты, ограничение одновременных запросов
+utm_client = UtmClient(
+    os.getenv('EGAIS_HOST', 'http://localhost:8080'),
+    connect_timeout=float(os.getenv('EGAIS_CONNECT_TIMEOUT', '3')),
+    read_timeout=float(os.getenv('EGAIS_READ_TIMEOUT', '15')),
+    max_concurrency=int(os.getenv('EGAIS_MAX_CONCURRENCY', '2')),
+    breaker=utm_breaker,
+    health_path=os.getenv('EGAIS_HEALTH_PATH', '/')
+)
+
+# Построитель XML чеков ЕГАИС: каркас документа с FSRAR_ID кэшируется
+egais_cheque_builder = ChequeBuilder(os.getenv("FSRAR_ID", "020000347275"))
+
+def load_egais_validator():
+    """XSD-схема чека ЕГАИС, скомпилированная один раз (None - проверка отключена)"""
+    if os.getenv('EGAIS_VALIDATE', 'true').lower() != 'true':
+        logger.info("Проверка XML чеков ЕГАИС по XSD-схеме отключена (EGAIS_VALIDATE != true)")
+        return None
+    path = os.getenv('EGAIS_SCHEMA', os.path.join('scheme', 'ChequeV3Documents.xsd'))
+    try:
+        return ChequeValidator(path)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки XSD-схемы чека ЕГАИС {path}, проверка отключена: {e}")
+        return None
+
+egais_validator = load_egais_validator()
+
+def validate_egais_xml(xml_data):
+    """Проверить XML чека по XSD-схеме перед отправкой в УТМ (ChequeValidationError при ошибке)"""
+    if egais_validator is not None:
+        egais_validator.validate(xml_data)
+
+# Фоновые этапы после закрытия чека: журнал, очередь ЕГАИС
+receipt_pipeline = ReceiptPipeline(max_orders=int(os.getenv('PIPELINE_HISTORY', '1000')))
 
 # Настройки безопасности
 SECRET_KEY = os.getenv("JWT_SECRET", "your-secret-key-change-in-production")
@@ -88,6 +186,18 @@ pwd_context = CryptContext(
 )
 security = HTTPBearer()
 
+# Новые колонки существующих таблиц: generate_schemas создает только отсутствующие таблицы
+SCHEMA_UPGRADES = [
+    "ALTER TABLE check_logs ADD COLUMN IF NOT EXISTS device_stats JSONB",
+    "ALTER TABLE categories ADD COLUMN IF NOT EXISTS kitchen_station VARCHAR(50)",
+    "ALTER TABLE categories ADD COLUMN IF NOT EXISTS kitchen_printer VARCHAR(100)",
+]
+
+async def upgrade_schema():
+    connection = Tortoise.get_connection("default")
+    for statement in SCHEMA_UPGRADES:
+        await connection.execute_script(statement)
+
 # Инициализация Tortoise ORM
 async def init_db():
     try:
@@ -96,6 +206,7 @@ async def init_db():
             modules={'models': ['api.models']}
         )
         await Tortoise.generate_schemas()
+        await upgrade_schema()
         logger.success("PostgreSQL подключен успешно")
         return True
     except Exception as e:
@@ -160,6 +271,12 @@ class KitchenMarkRequest(BaseModel):
     kitchen_type: str
     products: List[Item] = None
 
+class KitchenOrderRequest(BaseModel):
+    table_number: int
+    waiter_name: str
+    order_number: int
+    products: List[Item] = None
+
 # Инициализация БД при запуске
 db_connected = False
 
@@ -193,15 +310,56 @@ async def lifespan(app: FastAPI):
         else:
             logger.info("Инициализация тестовых данных отключена (INIT_TEST_DATA != true)")
     
-    # Инициализируем кэш данных ККТ
-    initialize_kkt_cache()
+    # Запускаем поток ККТ и инициализируем кэш данных ККТ
+    kkt_pool.start()
+    for device in kkt_pool.devices.values():
+        try:
+            await device.run(initialize_kkt_cache, device.cache, priority=PRIORITY_REPORT)
+        except Exception as e:
+            logger.error(f"Ошибка инициализации кэша ККТ {device.id}: {e}")
+    await recover_fiscal_journal()
+    if db_connected:
+        try:
+            await egais_outbox.start()
+        except Exception as e:
+            logger.error(f"Ошибка запуска очереди ЕГАИС: {e}")
+    kkt_status_poller.start()
+    kitchen_queue.start()
+    printer_prober.start()
+    if os.getenv('EGAIS_SEND', 'false').lower() == 'true':
+        utm_breaker.start()
     
     yield
     
-    # Shutdown (если нужно добавить закрытие соединений)
+    # Shutdown
+    await receipt_pipeline.drain()
+    await kkt_status_poller.stop()
+    kkt_pool.stop()
+    await printer_prober.stop()
+    await kitchen_queue.stop()
+    printer_pool.close()
+    await egais_outbox.stop()
+    await utm_breaker.stop()
+    await utm_client.close()
 
 app = FastAPI(lifespan=lifespan)
 
+@app.exception_handler(KktDeviceNotFound)
+async def kkt_not_found_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_404_NOT_FOUND,
+        content={"status": "error", "message": str(exc)}
+    )
+
+@app.exception_handler(KktQueueFull)
+@app.exception_handler(KktTimeout)
+async def kkt_busy_handler(request, exc):
+    logger.warning(f"ККТ занят: {exc}")
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "error", "message": "ККТ занят, повторите запрос позже", "error": str(exc)}
+    )
+
 # Функции авторизации
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -240,19 +398,11 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         )
     return user
 
-def add_spaces_to_45_chars(input_string): 
-    total_spaces = 45 - len(input_string)
-    left_spaces = total_spaces // 2
-    right_spaces = total_spaces - left_spaces
-    # Добавляем пробелы слева и справа
-    padded_string = " " * left_spaces + input_string + " " * right_spaces
-    return padded_string
-
-def get_ecr_mode(fr: win32com.client.CDispatch):
+def get_ecr_mode(fr: FiscalDriver):
     """
     Функция запроса режима кассы.
     
-    :param fr: объект драйвера кассы (CDispatch)
+    :param fr: объект драйвера кассы (DRvFR или симулятор)
     :return: Кортеж (int, str, int) — режим кассы, его описание и расширенный режим
     """
     fr.Password = 30
@@ -293,7 +443,7 @@ def send_user_details(fr, numdoc) -> None:
         fr.TagType = 7
         fr.TagValueStr = tag_value
         fr.FNSendTagOperation()
-    logger.debug(f"Отправка тегов пользователя: {fr.ResultCode}, {fr.ResultCodeDescription}")
+    logger.opt(lazy=True).debug("Отправка тегов пользователя: {}, {}", lambda: fr.ResultCode, lambda: fr.ResultCodeDescription)
     """
         Значение реквизита «отраслевой реквизит предмета расчета» 1260
         Значение реквизита «идентификатор ФОИВ» (тег 1262): 030
@@ -324,7 +474,7 @@ def save_check_result_file(prefix, content, error=None):
         f.write(content)
     return filepath
 
-async def save_check_result(status, message, error=None, order_data=None, result_code=None, result_description=None, document_number=None, fiscal_sign=None, legacynum=None):
+async def save_check_result(status, message, error=None, order_data=None, result_code=None, result_description=None, document_number=None, fiscal_sign=None, legacynum=None, device_stats=None):
     """
     Сохранить результат чека в БД, при ошибке - в файл
     """
@@ -346,6 +496,8 @@ async def save_check_result(status, message, error=None, order_data=None, result
             content += f"FiscalSign: {fiscal_sign}\n"
         if legacynum:
             content += f"legacynum: {legacynum}\n"
+        if device_stats:
+            content += f"DeviceStats: {json.dumps(device_stats, ensure_ascii=False)}\n"
         save_check_result_file("check", content, error)
         return False
     
@@ -359,7 +511,8 @@ async def save_check_result(status, message, error=None, order_data=None, result
             result_description=result_description,
             document_number=document_number,
             fiscal_sign=fiscal_sign,
-            legacynum=legacynum
+            legacynum=legacynum,
+            device_stats=device_stats
         )
         return True
     except Exception as e:
@@ -380,6 +533,8 @@ async def save_check_result(status, message, error=None, order_data=None, result
             content += f"FiscalSign: {fiscal_sign}\n"
         if legacynum:
             content += f"legacynum: {legacynum}\n"
+        if device_stats:
+            content += f"DeviceStats: {json.dumps(device_stats, ensure_ascii=False)}\n"
         save_check_result_file("check", content, error)
         return False
 
@@ -443,204 +598,274 @@ async def save_egais_result(status, order_data=None, xml_data=None, response_dat
         save_check_result_file("egais", content, error)
         return False
 
-async def order_pay(order, type_pay):
-    try:
-        logger.info(f"Начало обработки заказа: {order.num}, тип оплаты: {type_pay}")
-        max_discount = os.getenv('MAX_DISCOUNT', 'False') in ['True']
-        discount = 0
-        total_to_pay = 0
-        item_no_discount = False
-        if float(order.alldiscount) > 0 and float(order.alldiscount) <= 100:
-            discount = float(order.alldiscount) / 100    
-        fr = win32com.client.Dispatch('Addin.DRvFR')
-        fr.Connect()
+def print_receipt(fr, order, priced, type_pay, device):
+    """
+    Пробитие чека на ККТ (выполняется в потоке ККТ)
+
+    :param fr: объект драйвера кассы
+    :param priced: расчет заказа (price_order)
+    :param device: ККТ пула, на которой печатается чек (кэш реквизитов и отслеживаемое состояние)
+    :return: dict со статусом, данными чека и кодом результата
+    """
+    # Разбивка вызовов драйвера по чеку сохраняется в CheckLog.device_stats
+    begin_trace(fr)
+    state = device.state
+    document_before = None
+    if state.is_ready():
+        # Режим известен по результатам предыдущих команд - запрос GetECRStatus не нужен
+        ecr_mode = state.mode
+        document_before = state.document_number
+        logger.debug(f"ECR Mode (отслеживаемый): {ecr_mode}")
+    else:
         ecr_mode, ecr_description, ecr_advanced_mode = get_ecr_mode(fr)
+        state.sync(ecr_mode)
         logger.info(f"ECR Mode: {ecr_mode}, Description: {ecr_description}, Advanced Mode: {ecr_advanced_mode}")
+    
+    # Проверяем режим ККТ и закрываем открытый документ если необходимо
+    # Режимы ККТ: 2 - готов к работе, 8 - открытый документ возврата, и другие
+    if ecr_mode != 2 and ecr_mode != 4:  # Режим 2 - готов к работе, 4 - закрытая смена
+        logger.warning(f"ККТ не готов к работе (режим {ecr_mode}: {ecr_description}, расширенный режим: {ecr_advanced_mode})")
         
-        # Проверяем режим ККТ и закрываем открытый документ если необходимо
-        # Режимы ККТ: 2 - готов к работе, 8 - открытый документ возврата, и другие
-        if ecr_mode != 2 and ecr_mode != 4:  # Режим 2 - готов к работе, 4 - закрытая смена
-            logger.warning(f"ККТ не готов к работе (режим {ecr_mode}: {ecr_description}, расширенный режим: {ecr_advanced_mode})")
-            
-            if ecr_advanced_mode == 3:
-                # Расширенный режим 3 - нужно продолжить печать
-                logger.info("Расширенный режим 3 - выполняем ContinuePrint")
-                try:
-                    fr.ContinuePrint()
-                    logger.info(f"ContinuePrint выполнен: {fr.ResultCode}, {fr.ResultCodeDescription}")
-                except Exception as e:
-                    logger.error(f"Ошибка при выполнении ContinuePrint: {e}")
-            else:
-                # Для других режимов - закрываем документ
-                logger.info("Закрываем открытый документ")
-                fr.Disconnect()  # Отключаемся перед вызовом kill_document
-                
-                try:
-                    kill_result = kill_document()  # Закрываем открытый документ
-                    logger.info(f"Результат закрытия документа: {kill_result}")
-                except Exception as e:
-                    logger.error(f"Ошибка при закрытии документа: {e}")
-                
-                # Переподключаемся после закрытия документа
-                fr = win32com.client.Dispatch('Addin.DRvFR')
-                fr.Connect()
-            
-            # Проверяем режим ККТ после операции (ContinuePrint или kill_document)
-            ecr_mode, ecr_description, ecr_advanced_mode = get_ecr_mode(fr)
-            logger.info(f"После операции восстановления - ECR Mode: {ecr_mode}, Description: {ecr_description}, Advanced Mode: {ecr_advanced_mode}")
-            
-            # Проверяем, что ККТ теперь готов к работе
-            if ecr_mode != 2:
-                error_msg = f"ККТ все еще не готов к работе после операции восстановления (режим {ecr_mode}: {ecr_description}, расширенный режим: {ecr_advanced_mode})"
-                logger.error(error_msg)
-                fr.Disconnect()
-                
-                # Сохраняем ошибку в БД
-                await save_check_result(
-                    status="error",
-                    message="Ошибка подготовки ККТ к работе",
-                    error=error_msg,
-                    order_data=order.dict(),
-                    legacynum=order.num
-                )
-                return {"status": "error", "message": "Ошибка подготовки ККТ к работе", "error": error_msg}
-        fr.Summ1Enabled = False
-        fr.TaxValueEnabled = False
-        for item in order.products:
-            quantity = float(item.kolvo)
-            item_discount = discount
-            if max_discount:
-                item_discount = min(discount, float(item.maxdiscont) / 100)
-                item_no_discount = True
-            price = float(item.price)*(1 - item_discount)
-            logger.debug(f"Товар: {item.name}, количество: {quantity}, цена: {price}")
-            measure_unit = 0
-            PaymentItemSign = 1
-            if item.mark == '1' and item.draught == '1':
-                logger.debug("алко разливное пиво")
-                fr.DivisionalQuantity = False
-                fr.Numerator = "1";
-                fr.Denominator = "1";
-                measure_unit = 41
-                PaymentItemSign = 31
-            elif item.mark == '1' and item.bottled == '1':
-                logger.debug("алко пиво")
-                PaymentItemSign = 31
-            elif item.mark == '1':
-                logger.debug("иные маркированные")
-                PaymentItemSign = 33
-            fr.MeasureUnit = measure_unit
-            fr.StringForPrinting = item.name
-            fr.Price = price
-            fr.Quantity = quantity
-            fr.PaymentTypeSign = 4
-            fr.PaymentItemSign =  PaymentItemSign
-            fr.FNOperation()
-            logger.debug(f"FNOperation: {fr.ResultCode}, {fr.ResultCodeDescription}")
-            total_to_pay += float(item.kolvo) * float(item.price) * (1 - item_discount)
-            if item.mark == '1' and item.draught == '1':
-                send_user_details(fr, order.num.strip())
-                fr.MCOSUSign = True
-                fr.Barcode = item.GTIN
-                fr.FNSendItemBarcode()
-                logger.debug(f"Маркировка разливного: {fr.MarkingTypeEx}, {fr.MarkingType}, {fr.CheckItemLocalResult}")
-                logger.debug(f"FNSendItemBarcode: {fr.ResultCode}, {fr.ResultCodeDescription}")
-            elif item.mark == '1':
-                qr_add_gs = item.qr.replace('{GS}', chr(29))
-                fr.BarCode = qr_add_gs
-                fr.ItemStatus = 1
-                fr.FNCheckItemBarcode()
-                fr.FNAcceptMarkingCode()
-                logger.debug(f"Маркировка товара: {fr.MarkingTypeEx}, {fr.MarkingType}, {fr.CheckItemLocalResult}")
-                logger.debug(f"FNCheckItemBarcode: {fr.ResultCode}, {fr.ResultCodeDescription}")
-                fr.Barcode = qr_add_gs
-                fr.FNSendItemBarcode()
-        if float(order.alldiscount) > 0 and float(order.alldiscount) <= 100:
-            summ_no_discount = sum(float(item.kolvo) * float(item.price) for item in order.products)
-            fr.StringQuantity = 1
-            fr.FeedDocument()
-            fr.StringForPrinting = f"Скидка .. {order.alldiscount}%"
-            fr.PrintString()
-            if item_no_discount:
-                fr.StringForPrinting = f"В чеке присутствуют товары скидка на которые не распространяется!"
-                fr.PrintString()
-            fr.StringForPrinting = f"Сумма чека без скидки .. {summ_no_discount}"
-            fr.PrintString()
-        if type_pay == "cash":
-            fr.Summ1 = total_to_pay
-        if type_pay == "card":
-            fr.Summ2 = total_to_pay
-        send_tag_1021_1203(fr, order.employee_pos + " " + order.employee_fio, order.employee_inn)
-        fr.FNCloseCheckEx()
-        logger.info(f"Закрытие чека: {fr.ResultCode}, {fr.ResultCodeDescription}")
-        fr.StringQuantity = 2
-        fr.FeedDocument()
-        fr.CutType = 2
-        fr.CutCheck()
+        if ecr_advanced_mode == 3:
+            # Расширенный режим 3 - нужно продолжить печать
+            logger.info("Расширенный режим 3 - выполняем ContinuePrint")
+            try:
+                fr.ContinuePrint()
+                logger.info(f"ContinuePrint выполнен: {fr.ResultCode}, {fr.ResultCodeDescription}")
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении ContinuePrint: {e}")
+        else:
+            # Для других режимов - закрываем документ
+            logger.info("Закрываем открытый документ")
+            try:
+                kill_result = kill_document(fr)  # Закрываем открытый документ
+                logger.info(f"Результат закрытия документа: {kill_result}")
+                cancelled = fiscal_journal.resolve_open(device.id, 'cancelled', reason="SysAdminCancelCheck перед следующим чеком")
+                for op in cancelled:
+                    logger.warning(f"Аннулирован незавершенный чек заказа {op.get('order')}")
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии документа: {e}")
         
-        # Получаем данные ККТ из кэша и актуальные данные чека
-        check_info = None
+        # Проверяем режим ККТ после операции (ContinuePrint или kill_document)
+        ecr_mode, ecr_description, ecr_advanced_mode = get_ecr_mode(fr)
+        state.sync(ecr_mode)
+        logger.info(f"После операции восстановления - ECR Mode: {ecr_mode}, Description: {ecr_description}, Advanced Mode: {ecr_advanced_mode}")
+        
+        # Проверяем, что ККТ теперь готов к работе
+        if ecr_mode != 2:
+            error_msg = f"ККТ все еще не готов к работе после операции восстановления (режим {ecr_mode}: {ecr_description}, расширенный режим: {ecr_advanced_mode})"
+            logger.error(error_msg)
+            return {"status": "error", "error": error_msg, "device_stats": end_trace(fr)}
+    if document_before is None:
+        # Номер последнего документа - из ответа GetECRStatus
+        document_before = getattr(fr, 'DocumentNumber', None)
+    op_id = fiscal_journal.begin(device.id, order.num, type_pay, order.dict(), document_before, ecr_mode)
+    fr.Summ1Enabled = False
+    fr.TaxValueEnabled = False
+    for line in priced.lines:
+        item = line.item
+        quantity = float(line.quantity)
+        price = float(line.unit_price)
+        logger.debug(f"Товар: {item.name}, количество: {quantity}, цена: {price}")
+        measure_unit = 0
+        PaymentItemSign = 1
+        if item.mark == '1' and item.draught == '1':
+            logger.debug("алко разливное пиво")
+            fr.DivisionalQuantity = False
+            fr.Numerator = "1";
+            fr.Denominator = "1";
+            measure_unit = 41
+            PaymentItemSign = 31
+        elif item.mark == '1' and item.bottled == '1':
+            logger.debug("алко пиво")
+            PaymentItemSign = 31
+        elif item.mark == '1':
+            logger.debug("иные маркированные")
+            PaymentItemSign = 33
+        fr.MeasureUnit = measure_unit
+        fr.StringForPrinting = item.name
+        fr.Price = price
+        fr.Quantity = quantity
+        fr.PaymentTypeSign = 4
+        fr.PaymentItemSign =  PaymentItemSign
+        fr.FNOperation()
+        # Отладочные чтения свойств - лишние вызовы через COM, выполняются только при уровне DEBUG
+        logger.opt(lazy=True).debug("FNOperation: {}, {}", lambda: fr.ResultCode, lambda: fr.ResultCodeDescription)
+        if item.mark == '1' and item.draught == '1':
+            send_user_details(fr, (order.num or "").strip())
+            fr.MCOSUSign = True
+            fr.Barcode = item.GTIN
+            fr.FNSendItemBarcode()
+            logger.opt(lazy=True).debug("Маркировка разливного: {}, {}, {}", lambda: fr.MarkingTypeEx, lambda: fr.MarkingType, lambda: fr.CheckItemLocalResult)
+            logger.opt(lazy=True).debug("FNSendItemBarcode: {}, {}", lambda: fr.ResultCode, lambda: fr.ResultCodeDescription)
+        elif item.mark == '1':
+            qr_add_gs = item.qr.replace('{GS}', chr(29))
+            fr.BarCode = qr_add_gs
+            fr.ItemStatus = 1
+            fr.FNCheckItemBarcode()
+            fr.FNAcceptMarkingCode()
+            logger.opt(lazy=True).debug("Маркировка товара: {}, {}, {}", lambda: fr.MarkingTypeEx, lambda: fr.MarkingType, lambda: fr.CheckItemLocalResult)
+            logger.opt(lazy=True).debug("FNCheckItemBarcode: {}, {}", lambda: fr.ResultCode, lambda: fr.ResultCodeDescription)
+            fr.Barcode = qr_add_gs
+            fr.FNSendItemBarcode()
+    if priced.has_discount:
+        fr.StringQuantity = 1
+        fr.FeedDocument()
+        fr.StringForPrinting = f"Скидка .. {order.alldiscount}%"
+        fr.PrintString()
+        if priced.has_capped:
+            fr.StringForPrinting = f"В чеке присутствуют товары скидка на которые не распространяется!"
+            fr.PrintString()
+        fr.StringForPrinting = f"Сумма чека без скидки .. {priced.total_full}"
+        fr.PrintString()
+    total_to_pay = float(priced.total)
+    if type_pay == "cash":
+        fr.Summ1 = total_to_pay
+    if type_pay == "card":
+        fr.Summ2 = total_to_pay
+    fiscal_journal.items(op_id, len(priced.lines), total_to_pay, type_pay)
+    send_tag_1021_1203(fr, order.employee_pos + " " + order.employee_fio, order.employee_inn)
+    fr.FNCloseCheckEx()
+    logger.info(f"Закрытие чека: {fr.ResultCode}, {fr.ResultCodeDescription}")
+    # Номер документа и ФП читаем сразу после закрытия чека
+    document_number = getattr(fr, 'DocumentNumber', None)
+    fiscal_sign = getattr(fr, 'FiscalSign', None)
+    if fr.ResultCode == 0:
+        fiscal_journal.closed(op_id, fr.ResultCode, document_number, fiscal_sign)
+        state.on_receipt_closed(document_number)
+    else:
+        # Ошибка не запоминается реестром идемпотентности - повтор оплаты пробьет чек заново
+        state.invalidate()
         result_code = fr.ResultCode
         result_description = fr.ResultCodeDescription
-        
+        error_msg = f"Чек не закрыт: {result_code}, {result_description}"
+        logger.error(error_msg)
+        # Если документ не остался открытым и номер документа не вырос, чек не пробит - операция
+        # завершена. Иначе она будет разобрана при следующем чеке или запуске
         try:
-            # Получаем параметры текущей смены
-            fr.FNGetCurrentSessionParams()
-            session_number = getattr(fr, 'SessionNumber', None)
-            
-            # Получаем текущее время
-            now = datetime.now()
-            check_iso_datetime = now.strftime("%Y-%m-%dT%H:%M:%S")
-            
-            # Используем кэшированные данные для остальных параметров
-            check_info = {
-                'FDNumber': str(fr.DocumentNumber) if hasattr(fr, 'DocumentNumber') and fr.DocumentNumber else None,
-                'FNSerialNumber': KKT_CACHE['FNSerialNumber'],
-                'KKTNumber': KKT_CACHE['KKTSerialNumber'],
-                'KKTRegistrationNumber': KKT_CACHE['KKTRegistrationNumber'],
-                'FP': str(fr.FiscalSign) if hasattr(fr, 'FiscalSign') and fr.FiscalSign else None,
-                'ShiftNumber': session_number,  # Номер смены
-                'FDDateTime': check_iso_datetime  # Время в формате ЕГАИС
-            }
-            
-            logger.debug(f"Используются кэшированные данные ККТ: {check_info}")
+            ecr_mode_after, _, _ = get_ecr_mode(fr)
+            if fr.ResultCode == 0 and ecr_mode_after in (2, 4) and \
+                    receipt_fiscalized(document_before, getattr(fr, 'DocumentNumber', None), ecr_mode) is False:
+                fiscal_journal.resolve(op_id, 'not_printed', result_code=result_code, error=error_msg)
         except Exception as e:
-            logger.error(f"Ошибка получения данных ККТ: {e}")
+            logger.warning(f"Не удалось проверить режим ККТ после ошибки закрытия чека: {e}")
+        return {
+            "status": "error",
+            "message": "Ошибка закрытия чека",
+            "error": error_msg,
+            "result_code": result_code,
+            "result_description": result_description,
+            "device_stats": end_trace(fr)
+        }
+    
+    # Получаем данные ККТ из кэша и актуальные данные чека
+    check_info = None
+    result_code = fr.ResultCode
+    result_description = fr.ResultCodeDescription
+    
+    try:
+        # Номер смены известен из отслеживаемого состояния, иначе запрашиваем параметры смены
+        if state.session_number is None:
+            fr.FNGetCurrentSessionParams()
+            state.session_number = getattr(fr, 'SessionNumber', None)
+        session_number = state.session_number
+        
+        # Получаем текущее время
+        now = datetime.now()
+        check_iso_datetime = now.strftime("%Y-%m-%dT%H:%M:%S")
+        
+        # Используем кэшированные данные для остальных параметров
+        check_info = {
+            'FDNumber': str(document_number) if document_number else None,
+            'FNSerialNumber': device.cache['FNSerialNumber'],
+            'KKTNumber': device.cache['KKTSerialNumber'],
+            'KKTRegistrationNumber': device.cache['KKTRegistrationNumber'],
+            'FP': str(fiscal_sign) if fiscal_sign else None,
+            'ShiftNumber': session_number,  # Номер смены
+            'FDDateTime': check_iso_datetime  # Время в формате ЕГАИС
+        }
         
-        fr.Disconnect()
+        logger.debug(f"Используются кэшированные данные ККТ: {check_info}")
+    except Exception as e:
+        logger.error(f"Ошибка получения данных ККТ: {e}")
+    
+    return {
+        "status": "success",
+        "check_info": check_info,
+        "result_code": result_code,
+        "result_description": result_description,
+        "device_stats": end_trace(fr)
+    }
+
+def finish_receipt(fr, receipt):
+    """
+    Подача и отрезка чека (выполняется в потоке ККТ сразу после print_receipt,
+    но ответ клиенту не ждет механики принтера)
+    """
+    if receipt["status"] != "success":
+        return
+    fr.StringQuantity = 2
+    fr.FeedDocument()
+    fr.CutType = 2
+    fr.CutCheck()
+
+async def order_pay(order, type_pay):
+    try:
+        logger.info(f"Начало обработки заказа: {order.num}, тип оплаты: {type_pay}")
+        # Расчет и проверка заказа до постановки в очередь ККТ
+        priced = price_order(order)
+        device = kkt_pool.route(order.hall, order.table)
+        logger.info(f"Заказ {order.num} направлен на ККТ {device.id}")
+        receipt = await device.run(print_receipt, order, priced, type_pay, device, priority=PRIORITY_PAYMENT, then=finish_receipt)
+        
+        if receipt["status"] != "success":
+            message = receipt.get("message", "Ошибка подготовки ККТ к работе")
+            # Сохраняем ошибку в БД
+            await save_check_result(
+                status="error",
+                message=message,
+                error=receipt["error"],
+                order_data=order.dict(),
+                result_code=str(receipt["result_code"]) if "result_code" in receipt else None,
+                result_description=receipt.get("result_description"),
+                legacynum=order.num,
+                device_stats=receipt.get("device_stats")
+            )
+            return {"status": "error", "message": message, "error": receipt["error"]}
         
-        # Сохраняем успешный чек в БД
+        check_info = receipt["check_info"]
         document_number = None
         fiscal_sign = None
         if check_info:
             document_number = check_info.get('FDNumber')
             fiscal_sign = check_info.get('FP')
         
-        await save_check_result(
-            status="success",
-            message="Чек успешно напечатан",
-            order_data=order.dict(),
-            result_code=str(result_code),
-            result_description=result_description,
-            document_number=document_number,
-            fiscal_sign=fiscal_sign,
-            legacynum=order.num
-        )
-        
-        # Проверяем, есть ли алкогольные позиции для отправки в ЕГАИС
-        alco_items = [item for item in order.products if item.alco == '1' or item.alc_code]
-        if alco_items:
-            try:
-                # Если не удалось получить данные из ККТ, не отправляем в ЕГАИС
-                if not check_info:
+        # Фискальный документ закрыт - отвечаем клиенту, остальное доделываем в фоне
+        message = "Чек успешно напечатан"
+        # Чек уже пробит: ошибка здесь не должна превращать его в ошибку оплаты (повтор пробил бы второй чек)
+        try:
+            stages = [("log", lambda: log_receipt_stage(order, receipt, document_number, fiscal_sign))]
+            alco_items = [item for item in order.products if item.alco == '1' or item.alc_code]
+            if alco_items:
+                if check_info:
+                    stages.append(("egais", lambda: egais_stage(order, check_info, device)))
+                else:
+                    # Если не удалось получить данные из ККТ, не отправляем в ЕГАИС
                     logger.warning("Не удалось получить данные ККТ, пропускаем отправку в ЕГАИС")
-                    return {"status": "success", "message": "Чек успешно напечатан, но не отправлен в ЕГАИС"}
-                
-                egais_result = await send_egais_check(order, check_info)
-                logger.info(f"ЕГАИС результат: {egais_result}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки в ЕГАИС: {e}")
-        return {"status": "success", "message": "Чек успешно напечатан"}
+                    message = "Чек успешно напечатан, но не отправлен в ЕГАИС"
+            receipt_pipeline.start((order.num or "").strip() or str(document_number), stages)
+        except Exception as e:
+            logger.error(f"Чек {document_number} заказа {order.num} пробит, но фоновые этапы не запущены: {e}")
+        return {
+            "status": "success",
+            "message": message,
+            "document_number": document_number,
+            "fiscal_sign": fiscal_sign,
+            "kkt": device.id
+        }
+    except (KktQueueFull, KktTimeout):
+        # Команда не начала выполняться, чек не пробит - ответ 503 дает обработчик исключений
+        raise
     except Exception as e:
         # Сохраняем ошибку в БД
         await save_check_result(
@@ -654,238 +879,453 @@ async def order_pay(order, type_pay):
         )
         return {"status": "error", "message": "Ошибка при печати чека", "error": str(e)}
 
-@app.post("/api/v1/invoice")
-async def create_invoice(order: Order):
-    logger.info(f"Печать счета для заказа: {order.num}")
-    max_discount = os.getenv('MAX_DISCOUNT', 'False') in ['True']
+async def log_receipt_stage(order, receipt, document_number, fiscal_sign):
+    """Фоновый этап: запись успешного чека в журнал"""
+    await save_check_result(
+        status="success",
+        message="Чек успешно напечатан",
+        order_data=order.dict(),
+        result_code=str(receipt["result_code"]),
+        result_description=receipt["result_description"],
+        document_number=document_number,
+        fiscal_sign=fiscal_sign,
+        legacynum=order.num,
+        device_stats=receipt.get("device_stats")
+    )
+    return {"document_number": document_number}
+
+async def egais_stage(order, check_info, device):
+    """
+    Фоновый этап: чек в очередь отправки в ЕГАИС; QR-код печатается на ККТ
+    чека, когда УТМ примет чек
+    """
+    result = await send_egais_check(order, check_info, device=device)
+    logger.info(f"ЕГАИС результат: {result}")
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return {key: result[key] for key in ("message", "outbox_id", "qr_code") if key in result}
+
+@app.get("/api/v1/payment/{order_num}/status")
+async def get_payment_status(order_num: str):
+    """
+    Статус фоновых этапов чека: запись в журнал, ЕГАИС, печать QR-кода
+    """
+    record = receipt_pipeline.get(order_num.strip())
+    if record is None:
+        return {"status": "error", "message": f"Заказ {order_num} не найден"}
+    return {"status": "success", "data": record}
+
+def print_invoice_kkt(fr, ops):
+    """
+    Печать счета на ККТ (выполняется в потоке ККТ)
+
+    :param ops: счет, отрисованный по шаблону (InvoiceTemplate.render)
+    """
     cut_invoice = os.getenv('CUT_INVOICE', 'False') in ['True']
-    fr = win32com.client.Dispatch('Addin.DRvFR')
-    fr.Connect()
     fr.UseReceiptRibbon = True
-    fr.StringQuantity = 1
-    fr.FeedDocument()
-    fr.StringForPrinting = add_spaces_to_45_chars(os.getenv('ORG_TITLE', 'Кафе'))
-    fr.PrintString()
-    fr.StringQuantity = 1
-    fr.FeedDocument()
-    fr.StringForPrinting = f"    СЧЕТ #{order.num.strip()}"
-    fr.PrintWideString()
-    fr.StringQuantity = 1
-    fr.FeedDocument()
-    fr.StringForPrinting = f"ЗАЛ {order.hall.strip()}"
-    fr.PrintString()
-    fr.StringForPrinting = f"СТОЛ {order.table.strip()}"
-    fr.PrintString()
-    fr.StringForPrinting = f"Официант {order.waiter.strip()}"
-    fr.PrintString()
-    fr.StringForPrinting = f"Счет открыт {order.create.strip()}"
-    fr.PrintString()
-    fr.StringQuantity = 1
-    fr.FeedDocument()
-    fr.StringForPrinting = add_spaces_to_45_chars(f"Блюда")
-    fr.PrintString()
-    discount = 0
-    total_to_pay = 0
-    item_no_discount = False
-    if float(order.alldiscount) > 0 and float(order.alldiscount) <= 100:
-        discount = float(order.alldiscount) / 100
-    for item in order.products:
-        logger.debug(f"Товар в счете: {item.name}")
-        fr.StringForPrinting = f"{item.name.upper()}...{item.kolvo}x{item.price}  {float(item.kolvo)*float(item.price)}"
-        fr.PrintString()
-        fr.StringQuantity = 1
-        fr.FeedDocument()
-        item_discount = discount
-        if max_discount:
-            item_discount = min(discount, float(item.maxdiscont) / 100)
-            item_no_discount = True
-        total_to_pay += float(item.kolvo) * float(item.price) * (1 - item_discount)
-    # Проверка условия, что скидка больше 0 и меньше или равна 100
-    if float(order.alldiscount) > 0 and float(order.alldiscount) <= 100:
-        summ_no_discount = sum(float(item.kolvo) * float(item.price) for item in order.products)
-        fr.StringQuantity = 2
-        fr.FeedDocument()
-        fr.StringForPrinting = f"Скидка .. {order.alldiscount}%"
-        fr.PrintString()
-        if item_no_discount:
-            fr.StringForPrinting = f"В чеке присутствуют товары скидка на которые не распространяется!"
+    for kind, value in ops:
+        if kind == PRINT_FEED:
+            fr.StringQuantity = value
+            fr.FeedDocument()
+        elif kind == PRINT_WIDE:
+            fr.StringForPrinting = value
+            fr.PrintWideString()
+        else:
+            fr.StringForPrinting = value
             fr.PrintString()
-        fr.StringForPrinting = f"Сумма чека без скидки .. {summ_no_discount}"
-        fr.PrintString()
-    fr.StringQuantity = 2
-    fr.FeedDocument()
-    fr.StringForPrinting = f"ИТОГО К ОПЛАТЕ .. {total_to_pay}"
-    fr.PrintWideString()    
-#    fr.StringQuantity = 2
-#    fr.FeedDocument()
-#    fr.CutType = 2
-    fr.StringQuantity = 15
-    fr.FeedDocument()
     if cut_invoice:
         fr.CutCheck()
     logger.info(f"Печать счета завершена: {fr.ResultCode}, {fr.ResultCodeDescription}")
-    fr.Disconnect()
-    # return order
-    return {"message": "Invoice printed successfully"}
+
+async def print_invoice_order(order):
+    """
+    Печать счета (пречека): на сетевом принтере зала, при его отсутствии или
+    недоступности - на ККТ
+    """
+    logger.info(f"Печать счета для заказа: {order.num}")
+    try:
+        priced = price_order(order)
+    except ValueError as e:
+        return {"status": "error", "message": "Некорректные данные заказа", "error": str(e)}
+    # Счет отрисовывается по шаблону зала до отправки на принтер
+    ops = invoice_templates.get(order.hall).render(order, priced, os.getenv('ORG_TITLE', 'Кафе'))
+
+    address = INVOICE_PRINTERS.get((order.hall or "").strip()) or INVOICE_PRINTER
+    if address:
+        try:
+            await asyncio.to_thread(printer_pool.send, address, render_invoice(ops))
+            logger.info(f"Счет {order.num} напечатан на принтере {address}")
+            return {"message": "Invoice printed successfully", "printer": address}
+        except Exception as e:
+            logger.warning(f"Принтер счетов {address} недоступен: {e}, печатаем счет на ККТ")
+
+    device = kkt_pool.route(order.hall, order.table)
+    await device.run(print_invoice_kkt, ops, priority=PRIORITY_PRINT)
+    return {"message": "Invoice printed successfully", "printer": "kkt", "kkt": device.id}
+
+@app.post("/api/v1/invoice")
+async def create_invoice(order: Order):
+    return await print_invoice_order(order)
+
+async def load_payment_result(key):
+    """Результат оплаты по ключу идемпотентности из БД"""
+    if not db_connected:
+        return None
+    record = await PaymentIdempotency.get_or_none(key=key)
+    return record.response if record else None
+
+async def save_payment_result(key, result):
+    """Сохранить успешный результат оплаты по ключу идемпотентности в БД"""
+    if not db_connected:
+        return
+    await PaymentIdempotency.get_or_create(key=key, defaults={"response": result})
+
+# Повторы оплаты с тем же номером заказа (или Idempotency-Key) не пробивают второй чек
+payment_idempotency = IdempotencyRegistry(
+    max_entries=int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '1000')),
+    load=load_payment_result,
+    save=save_payment_result
+)
+
+async def order_pay_once(order, type_pay, idempotency_key=None):
+    """
+    Оплата заказа не более одного раза для ключа: заголовок Idempotency-Key,
+    иначе номер заказа. Без ключа оплата выполняется как есть.
+    """
+    key = (idempotency_key or order.num or "").strip()
+    if not key:
+        return await order_pay(order, type_pay)
+    result, replayed = await payment_idempotency.run(key, lambda: order_pay(order, type_pay))
+    if replayed:
+        return {**result, "replayed": True}
+    return result
 
 @app.post("/api/v1/payment/cash")
-async def process_cash_payment(order: Order):
-    result = await order_pay(order, "cash")
+async def process_cash_payment(order: Order, idempotency_key: str = Header(None)):
+    result = await order_pay_once(order, "cash", idempotency_key)
     return result
 
 @app.post("/api/v1/payment/card")
-async def process_card_payment(order: Order):
-    result = await order_pay(order, "card")
+async def process_card_payment(order: Order, idempotency_key: str = Header(None)):
+    result = await order_pay_once(order, "card", idempotency_key)
     return result
 
 @app.post("/api/v1/print/invoice")
 async def print_invoice(order: Order):
-    # Logic for printing invoice
-    return {"message": "Invoice printed successfully"}
+    return await print_invoice_order(order)
+
+async def queue_kitchen_ticket(order):
+    """
+    Поставить кухонную марку в очередь принтера: марка собирается в один буфер
+    ESC/POS и печатается фоновой задачей очереди (с повторами, если принтер недоступен)
+    """
+    return await kitchen_queue.enqueue(
+        order.printer_ip,
+        render_kitchen_ticket(order),
+        order_number=order.order_number,
+        station=order.kitchen_type
+    )
 
 @app.post("/api/v1/print/kitchen-mark")
 async def print_kitchen_mark(order: KitchenMarkRequest):
     try:
-        # Подключение к принтеру
-        p = Network(order.printer_ip)
-
-        # Отключение китайского режима
-        p._raw(b'\x1C\x2E')
-
-        # Установка кодовой таблицы CP866 (русский язык)
-        p._raw(b'\x1B\x74\x10')
-
-        # Заголовок — номер заказа
-        p.set(align='center', width=2, height=1)
-        p.text(f"ЗАКАЗ №{order.order_number}\n")
-
-        # Печать типа кухни (например, "КУХНЯ" или "БАР")
-        p.set(align='center', width=2, height=2)
-        p.text(f"== {order.kitchen_type.upper()} ==\n")
+        ticket = await queue_kitchen_ticket(order)
+        return {"message": "Kitchen mark queued", "ticket_id": ticket["id"]}
+    except Exception as e:
+        return {"error": str(e)}
 
-        p.set(align='left', width=1, height=1)
-        p.text("=" * 48 + "\n")
-        now = datetime.now().strftime("%d.%m.%Y %H:%M")
-        p.text(f"СТОЛ: {order.table_number:<5}   ОФИЦИАНТ: {order.waiter_name:<20}\n")
-        p.text(f"ВРЕМЯ: {now}\n")
-        p.text("=" * 48 + "\n")
+async def load_kitchen_routes():
+    """Категории со станциями и товары для карты маршрутов кухонных марок"""
+    global db_connected
+    if not db_connected:
+        return {}, []
+    categories = {
+        category_id: (parent_id, station, printer)
+        for category_id, parent_id, station, printer in await Category.filter(is_active=True).values_list(
+            'id', 'parent_id', 'kitchen_station', 'kitchen_printer')
+    }
+    products = await Product.filter(is_active=True, category_id__isnull=False).values_list(
+        'legacy_id', 'barcode', 'name', 'category_id')
+    return categories, products
+
+# Маршруты кухонных марок по категориям; позиции без маршрута - на KITCHEN_DEFAULT_PRINTER
+kitchen_router = KitchenRouter(
+    load_kitchen_routes,
+    default_printer=os.getenv('KITCHEN_DEFAULT_PRINTER', '').strip() or None,
+    default_station=os.getenv('KITCHEN_DEFAULT_STATION', 'КУХНЯ'),
+    ready=printer_prober.ready
+)
 
-        # Позиции с точками
-        for item in order.products:
-            name = item.name[:35]  # обрезаем длинные названия
-            qty_str = f"{item.quantity} шт"
-            dots = "." * (48 - len(name) - len(qty_str))
-            p.text(f"{name}{dots}{qty_str}\n")
+async def print_station_ticket(order, station, printer, items):
+    """Марка одной станции в очередь ее принтера; ошибка одной станции не мешает остальным"""
+    ticket = KitchenMarkRequest(
+        printer_ip=printer,
+        table_number=order.table_number,
+        waiter_name=order.waiter_name,
+        order_number=order.order_number,
+        kitchen_type=station,
+        products=items
+    )
+    result = {"station": station, "printer": printer, "items": len(items)}
+    try:
+        result["ticket_id"] = (await queue_kitchen_ticket(ticket))["id"]
+        result["status"] = "success"
+    except Exception as e:
+        logger.error(f"Ошибка постановки в очередь марки заказа {order.order_number} на {station} ({printer}): {e}")
+        result["status"] = "error"
+        result["error"] = str(e)
+    return result
 
-        p.text("=" * 48 + "\n")
+@app.post("/api/v1/print/kitchen-order")
+async def print_kitchen_order(order: KitchenOrderRequest):
+    """
+    Кухонные марки заказа на все станции сразу: позиции разбиваются по
+    категориям товаров, марки ставятся в очереди принтеров станций и
+    печатаются параллельно
+    """
+    stations, unrouted = await kitchen_router.split(order.products)
+    results = await asyncio.gather(*[
+        print_station_ticket(order, station, printer, items)
+        for (station, printer), items in stations.items()
+    ])
+    failed = [result for result in results if result["status"] != "success"]
+    response = {
+        "status": "error" if failed or unrouted else "success",
+        "stations": results,
+        "unrouted": [item.name for item in unrouted]
+    }
+    if failed:
+        response["error"] = ", ".join(f"{result['station']}: {result['error']}" for result in failed)
+    elif unrouted:
+        response["error"] = "Не найдена станция для позиций: " + ", ".join(response["unrouted"])
+    return response
+
+class KitchenRerouteRequest(BaseModel):
+    source: str
+    target: str
+
+@app.get("/api/v1/kitchen/queue")
+async def get_kitchen_queue(printer: str = None):
+    """Очереди кухонных марок: глубина, возраст самой старой марки, ошибки принтера"""
+    data = {"printers": kitchen_queue.status()}
+    if printer:
+        data["tickets"] = kitchen_queue.pending(printer)
+    return {"status": "success", "data": data}
+
+@app.post("/api/v1/kitchen/queue/reroute")
+async def reroute_kitchen_queue(request: KitchenRerouteRequest):
+    """Перенести зависшую очередь марок на другой принтер"""
+    try:
+        host, _ = parse_address(request.target)
+        if not host:
+            return {"status": "error", "error": "Не указан принтер для переноса очереди"}
+        moved = await kitchen_queue.reroute(request.source.strip(), request.target.strip())
+        return {"status": "success", "moved": moved}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
 
-        # Подача бумаги и частичная обрезка
-        p._raw(b'\x1B\x64\x02')
-        p.cut(mode='PART')
-        p._raw(b'\x1B\x64\x02')
+@app.get("/api/v1/kitchen/printers")
+async def get_kitchen_printers(fresh: int = 0):
+    """
+    Состояние принтеров кухонных марок по последнему опросу (DLE EOT):
+    подключение, offline, крышка, бумага, время опроса и его возраст.
+    fresh - опросить принтеры немедленно
+    """
+    try:
+        if fresh:
+            await printer_prober.refresh()
+        return {"status": "success", "data": printer_prober.status()}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
 
-        return {"message": "Kitchen mark printed successfully"}
+@app.get("/api/v1/kitchen/routes")
+async def get_kitchen_routes():
+    """Карта маршрутов кухонных марок (код товара -> станция и принтер)"""
+    await kitchen_router.routes()
+    return {"status": "success", "data": kitchen_router.as_dict()}
 
-    except Exception as e:
-        return {"error": str(e)}
+def report_result(fr):
+    """Результат команды отчета в формате API"""
+    return {
+        "status": "success" if fr.ResultCode == 0 else "error",
+        "result_code": fr.ResultCode,
+        "result_description": fr.ResultCodeDescription,
+        "error": None if fr.ResultCode == 0 else f"{fr.ResultCode}, {fr.ResultCodeDescription}"
+    }
 
-@app.get("/api/v1/print/xreport")
-async def print_x_report():
-    fr = win32com.client.Dispatch('Addin.DRvFR')
-    fr.Connect()
+def x_report(fr):
+    """
+    Печать X-отчета (выполняется в потоке ККТ)
+    """
     fr.Password = 30
     fr.PrintReportWithoutCleaning()
     logger.info(f"X-отчет: {fr.ResultCode}, {fr.ResultCodeDescription}")
+    result = report_result(fr)
     fr.WaitForPrinting()
-    fr.Disconnect()
-    return {"message": "X-report printed successfully"}
+    return result
 
-@app.post("/api/v1/print/zreport")
-async def print_z_report(employee: Employee):
-    logger.info(f"Печать Z-отчета сотрудником: {employee.fio}")
-    fr = win32com.client.Dispatch('Addin.DRvFR')
-    fr.Connect()
+def z_report(fr, employee, device):
+    """
+    Печать Z-отчета (выполняется в потоке ККТ)
+    """
     fr.Password = 30
     fr.FNBeginCloseSession()
     send_tag_1021_1203(fr, employee.pos + " " + employee.fio, employee.inn)
     fr.FNCloseSession()
     logger.info(f"Z-отчет: {fr.ResultCode}, {fr.ResultCodeDescription}")
+    result = report_result(fr)
+    if fr.ResultCode == 0:
+        device.state.on_session_closed()
+    else:
+        device.state.invalidate()
     fr.WaitForPrinting()
-    # return fr.ECRMode, fr.ECRModeDescription
-    fr.Disconnect()
-    return {"message": "Z-report printed successfully"}
+    return result
 
-def kill_document():
+# Отчеты выполняются заданиями: запрос сразу получает job_id, а отчет ждет своей очереди ККТ
+report_jobs = JobRegistry(max_jobs=int(os.getenv('REPORT_JOBS_HISTORY', '100')))
+
+def run_report_job(fr, job, report, *args):
+    """Выполнение отчета в потоке ККТ с отметкой о начале задания"""
+    report_jobs.started(job)
+    return report(fr, *args)
+
+def submit_report(kind, device, report, *args):
+    job = report_jobs.submit(
+        kind,
+        lambda job: device.run(run_report_job, job, report, *args, priority=PRIORITY_REPORT),
+        device=device.id
+    )
+    return {
+        "status": "accepted",
+        "message": f"{kind.upper()}-отчет поставлен в очередь ККТ {device.id}",
+        "job_id": job["id"],
+        "status_url": f"/api/v1/print/report/{job['id']}"
+    }
+
+@app.get("/api/v1/print/xreport")
+@app.post("/api/v1/print/xreport")
+async def print_x_report(device_id: str = None):
+    return submit_report("x", kkt_pool.get(device_id), x_report)
+
+@app.post("/api/v1/print/zreport")
+async def print_z_report(employee: Employee, device_id: str = None):
+    logger.info(f"Печать Z-отчета сотрудником: {employee.fio}")
+    device = kkt_pool.get(device_id)
+    return submit_report("z", device, z_report, employee, device)
+
+@app.get("/api/v1/print/report/{job_id}")
+async def get_report_job(job_id: str, wait: float = 0):
+    """
+    Статус задания отчета: queued, running, done, error.
+    ?wait=N - ждать завершения до N секунд (long-poll, не более 60)
+    """
+    job = await report_jobs.wait(job_id, min(wait, 60))
+    if job is None:
+        return {"status": "error", "message": f"Задание {job_id} не найдено"}
+    return {"status": "success", "job": job}
+
+# Итог восстановления: (статус CheckLog, сообщение, закрытие чека подтверждено ККТ)
+RECOVERY_OUTCOMES = {
+    'completed': ("success", "Чек закрыт при восстановлении после сбоя", True),
+    'fiscalized': ("success", "Чек, вероятно, был пробит до сбоя (по номеру документа ККТ), требуется ручная проверка", False),
+    'cancelled': ("cancelled", "Незавершенный чек аннулирован при восстановлении после сбоя", False),
+    'not_printed': ("error", "Чек не был пробит до сбоя", False),
+    'unknown': ("error", "Состояние чека после сбоя неизвестно, требуется ручная проверка", False),
+}
+
+# Итоги, определенные по косвенным признакам или с ошибкой - их проверяет оператор
+RECOVERY_REVIEW_OUTCOMES = ('fiscalized', 'unknown', 'error')
+
+async def recover_fiscal_journal():
+    """
+    Разбор незавершенных фискальных операций после падения процесса (при запуске):
+    сверка с номером последнего документа ККТ, закрытие или аннулирование
+    открытого чека, запись итога в журнал чеков
+    """
+    report = []
+    for device in kkt_pool.devices.values():
+        operations = fiscal_journal.pending(device.id)
+        if not operations:
+            continue
+        logger.warning(f"Незавершенных фискальных операций на ККТ {device.id}: {len(operations)}")
+        try:
+            results = await device.run(reconcile, operations, priority=PRIORITY_PAYMENT)
+        except Exception as e:
+            logger.error(f"Ошибка восстановления операций ККТ {device.id}: {e}")
+            report.extend({'op': op['op'], 'order': op.get('order'), 'device': device.id, 'outcome': 'error', 'error': str(e)} for op in operations)
+            continue
+        finally:
+            device.state.invalidate()
+        orders = {op['op']: op for op in operations}
+        for result in results:
+            outcome = result['outcome']
+            fiscal_journal.resolve(result['op'], outcome, document_number=result.get('document_number'))
+            check_status, message, confirmed = RECOVERY_OUTCOMES[outcome]
+            document_number = str(result['document_number']) if result.get('document_number') else None
+            fiscal_sign = str(result['fiscal_sign']) if result.get('fiscal_sign') else None
+            await save_check_result(
+                status=check_status,
+                message=message,
+                error=result.get('error'),
+                order_data=orders[result['op']].get('order_data'),
+                document_number=document_number,
+                fiscal_sign=fiscal_sign,
+                legacynum=result['order']
+            )
+            if confirmed and result['order']:
+                # Повтор оплаты этого заказа не должен пробить второй чек. Итог по номеру документа
+                # не доказывает, что чек этого заказа закрыт, - такой заказ остается доступным для повтора
+                await payment_idempotency.record(result['order'].strip(), {
+                    "status": "success",
+                    "message": message,
+                    "document_number": document_number,
+                    "fiscal_sign": fiscal_sign,
+                    "kkt": device.id
+                })
+            report.append(result)
+    fiscal_journal.last_recovery = report
+    # Завершенные операции из журнала больше не нужны
+    fiscal_journal.compact()
+    return report
+
+@app.get("/api/v1/kkt/journal")
+async def api_get_kkt_journal(device_id: str = None):
+    """
+    Незавершенные фискальные операции и итог последнего восстановления после сбоя
+    (review - операции, которые нужно проверить вручную)
+    """
+    return {
+        "status": "success",
+        "pending": fiscal_journal.pending(device_id),
+        "recovery": fiscal_journal.last_recovery,
+        "review": [result for result in fiscal_journal.last_recovery if result['outcome'] in RECOVERY_REVIEW_OUTCOMES]
+    }
+
+def kill_document(fr):
     """
     Функция прибития застрявшего документа (SysAdminCancelCheck)
     """
-    fr = win32com.client.Dispatch('Addin.DRvFR')
-    fr.Connect()
     fr.Password = 30
     fr.SysAdminCancelCheck()
     logger.info('Аннулировали документ')
     result = {'ResultCode': fr.ResultCode, 'ResultCodeDescription': fr.ResultCodeDescription}
     logger.info(f"Результат отмены документа: {result}")
-    fr.Disconnect()
     return result
 
 @app.post("/api/v1/cancel-document")
-async def cancel_document():
-    result = kill_document()
+async def cancel_document(device_id: str = None):
+    device = kkt_pool.get(device_id)
+    result = await device.run(kill_document, priority=PRIORITY_PAYMENT)
+    fiscal_journal.resolve_open(device.id, 'cancelled', reason="cancel-document")
+    # Режим после отмены перечитаем перед следующим чеком
+    device.state.invalidate()
     return {"message": "Document cancelled", **result}
 
-def validate_egais_fields(inn, kpp, kassa, address, name, number, shift):
-    """
-    Валидация полей согласно XSD схеме ПРИЛОЖЕНИЕ Б
-    """
-    import re
-    
-    # Валидация ИНН (10 или 12 цифр)
-    if not re.match(r'^\d{10}$|^\d{12}$', str(inn)):
-        raise ValueError(f"ИНН должен содержать 10 или 12 цифр: {inn}")
-    
-    # Валидация КПП (9 цифр или пустая строка)
-    if kpp and not re.match(r'^\d{9}$', str(kpp)):
-        raise ValueError(f"КПП должен содержать 9 цифр: {kpp}")
-    
-    # Валидация адреса (максимум 128 символов)
-    if len(str(address)) > 128:
-        raise ValueError(f"Адрес не должен превышать 128 символов: {len(str(address))}")
-    
-    # Валидация названия (максимум 128 символов)
-    if len(str(name)) > 128:
-        raise ValueError(f"Название не должно превышать 128 символов: {len(str(name))}")
-    
-    return True
-
-def validate_bottle_fields(price, barcode, ean=None, volume=None):
-    """
-    Валидация полей элемента Bottle согласно XSD схеме
-    """
-    import re
-    
-    # Валидация цены (формат: [-]?\d+\.\d{0,2})
-    if not re.match(r'^[-]?\d+\.\d{0,2}$', str(price)):
-        raise ValueError(f"Цена должна быть в формате [-]?\\d+\\.\\d{{0,2}}: {price}")
-    
-    # Валидация баркода (формат: \d\d[a-zA-Z0-9]{21}\d[0-1]\d[0-3]\d{10}[a-zA-Z0-9]{31})
-    if not re.match(r'^\d\d[a-zA-Z0-9]{21}\d[0-1]\d[0-3]\d{10}[a-zA-Z0-9]{31}$', str(barcode)):
-        raise ValueError(f"Баркод не соответствует формату: {barcode}")
-    
-    # Валидация EAN (8, 12, 13 или 14 цифр)
-    if ean and not re.match(r'^\d{8}$|^\d{12}$|^\d{13}$|^\d{14}$', str(ean)):
-        raise ValueError(f"EAN должен содержать 8, 12, 13 или 14 цифр: {ean}")
-    
-    # Валидация объема (формат: \d+\.?\d{0,4})
-    if volume and not re.match(r'^\d+\.?\d{0,4}$', str(volume)):
-        raise ValueError(f"Объем должен быть в формате \\d+\\.?\\d{0,4}: {volume}")
-    
-    return True
-
 def build_egais_cheque_xml(order, alco_items, last_check_info=None):
     """
     Построение XML чека согласно схеме WB_DOC_SINGLE_01 для отправки в УТМ ЕГАИС
     Использует простую структуру как в примере egais_cheque_example.xml
+    (каркас документа с FSRAR_ID строится один раз, см. ChequeBuilder)
     """
     # Получаем данные организации из переменных окружения или кэша ККТ
     kassa = last_check_info.get('KKTNumber') if last_check_info and last_check_info.get('KKTNumber') else os.getenv("KASSA")
@@ -904,80 +1344,15 @@ def build_egais_cheque_xml(order, alco_items, last_check_info=None):
     # Определяем тип чека
     cheque_type = "Продажа" if order.typedoc != "return" else "Возврат"
     
-    # Получаем FSRAR_ID из переменных окружения
-    fsrar_id = os.getenv("FSRAR_ID", "020000347275")
-    
     # Логируем используемые параметры
     logger.info(f"EGАИС ChequeV3 XML параметры: смена={shift}, время={iso_datetime}, касса={kassa}, тип={cheque_type}")
     
-    # Создаем корневой элемент Documents с правильными namespace
-    documents = ET.Element("ns:Documents")
-    documents.set("Version", "1.0")
-    documents.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
-    documents.set("xmlns:ns", "http://fsrar.ru/WEGAIS/WB_DOC_SINGLE_01")
-    documents.set("xmlns:ck", "http://fsrar.ru/WEGAIS/ChequeV3")
-    documents.set("xmlns:oref", "http://fsrar.ru/WEGAIS/ClientRef_v2")
-    documents.set("xmlns:pref", "http://fsrar.ru/WEGAIS/ProductRef_v2")
-    
-    # Добавляем Owner
-    owner = ET.SubElement(documents, "ns:Owner")
-    fsrar_id_elem = ET.SubElement(owner, "ns:FSRAR_ID")
-    fsrar_id_elem.text = fsrar_id
-    
-    # Добавляем Document
-    document = ET.SubElement(documents, "ns:Document")
-    
-    # Добавляем ChequeV3
-    cheque = ET.SubElement(document, "ns:ChequeV3")
-    
-    # Добавляем Header (только для продаж, как в примере)
-    header = ET.SubElement(cheque, "ck:Header")
-    
-    # Дата и время
-    date_elem = ET.SubElement(header, "ck:Date")
-    date_elem.text = iso_datetime
-    
-    # Касса
-    kassa_elem = ET.SubElement(header, "ck:Kassa")
-    kassa_elem.text = str(kassa)
-    
-    # Смена
-    shift_elem = ET.SubElement(header, "ck:Shift")
-    shift_elem.text = str(shift)
-    
-    # Номер чека
-    number_elem = ET.SubElement(header, "ck:Number")
-    number_elem.text = str(number)
-    
-    # Тип чека
-    type_elem = ET.SubElement(header, "ck:Type")
-    type_elem.text = cheque_type
-    
-    # Content
-    content = ET.SubElement(cheque, "ck:Content")
-    
-    # Добавляем элементы Bottle для каждой алкогольной позиции (только как в примере)
-    for item in alco_items:
-        bottle = ET.SubElement(content, "ck:Bottle")
-        
-        # Баркод (обязательный элемент)
-        barcode = item.egais_mark_code or item.alc_code
-        
-        barcode_elem = ET.SubElement(bottle, "ck:Barcode")
-        barcode_elem.text = barcode
-        
-        # EAN код (обязательный элемент)
-        ean = str(item.EAN)
-        ean_elem = ET.SubElement(bottle, "ck:EAN")
-        ean_elem.text = ean
-        
-        # Цена (обязательный элемент)
-        price = f"{float(item.price):.2f}"
-        price_elem = ET.SubElement(bottle, "ck:Price")
-        price_elem.text = price
-    
-    xml_bytes = ET.tostring(documents, encoding='utf-8', xml_declaration=True)
-    return xml_bytes
+    # Баркод (марка), EAN и цена каждой алкогольной позиции
+    bottles = [
+        (item.egais_mark_code or item.alc_code, str(item.EAN), f"{float(item.price):.2f}")
+        for item in alco_items
+    ]
+    return egais_cheque_builder.build(iso_datetime, str(kassa), str(shift), str(number), cheque_type, bottles)
 
 def build_egais_v4_xml(order, alco_items, last_check_info=None):
     """
@@ -986,44 +1361,103 @@ def build_egais_v4_xml(order, alco_items, last_check_info=None):
     """
     return build_egais_cheque_xml(order, alco_items, last_check_info)
 
-def print_egais_qr(qr_url, sign=None):
+def print_egais_qr(fr, qr_url, sign=None):
     """
-    Печать QR-кода ЕГАИС с URL и подписью
+    Печать QR-кода ЕГАИС с URL и подписью (выполняется в потоке ККТ)
     qr_url: URL для QR-кода
     sign: подпись для печати под QR-кодом в формате 4 символа пробел
     """
-    fr = win32com.client.Dispatch('Addin.DRvFR')
-    fr.Connect()
+    # Печатаем QR-код (размер по умолчанию)
+    fr.Barcode = qr_url
+    fr.BarcodeType = 3  # QR Code
+    fr.LoadAndPrint2DBarcode()
     
-    try:
-        # Печатаем QR-код (размер по умолчанию)
-        fr.Barcode = qr_url
-        fr.BarcodeType = 3  # QR Code
-        fr.LoadAndPrint2DBarcode()
+    # Печатаем URL под QR-кодом
+    fr.StringForPrinting = qr_url
+    fr.PrintString()
+    
+    # Печатаем подпись в формате 4 символа + пробел
+    if sign:
+        formatted_sign = ""
+        for i in range(0, len(sign), 4):
+            chunk = sign[i:i+4]
+            formatted_sign += chunk + " "
         
-        # Печатаем URL под QR-кодом
-        fr.StringForPrinting = qr_url
+        fr.StringForPrinting = formatted_sign.strip()
         fr.PrintString()
-        
-        # Печатаем подпись в формате 4 символа + пробел
-        if sign:
-            formatted_sign = ""
-            for i in range(0, len(sign), 4):
-                chunk = sign[i:i+4]
-                formatted_sign += chunk + " "
-            
-            fr.StringForPrinting = formatted_sign.strip()
-            fr.PrintString()
-            
-    finally:
-        fr.Disconnect()
 
-async def send_egais_check(order: Order, check_info=None):
+def save_egais_response(response_text):
+    """Ответ УТМ в файл check/egais_response_<время>.txt"""
+    check_dir = "check"
+    if not os.path.exists(check_dir):
+        os.makedirs(check_dir)
+    filepath = os.path.join(check_dir, f"egais_response_{time.strftime('%Y%m%d_%H%M%S')}.txt")
+    with open(filepath, "w", encoding="utf-8") as f:
+        f.write("=== ОТВЕТ ЕГАИС ===\n")
+        f.write(response_text)
+    return filepath
+
+async def on_egais_sent(entry, response_text):
+    """
+    Чек из очереди принят УТМ: ответ в файл и журнал, QR-код на ККТ чека.
+    QR-код печатается, только если чек принят вскоре после оплаты - спустя
+    EGAIS_QR_DEADLINE секунд гость уже ушел
+    """
+    filepath = save_egais_response(response_text)
+    qr_url, sign = parse_utm_response(response_text)
+    if qr_url and entry.print_qr and entry.device_id:
+        age = egais_outbox.age(entry)
+        if age <= EGAIS_QR_DEADLINE:
+            await kkt_pool.get(entry.device_id).run(print_egais_qr, qr_url, sign, priority=PRIORITY_PRINT)
+        else:
+            logger.info(f"QR-код чека {entry.legacynum} не печатается: УТМ принял чек через {age:.0f} с")
+    await save_egais_result(
+        status="success",
+        order_data=entry.order_data,
+        xml_data=entry.xml_data,
+        response_data=response_text,
+        qr_code=qr_url,
+        sign=sign,
+        xml_file=entry.xml_file,
+        saved_file=filepath,
+        legacynum=entry.legacynum
+    )
+
+async def on_egais_failed(entry):
+    """Чек из очереди отклонен УТМ или не отправлен за EGAIS_MAX_ATTEMPTS попыток"""
+    await save_egais_result(
+        status="error",
+        order_data=entry.order_data,
+        xml_data=entry.xml_data,
+        error=f"Не отправлен в ЕГАИС (попыток: {entry.attempts}): {entry.last_error}",
+        xml_file=entry.xml_file,
+        legacynum=entry.legacynum
+    )
+
+EGAIS_QR_DEADLINE = float(os.getenv('EGAIS_QR_DEADLINE', '120'))
+
+# Очередь отправки чеков в УТМ (таблица egais_outbox): повторы с паузой, порядок по кассам
+egais_outbox = OutboxDispatcher(
+    utm_client.send_xml,
+    on_sent=on_egais_sent,
+    on_failed=on_egais_failed,
+    retry_base=float(os.getenv('EGAIS_RETRY_BASE', '10')),
+    retry_max=float(os.getenv('EGAIS_RETRY_MAX', '600')),
+    max_attempts=int(os.getenv('EGAIS_MAX_ATTEMPTS', '50')),
+    available=utm_breaker.allow,
+    rejected=is_rejection,
+    retention=float(os.getenv('EGAIS_OUTBOX_RETENTION_DAYS', '30')) * 86400 or None
+)
+
+async def send_egais_check(order: Order, check_info=None, device=None, print_qr=True):
     """
     Отправка чека с алкогольной позицией в ЕГАИС (v4 XML через УТМ) и печать QR-кода при успехе
     Если EGAIS_SEND != true, только сохраняет исходный XML в файл.
+    При подключенной БД чек ставится в очередь egais_outbox и отправляется в фоне
+    (повторы при недоступном УТМ), без БД - отправляется сразу.
+    device: ККТ для печати QR-кода (по умолчанию - по залу заказа)
+    print_qr: печатать QR-код, когда УТМ примет чек
     """
-    egais_host = os.getenv('EGAIS_HOST', 'http://localhost:8080')
     egais_send = os.getenv('EGAIS_SEND', 'false').lower() == 'true'
     alco_items = [item for item in order.products if item.alco == '1' or item.alc_code]
     if not alco_items:
@@ -1035,7 +1469,14 @@ async def send_egais_check(order: Order, check_info=None):
         )
         return {"message": "В заказе нет алкогольных позиций для ЕГАИС"}
     try:
+        for item in alco_items:
+            try:
+                validate_bottle_fields(f"{float(item.price):.2f}", item.egais_mark_code or item.alc_code, item.EAN)
+            except ValueError as e:
+                raise ValueError(f"Позиция {item.name}: {e}")
         xml_data = build_egais_v4_xml(order, alco_items, last_check_info=check_info)
+        # Чек с ошибкой отклоняется здесь, а не после запроса к УТМ и повторов в очереди
+        validate_egais_xml(xml_data)
         ts = time.strftime('%Y%m%d_%H%M%S')
         
         # Создаем папку check если её нет
@@ -1056,50 +1497,39 @@ async def send_egais_check(order: Order, check_info=None):
                 legacynum=order.num
             )
             return {"message": "EGAIS_SEND is not true, XML сохранён в файл", "xml_file": xml_filepath}
-        files = {'xml_file': ('Cheque.xml', xml_data, 'application/xml')}
-        params = {'type': 'ChequeV3'}
-        response = requests.post(f"{egais_host}/xml", files=files, params=params, timeout=10)
-        response.raise_for_status()
+        device = device or kkt_pool.route(order.hall, order.table)
+        if db_connected:
+            entry = await egais_outbox.enqueue(
+                device.id,
+                xml_data.decode('utf-8'),
+                order_data=order.dict(),
+                legacynum=order.num,
+                xml_file=xml_filepath,
+                device_id=device.id,
+                print_qr=print_qr
+            )
+            return {"message": "Чек поставлен в очередь отправки в ЕГАИС", "outbox_id": entry.id, "xml_file": xml_filepath}
+        response_text = await utm_client.send_xml(xml_data)
         # Сохраняем ответ в файл
-        filename = f"egais_response_{ts}.txt"
-        filepath = os.path.join(check_dir, filename)
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write("=== ОТВЕТ ЕГАИС ===\n")
-            f.write(response.text)
+        filepath = save_egais_response(response_text)
         # Извлекаем URL и подпись из ответа ЕГАИС типа A
-        qr_url = None
-        sign = None
-        try:
-            import xml.etree.ElementTree as ET
-            root = ET.fromstring(response.text)
-            
-            # Ищем элемент <url>
-            url_elem = root.find('url')
-            if url_elem is not None:
-                qr_url = url_elem.text
-            
-            # Ищем элемент <sign>
-            sign_elem = root.find('sign')
-            if sign_elem is not None:
-                sign = sign_elem.text
-        except Exception:
-            pass
+        qr_url, sign = parse_utm_response(response_text)
         
-        if qr_url:
-            print_egais_qr(qr_url, sign)
+        if qr_url and print_qr:
+            await device.run(print_egais_qr, qr_url, sign, priority=PRIORITY_PRINT)
         # Сохраняем успешный результат в БД
         await save_egais_result(
             status="success",
             order_data=order.dict(),
             xml_data=xml_data.decode('utf-8'),
-            response_data=response.text,
+            response_data=response_text,
             qr_code=qr_url,
             sign=sign,
             xml_file=xml_filepath,
             saved_file=filepath,
             legacynum=order.num
         )
-        return {"message": "Чек v3 отправлен в ЕГАИС", "egais_response": response.text, "qr_code": qr_url, "sign": sign, "saved_file": filepath, "xml_file": xml_filepath}
+        return {"message": "Чек v3 отправлен в ЕГАИС", "egais_response": response_text, "qr_code": qr_url, "sign": sign, "saved_file": filepath, "xml_file": xml_filepath}
     except Exception as e:
         # Сохраняем ошибку в БД
         await save_egais_result(
@@ -1118,91 +1548,200 @@ async def api_send_egais_check(order: Order):
     """
     return await send_egais_check(order)
 
+def read_egais_xml_file(xml_file):
+    """XML чека из сохраненного файла (в журнале - путь или имя файла в папке check)"""
+    path = xml_file if os.path.exists(xml_file) else os.path.join("check", os.path.basename(xml_file))
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+class EgaisReplayRequest(BaseModel):
+    statuses: List[str] = ["error", "saved"]
+    ids: List[int] = None
+    date_from: datetime = None
+    date_to: datetime = None
+    limit: int = 500
+
+@app.get("/api/v1/egais/outbox")
+async def get_egais_outbox():
+    """Очередь отправки в ЕГАИС по кассам: ждут отправки, отправляются, не отправлены, возраст самого старого чека"""
+    global db_connected
+    if not db_connected:
+        return {"status": "error", "message": "База данных не подключена"}
+    try:
+        return {"status": "success", "data": await egais_outbox.status(),
+                "utm": {**utm_client.status(), 'state': utm_breaker.state}}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+@app.get("/api/v1/egais/utm")
+async def get_egais_utm(probe: bool = False):
+    """
+    Состояние автомата защиты УТМ: closed - чеки отправляются, open - УТМ недоступен,
+    чеки ждут в очереди до успешной проверки. Счетчики запросов, ошибок, отклоненных запросов.
+    probe=true - проверить УТМ немедленно
+    """
+    try:
+        if probe:
+            await utm_breaker.run_probe()
+        return {"status": "success", "data": {
+            **utm_breaker.as_dict(),
+            'utm': utm_client.status(),
+            'validation': egais_validator.counters if egais_validator is not None else None
+        }}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+@app.post("/api/v1/egais/outbox/retry")
+async def retry_egais_outbox(ids: List[int] = None):
+    """Вернуть в очередь чеки, не отправленные за EGAIS_MAX_ATTEMPTS попыток (все или ids)"""
+    global db_connected
+    if not db_connected:
+        return {"status": "error", "message": "База данных не подключена"}
+    try:
+        return {"status": "success", "queued": await egais_outbox.retry(ids)}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+@app.post("/api/v1/egais/replay")
+async def replay_egais_logs(request: EgaisReplayRequest):
+    """
+    Повторная отправка чеков из журнала ЕГАИС (egais_logs) через очередь:
+    по умолчанию со статусом error и saved (сохранены при EGAIS_SEND=false).
+    Запись, уже поставленная в очередь, и заказ, чек которого принят УТМ,
+    повторно не ставятся
+    """
+    global db_connected
+    if not db_connected:
+        return {"status": "error", "message": "База данных не подключена"}
+    if os.getenv('EGAIS_SEND', 'false').lower() != 'true':
+        return {"status": "error", "message": "Отправка в ЕГАИС выключена (EGAIS_SEND != true)"}
+    try:
+        # XML берется из журнала, а если он там не сохранен (большой загруженный файл) - из файла
+        query = EgaisLog.filter(status__in=request.statuses).filter(
+            Q(xml_data__isnull=False) & ~Q(xml_data="") | Q(xml_file__isnull=False) & ~Q(xml_file="")
+        )
+        if request.ids:
+            query = query.filter(id__in=request.ids)
+        if request.date_from:
+            query = query.filter(timestamp__gte=request.date_from)
+        if request.date_to:
+            query = query.filter(timestamp__lte=request.date_to)
+        logs = await query.order_by('id').limit(request.limit)
+        replayed = set(await EgaisOutbox.filter(
+            egais_log_id__in=[log.id for log in logs]
+        ).exclude(status="failed").values_list('egais_log_id', flat=True))
+        # Заказ, чек которого уже принят УТМ или ждет в очереди, не отправляем второй раз
+        numbers = [log.legacynum for log in logs if log.legacynum]
+        delivered = set(await EgaisLog.filter(status="success", legacynum__in=numbers).values_list('legacynum', flat=True))
+        delivered.update(await EgaisOutbox.filter(
+            legacynum__in=numbers, status__in=["pending", "sending"]
+        ).values_list('legacynum', flat=True))
+        queued = []
+        invalid = []
+        for log in logs:
+            if log.id in replayed or (log.legacynum and log.legacynum in delivered):
+                continue
+            try:
+                xml_data = log.xml_data or await asyncio.to_thread(read_egais_xml_file, log.xml_file)
+                validate_egais_xml(xml_data)
+            except (OSError, ValueError) as e:
+                invalid.append({"egais_log_id": log.id, "legacynum": log.legacynum, "error": str(e)})
+                continue
+            order_data = log.order_data or {}
+            try:
+                register = kkt_pool.route(order_data.get("hall"), order_data.get("table")).id
+            except Exception:
+                register = "replay"
+            entry = await egais_outbox.enqueue(
+                register,
+                xml_data,
+                order_data=log.order_data,
+                legacynum=log.legacynum,
+                xml_file=log.xml_file,
+                egais_log_id=log.id
+            )
+            queued.append({"egais_log_id": log.id, "outbox_id": entry.id, "legacynum": log.legacynum})
+        logger.info(f"Повторная отправка в ЕГАИС: в очереди {len(queued)} из {len(logs)} записей журнала")
+        return {"status": "success", "queued": queued, "invalid": invalid, "skipped": len(logs) - len(queued)}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+EGAIS_UPLOAD_MAX_SIZE = int(os.getenv('EGAIS_UPLOAD_MAX_SIZE', str(20 * 1024 * 1024)))
+EGAIS_UPLOAD_LOG_MAX = int(os.getenv('EGAIS_UPLOAD_LOG_MAX', str(1024 * 1024)))
+
 @app.post("/api/v1/send-egais-xml")
 async def api_send_egais_xml(xml_file: UploadFile = File(...), description: str = Form("")):
     """
     API endpoint для отправки XML файла в ЕГАИС
+    Файл пишется на диск по частям (не больше EGAIS_UPLOAD_MAX_SIZE байт), по ходу
+    загрузки считается SHA-256 и разбирается XML (при отправке - с проверкой по схеме).
+    В УТМ файл уходит с диска; в egais_logs XML сохраняется, если он не больше EGAIS_UPLOAD_LOG_MAX байт,
+    иначе только путь к файлу (повторная отправка читает XML из файла)
     """
+    order_data = {"description": description, "filename": xml_file.filename}
+    original_filepath = None
     try:
-        # Читаем содержимое XML файла
-        xml_content = await xml_file.read()
-        
         # Проверяем, что это XML файл
         if not xml_file.filename.endswith('.xml'):
             return {"error": "Файл должен иметь расширение .xml"}
         
-        # Создаем папку check если её нет
-        check_dir = "check"
-        if not os.path.exists(check_dir):
-            os.makedirs(check_dir)
-        
-        # Сохраняем оригинальный файл
-        ts = time.strftime('%Y%m%d_%H%M%S')
-        original_filename = f"egais_xml_upload_{ts}.xml"
-        original_filepath = os.path.join(check_dir, original_filename)
-        
-        with open(original_filepath, "wb") as f:
-            f.write(xml_content)
-        
         # Получаем настройки EGAIS
-        egais_host = os.getenv('EGAIS_HOST', 'http://localhost:8080')
         egais_send = os.getenv('EGAIS_SEND', 'false').lower() == 'true'
         
+        # Сохраняем оригинальный файл в папку check, проверяя XML по ходу загрузки
+        upload = await receive_xml_upload(
+            xml_file, "check", "egais_xml_upload", EGAIS_UPLOAD_MAX_SIZE,
+            validator=egais_validator if egais_send else None
+        )
+        original_filepath = upload['path']
+        order_data.update(size=upload['size'], sha256=upload['sha256'])
+        
+        def read_xml_for_log():
+            if upload['size'] > EGAIS_UPLOAD_LOG_MAX:
+                return None
+            with open(original_filepath, encoding="utf-8") as f:
+                return f.read()
+        
         if not egais_send:
             await save_egais_result(
                 status="saved",
-                order_data={"description": description, "filename": xml_file.filename},
-                xml_data=xml_content.decode('utf-8'),
+                order_data=order_data,
+                xml_data=await asyncio.to_thread(read_xml_for_log),
                 xml_file=original_filepath,
                 legacynum=None
             )
             return {
                 "message": "EGAIS_SEND is not true, XML сохранён в файл", 
-                "xml_file": original_filepath
+                "xml_file": original_filepath,
+                "size": upload['size'],
+                "sha256": upload['sha256']
             }
         
-        # Отправляем в EGAIS
-        files = {'xml_file': ('Cheque.xml', xml_content, 'application/xml')}
-        params = {'type': 'ChequeV3'}
-        response = requests.post(f"{egais_host}/xml", files=files, params=params, timeout=10)
-        response.raise_for_status()
+        # Отправляем в EGAIS с диска, не загружая файл в память
+        with open(original_filepath, "rb") as f:
+            response_text = await utm_client.send_xml(f)
         
         # Сохраняем ответ в файл
+        ts = time.strftime('%Y%m%d_%H%M%S')
         response_filename = f"egais_response_{ts}.txt"
-        response_filepath = os.path.join(check_dir, response_filename)
+        response_filepath = os.path.join("check", response_filename)
         with open(response_filepath, "w", encoding="utf-8") as f:
             f.write("=== ОТВЕТ ЕГАИС ===\n")
-            f.write(response.text)
+            f.write(response_text)
         
         # Извлекаем URL и подпись из ответа ЕГАИС типа A
-        qr_url = None
-        sign = None
-        try:
-            import xml.etree.ElementTree as ET
-            root = ET.fromstring(response.text)
-            
-            # Ищем элемент <url>
-            url_elem = root.find('url')
-            if url_elem is not None:
-                qr_url = url_elem.text
-            
-            # Ищем элемент <sign>
-            sign_elem = root.find('sign')
-            if sign_elem is not None:
-                sign = sign_elem.text
-        except Exception:
-            pass
+        qr_url, sign = parse_utm_response(response_text)
         
         # Печатаем QR-код если есть
         if qr_url:
-            print_egais_qr(qr_url, sign)
+            await kkt_pool.route().run(print_egais_qr, qr_url, sign, priority=PRIORITY_PRINT)
         
         # Сохраняем успешный результат в БД
         await save_egais_result(
             status="success",
-            order_data={"description": description, "filename": xml_file.filename},
-            xml_data=xml_content.decode('utf-8'),
-            response_data=response.text,
+            order_data=order_data,
+            xml_data=await asyncio.to_thread(read_xml_for_log),
+            response_data=response_text,
             qr_code=qr_url,
             sign=sign,
             xml_file=original_filepath,
@@ -1212,56 +1751,55 @@ async def api_send_egais_xml(xml_file: UploadFile = File(...), description: str
         
         return {
             "message": "XML документ отправлен в ЕГАИС", 
-            "egais_response": response.text, 
+            "egais_response": response_text, 
             "qr_code": qr_url, 
             "sign": sign,
             "saved_file": response_filepath, 
-            "xml_file": original_filepath
+            "xml_file": original_filepath,
+            "size": upload['size'],
+            "sha256": upload['sha256']
         }
         
     except Exception as e:
-        # Сохраняем ошибку в БД
+        # Сохраняем ошибку в БД. XML не дублируем: принятый файл остается на диске,
+        # /api/v1/egais/replay прочитает его по xml_file; отклоненный при загрузке файл не сохраняется
         await save_egais_result(
             status="error",
-            order_data={"description": description, "filename": xml_file.filename},
-            xml_data=xml_content.decode('utf-8') if 'xml_content' in locals() else None,
+            order_data=order_data,
+            xml_file=original_filepath,
             error=str(e),
             legacynum=None
         )
         return {"error": str(e)}
 
-def initialize_kkt_cache():
+def initialize_kkt_cache(fr, kkt_cache):
     """
-    Инициализировать кэш данных ККТ при старте приложения
+    Инициализировать кэш данных ККТ при старте приложения (выполняется в потоке ККТ)
     """
-    global KKT_CACHE
     try:
-        fr = win32com.client.Dispatch('Addin.DRvFR')
-        fr.Connect()
         fr.Password = 30
         
         # Получаем данные фискализации ФН
         fr.GetECRStatus()
-        KKT_CACHE['INN'] = getattr(fr, 'INN', None)
+        kkt_cache['INN'] = getattr(fr, 'INN', None)
         fr.ReadSerialNumber()
-        KKT_CACHE['KKTSerialNumber'] = getattr(fr, 'SerialNumber', None)
+        kkt_cache['KKTSerialNumber'] = getattr(fr, 'SerialNumber', None)
         
         # Получаем серийный номер ККТ и регистрационный номер
         fr.FNGetFiscalizationResult()
-        KKT_CACHE['KKTRegistrationNumber'] = getattr(fr, 'KKTRegistrationNumber', None)
+        kkt_cache['KKTRegistrationNumber'] = getattr(fr, 'KKTRegistrationNumber', None)
         
         # Получаем серийный номер ФН
         fr.FNGetSerial()
-        KKT_CACHE['FNSerialNumber'] = getattr(fr, 'SerialNumber', None)
+        kkt_cache['FNSerialNumber'] = getattr(fr, 'SerialNumber', None)
         
-        fr.Disconnect()
-        KKT_CACHE['initialized'] = True
+        kkt_cache['initialized'] = True
         
-        logger.success(f"Кэш ККТ инициализирован: INN={KKT_CACHE['INN']}, KKTRegNumber={KKT_CACHE['KKTRegistrationNumber']}, KKTSerialNumber={KKT_CACHE['KKTSerialNumber']}, FNSerialNumber={KKT_CACHE['FNSerialNumber']}")
+        logger.success(f"Кэш ККТ инициализирован: INN={kkt_cache['INN']}, KKTRegNumber={kkt_cache['KKTRegistrationNumber']}, KKTSerialNumber={kkt_cache['KKTSerialNumber']}, FNSerialNumber={kkt_cache['FNSerialNumber']}")
         
     except Exception as e:
         logger.error(f"Ошибка инициализации кэша ККТ: {e}")
-        KKT_CACHE['initialized'] = False
+        kkt_cache['initialized'] = False
 
 def get_ecr_status(fr):
     """
@@ -1280,45 +1818,12 @@ def get_ecr_status(fr):
     except Exception as e:
         return {'error': str(e)}
 
-def get_fn_expiration_time():
-    """
-    Получить срок действия ФН (FNGetExpirationTime)
-    """
-    try:
-        fr = win32com.client.Dispatch('Addin.DRvFR')
-        fr.Connect()
-        fr.Password = 30
-        
-        # Запрос срока действия ФН
-        fr.FNGetExpirationTime()
-        
-        fn_expiration = {
-            'Date': getattr(fr, 'Date', None),
-            'ResultCode': fr.ResultCode,
-            'ResultCodeDescription': fr.ResultCodeDescription
-        }
-        
-        fr.Disconnect()
-        
-        return {
-            "status": "success",
-            "fn_expiration": fn_expiration
-        }
-        
-    except Exception as e:
-        return {
-            "status": "error",
-            "error": str(e)
-        }
-
-def get_fn_current_session_params():
+def get_fn_current_session_params(fr):
     """
     Получить параметры текущей смены ФН (FNGetCurrentSessionParams)
     Возвращает состояние смены, номер смены и номер чека
     """
     try:
-        fr = win32com.client.Dispatch('Addin.DRvFR')
-        fr.Connect()
         fr.Password = 30
         
         # Вызываем FNGetCurrentSessionParams
@@ -1333,8 +1838,6 @@ def get_fn_current_session_params():
             "result_description": fr.ResultCodeDescription
         }
         
-        fr.Disconnect()
-        
         return {
             "status": "success",
             "session_params": session_params
@@ -1346,13 +1849,11 @@ def get_fn_current_session_params():
             "error": str(e)
         }
 
-def get_kkt_info():
+def get_kkt_info(fr):
     """
     Получить общие параметры ККТ включая DocumentNumber
     """
     try:
-        fr = win32com.client.Dispatch('Addin.DRvFR')
-        fr.Connect()
         fr.Password = 30
         
         kkt_info = {}
@@ -1408,8 +1909,6 @@ def get_kkt_info():
         except Exception as e:
             kkt_info['FNExpiration'] = {'error': str(e)}
         
-        fr.Disconnect()
-        
         return {
             "status": "success",
             "kkt_info": kkt_info
@@ -1421,26 +1920,101 @@ def get_kkt_info():
             "error": str(e)
         }
 
+def collect_kkt_status(fr, device):
+    """
+    Снимок состояния ККТ и ФН для фонового опроса (выполняется в потоке ККТ).
+    Заодно синхронизирует отслеживаемое состояние ККТ.
+    """
+    kkt_info = get_kkt_info(fr)
+    session_params = get_fn_current_session_params(fr)
+    fn_expiration = {"status": kkt_info["status"]}
+    if kkt_info["status"] == "success":
+        fn_expiration["fn_expiration"] = kkt_info["kkt_info"]["FNExpiration"]
+        ecr_status = kkt_info["kkt_info"]["ECRStatus"]
+        if ecr_status.get("ResultCode") == 0 and session_params["status"] == "success":
+            device.state.sync(
+                ecr_status["ECRMode"],
+                session_number=session_params["session_params"]["session_number"],
+                document_number=ecr_status["DocumentNumber"]
+            )
+    else:
+        fn_expiration["error"] = kkt_info["error"]
+    return {
+        "kkt_info": kkt_info,
+        "fn_expiration": fn_expiration,
+        "session_params": session_params
+    }
+
+# Фоновый опрос состояния ККТ в свободные промежутки очереди
+kkt_status_poller = KktStatusPoller(
+    kkt_pool,
+    collect_kkt_status,
+    interval=float(os.getenv('KKT_STATUS_INTERVAL', '30'))
+)
+
+async def get_kkt_status(device_id, key, fresh):
+    """
+    Получить часть снимка состояния ККТ с возрастом снимка в секундах.
+    fresh - опросить ККТ немедленно
+    """
+    try:
+        device = kkt_pool.get(device_id)
+        if fresh or device.snapshot is None:
+            await kkt_status_poller.refresh(device)
+        return {**device.snapshot[key], "age": kkt_status_poller.age(device)}
+    except Exception as e:
+        return {
+            "status": "error",
+            "error": str(e)
+        }
+
 @app.get("/api/v1/kkt-info")
-async def api_get_kkt_info():
+async def api_get_kkt_info(device_id: str = None, fresh: int = 0):
     """
     API endpoint для получения общих параметров ККТ включая DocumentNumber
     """
-    return get_kkt_info()
+    return await get_kkt_status(device_id, "kkt_info", fresh)
 
 @app.get("/api/v1/fn-expiration")
-async def api_get_fn_expiration():
+async def api_get_fn_expiration(device_id: str = None, fresh: int = 0):
     """
     API endpoint для получения срока действия ФН
     """
-    return get_fn_expiration_time()
+    return await get_kkt_status(device_id, "fn_expiration", fresh)
 
 @app.get("/api/v1/fn-session-params")
-async def api_get_fn_session_params():
+async def api_get_fn_session_params(device_id: str = None, fresh: int = 0):
     """
     API endpoint для получения параметров текущей смены ФН
     """
-    return get_fn_current_session_params()
+    return await get_kkt_status(device_id, "session_params", fresh)
+
+@app.get("/api/v1/kkt/metrics")
+async def api_get_kkt_metrics(device_id: str = None, reset: int = 0):
+    """
+    Счетчики и гистограммы задержек вызовов драйвера ККТ по методам и свойствам
+    (с момента запуска или последнего сброса; ?reset=1 - сбросить после чтения)
+    """
+    devices = [kkt_pool.get(device_id)] if device_id else list(kkt_pool.devices.values())
+    result = {}
+    for device in devices:
+        if device.metrics is None:
+            result[device.id] = None
+            continue
+        result[device.id] = device.metrics.as_dict()
+        if reset:
+            device.metrics.reset()
+    return {"status": "success", "metrics": result}
+
+@app.get("/api/v1/kkt/devices")
+async def api_get_kkt_devices():
+    """
+    API endpoint для получения состояния ККТ в пуле
+    """
+    return {
+        "status": "success",
+        "devices": kkt_pool.status()
+    }
 
 @app.get("/api/v1/logs/checks")
 async def get_check_logs(page: int = 1, limit: int = 50, status: str = None):
@@ -1740,6 +2314,8 @@ async def get_categories():
                     "description": cat.description,
                     "legacy_id": cat.legacy_id,
                     "parent_id": cat.parent_id,
+                    "kitchen_station": cat.kitchen_station,
+                    "kitchen_printer": cat.kitchen_printer,
                     "is_active": cat.is_active,
                     "created_at": cat.created_at.isoformat() if cat.created_at else None,
                     "updated_at": cat.updated_at.isoformat() if cat.updated_at else None
@@ -1751,7 +2327,8 @@ async def get_categories():
         return {"status": "error", "error": str(e)}
 
 @app.post("/api/v1/categories")
-async def create_category(name: str = Form(...), description: str = Form(None), legacy_id: str = Form(None), parent_id: int = Form(None)):
+async def create_category(name: str = Form(...), description: str = Form(None), legacy_id: str = Form(None), parent_id: int = Form(None),
+                          kitchen_station: str = Form(None), kitchen_printer: str = Form(None)):
     """Создать новую категорию"""
     global db_connected
     if not db_connected:
@@ -1771,7 +2348,9 @@ async def create_category(name: str = Form(...), description: str = Form(None),
             if not parent:
                 return {"status": "error", "message": f"Родительская категория с ID {parent_id} не найдена"}
         
-        category = await Category.create(name=name, description=description, legacy_id=legacy_id, parent=parent)
+        category = await Category.create(name=name, description=description, legacy_id=legacy_id, parent=parent,
+                                         kitchen_station=kitchen_station or None, kitchen_printer=kitchen_printer or None)
+        kitchen_router.invalidate()
         return {
             "status": "success",
             "data": {
@@ -1780,6 +2359,8 @@ async def create_category(name: str = Form(...), description: str = Form(None),
                 "description": category.description,
                 "legacy_id": category.legacy_id,
                 "parent_id": category.parent_id,
+                "kitchen_station": category.kitchen_station,
+                "kitchen_printer": category.kitchen_printer,
                 "is_active": category.is_active
             }
         }
@@ -1787,7 +2368,8 @@ async def create_category(name: str = Form(...), description: str = Form(None),
         return {"status": "error", "error": str(e)}
 
 @app.put("/api/v1/categories/{category_id}")
-async def update_category(category_id: int, name: str = Form(...), description: str = Form(None), legacy_id: str = Form(None), parent_id: int = Form(None)):
+async def update_category(category_id: int, name: str = Form(...), description: str = Form(None), legacy_id: str = Form(None), parent_id: int = Form(None),
+                          kitchen_station: str = Form(None), kitchen_printer: str = Form(None)):
     """Обновить категорию"""
     global db_connected
     if not db_connected:
@@ -1823,7 +2405,13 @@ async def update_category(category_id: int, name: str = Form(...), description:
         category.legacy_id = legacy_id
         if parent_id is not None:
             category.parent = parent
+        # Станция и принтер меняются, только если переданы; пустая строка - сбросить
+        if kitchen_station is not None:
+            category.kitchen_station = kitchen_station or None
+        if kitchen_printer is not None:
+            category.kitchen_printer = kitchen_printer or None
         await category.save()
+        kitchen_router.invalidate()
         
         return {
             "status": "success",
@@ -1833,6 +2421,8 @@ async def update_category(category_id: int, name: str = Form(...), description:
                 "description": category.description,
                 "legacy_id": category.legacy_id,
                 "parent_id": category.parent_id,
+                "kitchen_station": category.kitchen_station,
+                "kitchen_printer": category.kitchen_printer,
                 "is_active": category.is_active
             }
         }
@@ -1858,6 +2448,7 @@ async def delete_category(category_id: int):
         
         category.is_active = False
         await category.save()
+        kitchen_router.invalidate()
         
         return {"status": "success", "message": "Категория удалена"}
     except Exception as e:
@@ -2501,6 +3092,8 @@ async def create_product(product_data: ProductCreateRequest):
                 gtin=product_data.gtin
             )
             logger.info(f"Создан новый продукт: '{product_data.name}', id={product.id}")
+        # Товар мог сменить категорию - маршруты кухонных марок перестраиваются
+        kitchen_router.invalidate()
         
         return {
             "status": "success",
@@ -2581,6 +3174,7 @@ async def update_product(product_id: int, product_data: ProductCreateRequest):
         product.gtin = product_data.gtin
         
         await product.save()
+        kitchen_router.invalidate()
         
         return {
             "status": "success",
@@ -2620,6 +3214,7 @@ async def delete_product(product_id: int):
         
         product.is_active = False
         await product.save()
+        kitchen_router.invalidate()
         
         return {"status": "success", "message": "Товар удален"}
     except Exception as e: